@@ -0,0 +1,67 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Wire codecs for the internal apis between the plugin runner, the
+# plugin service and the task engine. JSON is always available and is
+# the default. If msgpack is installed then clients can ask for it with
+# the Accept header and send it with the Content-Type header, which
+# makes large issue batches and session summaries smaller and cheaper
+# to encode and decode.
+#
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = "application/json"
+MSGPACK = "application/x-msgpack"
+
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False)
+
+def _msgpack_dumps(data):
+    return msgpack.packb(data, use_bin_type=False)
+
+CODECS = { JSON: (json.dumps, json.loads) }
+if msgpack is not None:
+    CODECS[MSGPACK] = (_msgpack_dumps, _msgpack_loads)
+
+
+def available():
+    return sorted(CODECS)
+
+def preferred():
+    """The most compact codec that we have."""
+    return MSGPACK if MSGPACK in CODECS else JSON
+
+def accept_header():
+    """The Accept header for clients: the preferred codec, falling back to JSON."""
+    return MSGPACK + ", " + JSON if MSGPACK in CODECS else JSON
+
+def _media_type(value):
+    return (value or "").split(";")[0].strip().lower()
+
+def negotiate(accept):
+    """Pick the codec for a response from an Accept header. Anything we do not know gets JSON."""
+    for media_type in (accept or "").split(","):
+        media_type = _media_type(media_type)
+        if media_type in CODECS:
+            return media_type
+    return JSON
+
+def encode(content_type, data):
+    return CODECS[content_type][0](data)
+
+def decode(content_type, body):
+    """Decode a body by its Content-Type. A missing or unknown type is treated as JSON."""
+    content_type = _media_type(content_type)
+    if content_type not in CODECS:
+        content_type = JSON
+    return CODECS[content_type][1](body)
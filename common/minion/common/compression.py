@@ -0,0 +1,78 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# gzip and deflate compression of response bodies. Scan summaries and
+# session results are large and very repetitive, so they compress
+# well. Small bodies are sent as is since compressing them is not
+# worth it. Very large bodies are compressed in the thread pool so
+# that we do not block the reactor while doing so.
+#
+
+import zlib
+
+from twisted.internet.defer import succeed
+from twisted.internet.threads import deferToThread
+
+
+DEFAULT_MINIMUM_SIZE = 1024
+DEFAULT_THREAD_SIZE = 256 * 1024
+DEFAULT_LEVEL = 6
+
+# zlib window bits for the gzip and the zlib (HTTP deflate) formats
+WBITS = { 'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS }
+
+
+def negotiate(accept_encoding):
+    """Pick gzip or deflate from an Accept-Encoding header or return None."""
+    qualities = {}
+    for part in (accept_encoding or "").split(","):
+        fields = part.split(";")
+        quality = 1.0
+        for field in fields[1:]:
+            field = field.strip()
+            if field.startswith("q="):
+                try:
+                    quality = float(field[2:])
+                except ValueError:
+                    quality = 0.0
+        qualities[fields[0].strip().lower()] = quality
+    for encoding in ('gzip', 'deflate'):
+        if qualities.get(encoding, qualities.get('*', 0.0)) > 0.0:
+            return encoding
+
+def compress(encoding, data, level=DEFAULT_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+def decompress(encoding, data):
+    if encoding in WBITS:
+        return zlib.decompress(data, WBITS[encoding])
+    return data
+
+
+class Compression:
+
+    def __init__(self, minimum_size=DEFAULT_MINIMUM_SIZE, thread_size=DEFAULT_THREAD_SIZE, level=DEFAULT_LEVEL):
+        self.minimum_size = minimum_size
+        self.thread_size = thread_size
+        self.level = level
+
+    def finish(self, handler, body, content_type):
+        """Finish the request with the body, compressed if the client accepts that. Returns a Deferred."""
+        handler.set_header("Content-Type", content_type)
+        handler.set_header("Vary", "Accept-Encoding")
+        encoding = None
+        if len(body) >= self.minimum_size:
+            encoding = negotiate(handler.request.headers.get("Accept-Encoding"))
+        if encoding is None:
+            handler.finish(body)
+            return succeed(None)
+        def _finish(data):
+            handler.set_header("Content-Encoding", encoding)
+            handler.finish(data)
+        if len(body) >= self.thread_size:
+            return deferToThread(compress, encoding, body, self.level).addCallback(_finish)
+        _finish(compress(encoding, body, self.level))
+        return succeed(None)
@@ -0,0 +1,144 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# A small in-process metrics registry with counters, gauges and
+# histograms that can be rendered in the Prometheus text exposition
+# format. Updating a metric is a dictionary update (plus a bisect for
+# histograms), all the formatting work happens when /metrics is
+# scraped. Everything runs in the reactor thread so there is no
+# locking.
+#
+
+import bisect
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, _escape(value)) for name,value in zip(names, values)) + "}"
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+
+    TYPE = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def samples(self):
+        for labels,value in sorted(self.values.items()):
+            yield self.name, self.labels, labels, value
+
+    def exposition(self):
+        lines = ["# HELP %s %s" % (self.name, self.description),
+                 "# TYPE %s %s" % (self.name, self.TYPE)]
+        for name, label_names, label_values, value in self.samples():
+            lines.append("%s%s %s" % (name, _format_labels(label_names, label_values), _format_value(value)))
+        return "\n".join(lines)
+
+class Counter(Metric):
+
+    TYPE = "counter"
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+
+    """
+    A gauge is either set explicitly or, if a function is given, is
+    computed when the metrics are collected. The function returns a
+    single value or, for labeled gauges, a dictionary that maps label
+    value tuples to values.
+    """
+
+    TYPE = "gauge"
+
+    def __init__(self, name, description, labels=(), function=None):
+        Metric.__init__(self, name, description, labels)
+        self.function = function
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def samples(self):
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            self.values = values
+        return Metric.samples(self)
+
+class Histogram(Metric):
+
+    TYPE = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        # Per label set we keep [bucket counts..., +Inf count, sum]
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        label_names = self.labels + ('le',)
+        for labels,counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound,count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + "_bucket", label_names, labels + (_format_value(bound),), cumulative
+            yield self.name + "_sum", self.labels, labels, counts[-1]
+            yield self.name + "_count", self.labels, labels, cumulative
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=(), function=None):
+        return self.register(Gauge(name, description, labels, function))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def exposition(self):
+        return "\n".join(self.metrics[name].exposition() for name in sorted(self.metrics)) + "\n"
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Priority classes. A scan is high, normal or low priority and its
+# plugin sessions get the same priority. The task engine passes it to
+# the plugin service in the X-Minion-Priority header.
+#
+# Work that waits for capacity, scans waiting to be created in the task
+# engine and sessions waiting for a plugin-runner in the plugin service,
+# is kept in a FairQueue. It hands out work by weighted round robin over
+# the classes that have work waiting. With the default weights, when all
+# three classes are waiting, 8 out of every 13 go to high, 4 to normal
+# and 1 to low priority work. So high priority work goes first, but low
+# priority work always gets its share and is never starved.
+#
+
+import collections
+
+
+PRIORITY_HEADER = "X-Minion-Priority"
+
+PRIORITIES = ('high', 'normal', 'low')
+DEFAULT_PRIORITY = 'normal'
+DEFAULT_WEIGHTS = { 'high': 8, 'normal': 4, 'low': 1 }
+
+
+def valid_priority(priority):
+    return priority in PRIORITIES
+
+def priority_rank(priority):
+    """Sort key, high priority first"""
+    return PRIORITIES.index(priority)
+
+
+class FairQueue:
+
+    """
+    A FIFO queue per priority class. popleft() uses smooth weighted round
+    robin (as in nginx), which interleaves the classes instead of serving
+    each one in bursts of its weight.
+    """
+
+    def __init__(self, weights=None):
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.queues = dict((priority, collections.deque()) for priority in PRIORITIES)
+        self._current = dict((priority, 0) for priority in PRIORITIES)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def append(self, item, priority=DEFAULT_PRIORITY):
+        self.queues[priority].append(item)
+
+    def popleft(self):
+        waiting = [priority for priority in PRIORITIES if self.queues[priority]]
+        if not waiting:
+            raise IndexError("pop from an empty FairQueue")
+        total = 0
+        for priority in PRIORITIES:
+            if priority in waiting:
+                self._current[priority] += self.weights[priority]
+                total += self.weights[priority]
+            else:
+                # A class does not save up credit while it has nothing waiting
+                self._current[priority] = 0
+        chosen = max(waiting, key=lambda priority: self._current[priority])
+        self._current[chosen] -= total
+        return self.queues[chosen].popleft()
+
+    def remove(self, item, priority=DEFAULT_PRIORITY):
+        try:
+            self.queues[priority].remove(item)
+        except ValueError:
+            pass
+
+    def counts(self):
+        return dict((priority, len(queue)) for priority, queue in self.queues.items())
@@ -0,0 +1,60 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# On-demand profiling of a running service. The profiler is turned on
+# in the reactor thread for a number of seconds and then writes its
+# stats to a file that can be inspected with pstats or snakeviz. It
+# can be triggered with SIGUSR2 or through the admin api.
+#
+
+import cProfile
+import logging
+import os
+import signal
+import time
+
+from twisted.internet import reactor
+
+
+DEFAULT_PROFILE_SECONDS = 30
+MAXIMUM_PROFILE_SECONDS = 600
+
+
+class ReactorProfiler:
+
+    def __init__(self, name, directory="/tmp"):
+        self.name = name
+        self.directory = os.path.expanduser(directory)
+        self.profiler = None
+        self.path = None
+
+    def running(self):
+        return self.profiler is not None
+
+    def start(self, seconds=DEFAULT_PROFILE_SECONDS):
+        """Profile the reactor thread for the given number of seconds. Returns the path of the stats file."""
+        if self.running():
+            return None
+        seconds = max(1, min(seconds, MAXIMUM_PROFILE_SECONDS))
+        self.path = os.path.join(self.directory, "%s-%d-%d.prof" % (self.name, os.getpid(), int(time.time())))
+        logging.info("Profiling %s for %d seconds to %s" % (self.name, seconds, self.path))
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        reactor.callLater(seconds, self.stop)
+        return self.path
+
+    def stop(self):
+        if not self.running():
+            return
+        self.profiler.disable()
+        try:
+            self.profiler.dump_stats(self.path)
+            logging.info("Wrote profile of %s to %s" % (self.name, self.path))
+        except Exception as e:
+            logging.error("Failed to write profile to %s: %s" % (self.path, str(e)))
+        self.profiler = None
+
+    def install_signal_handler(self, signum=signal.SIGUSR2, seconds=DEFAULT_PROFILE_SECONDS):
+        signal.signal(signum, lambda signum, frame: reactor.callFromThread(self.start, seconds))
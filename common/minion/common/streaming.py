@@ -0,0 +1,198 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Serving of (large) files like artifact zips. Files are streamed to the
+# client in chunks as the connection can take them, so a download does
+# not need the whole file in memory. Content can also be put together
+# from parts of several files, like a zip made from stored blobs. Single
+# byte ranges are supported so that downloads can be resumed, and
+# Last-Modified and ETag headers let clients check if they already have
+# the content.
+#
+
+import email.utils
+import os
+import re
+
+import zope.interface
+from twisted.internet import interfaces
+from twisted.internet.defer import Deferred, succeed
+
+
+CHUNK_SIZE = 64 * 1024
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class SegmentProducer:
+
+    """
+    Pull producer that writes a list of segments to a consumer. A segment
+    is either a string or a (path, offset, length) tuple for a part of a
+    file. The deferred fires with the number of bytes that were written
+    when done or when the consumer went away.
+    """
+
+    zope.interface.implements(interfaces.IPullProducer)
+
+    def __init__(self, segments, consumer):
+        self.segments = list(reversed(segments))
+        self.consumer = consumer
+        self.written = 0
+        self.deferred = Deferred()
+        self.file = None
+        self.remaining = 0
+
+    def start(self):
+        self.consumer.registerProducer(self, False)
+        return self.deferred
+
+    def _next_chunk(self):
+        while True:
+            if self.file is not None:
+                chunk = self.file.read(min(CHUNK_SIZE, self.remaining)) if self.remaining else ""
+                if chunk:
+                    self.remaining -= len(chunk)
+                    return chunk
+                self.file.close()
+                self.file = None
+            if not self.segments:
+                return ""
+            segment = self.segments.pop()
+            if isinstance(segment, str):
+                if segment:
+                    return segment
+            else:
+                path, offset, self.remaining = segment
+                self.file = open(path, "rb")
+                self.file.seek(offset)
+
+    def resumeProducing(self):
+        chunk = self._next_chunk()
+        if not chunk:
+            self._done()
+            return
+        self.written += len(chunk)
+        self.consumer.write(chunk)
+
+    def stopProducing(self):
+        self._done()
+
+    def _done(self):
+        if self.deferred is None:
+            return
+        self.consumer.unregisterProducer()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        deferred, self.deferred = self.deferred, None
+        deferred.callback(self.written)
+
+
+def _segment_length(segment):
+    return len(segment) if isinstance(segment, str) else segment[2]
+
+def slice_segments(segments, start, length):
+    """The segments for length bytes starting at start"""
+    sliced = []
+    for segment in segments:
+        size = _segment_length(segment)
+        if start >= size:
+            start -= size
+            continue
+        take = min(size - start, length)
+        if isinstance(segment, str):
+            sliced.append(segment[start:start + take])
+        else:
+            sliced.append((segment[0], segment[1] + start, take))
+        start = 0
+        length -= take
+        if not length:
+            break
+    return sliced
+
+
+def file_etag(stat):
+    return '"%x-%x"' % (int(stat.st_mtime * 1000000), stat.st_size)
+
+def _not_modified(handler, etag, mtime):
+    if_none_match = handler.request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        return etag in [e.strip() for e in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = handler.request.headers.get("If-Modified-Since")
+    if if_modified_since is not None:
+        date = email.utils.parsedate_tz(if_modified_since)
+        return date is not None and int(mtime) <= email.utils.mktime_tz(date)
+    return False
+
+def parse_range(value, size):
+    """Parse a Range header. Returns (start, end) of a single range, None to send everything or False if unsatisfiable."""
+    match = RANGE_PATTERN.match((value or "").replace(" ", ""))
+    if match is None:
+        # Multiple ranges or another unit. We are allowed to ignore those.
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+def serve_file(handler, path, content_type, filename=None):
+    """Stream a file. Returns a Deferred that the handler has to return, see serve_segments()."""
+    stat = os.stat(path)
+    return serve_segments(handler, [(path, 0, stat.st_size)], stat.st_size, file_etag(stat), stat.st_mtime,
+                          content_type, filename)
+
+def serve_segments(handler, segments, size, etag, mtime, content_type, filename=None):
+
+    """
+    Stream content that is made up of segments, see SegmentProducer, with
+    support for conditional and range requests. Returns a Deferred that
+    fires with the number of body bytes sent. The handler has to return it.
+    """
+
+    handler.set_header("Etag", etag)
+    handler.set_header("Last-Modified", email.utils.formatdate(mtime, usegmt=True))
+    handler.set_header("Accept-Ranges", "bytes")
+    if _not_modified(handler, etag, mtime):
+        handler.set_status(304)
+        handler.finish()
+        return succeed(0)
+
+    start, end = 0, size - 1
+    # If-Range makes the range conditional on the content not having changed
+    if_range = handler.request.headers.get("If-Range")
+    if "Range" in handler.request.headers and (if_range is None or if_range == etag):
+        byte_range = parse_range(handler.request.headers["Range"], size)
+        if byte_range is False:
+            handler.set_status(416)
+            handler.set_header("Content-Range", "bytes */%d" % size)
+            handler.finish()
+            return succeed(0)
+        if byte_range is not None:
+            start, end = byte_range
+            handler.set_status(206)
+            handler.set_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+
+    handler.set_header("Content-Type", content_type)
+    handler.set_header("Content-Length", str(end - start + 1))
+    if filename is not None:
+        handler.set_header("Content-Disposition", "inline; filename=\"%s\"" % filename)
+    handler.flush()
+    if handler.request.method == "HEAD" or end < start:
+        handler.finish()
+        return succeed(0)
+
+    # The headers are out, now the body goes straight to the connection
+    producer = SegmentProducer(slice_segments(segments, start, end - start + 1), handler.request.connection.transport)
+    def _finish(written):
+        handler.finish()
+        return written
+    return producer.start().addCallback(_finish)
@@ -0,0 +1,88 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Per-scan latency tracing. A Timeline is a list of timestamped
+# lifecycle events that share a trace id. The task engine creates the
+# trace id for a scan and passes it to the plugin service in the
+# X-Minion-Trace-Id header, which passes it on to the plugin runner,
+# so that the events (and log lines) of all three can be tied
+# together. Timelines can be exported in the Chrome trace event format
+# to look at them in chrome://tracing or ui.perfetto.dev.
+#
+# Event times are wall clock times. If the task engine and plugin
+# service run on different hosts then their clocks need to be in sync
+# for a combined timeline to make sense.
+#
+
+import re
+import time
+import uuid
+
+
+TRACE_ID_HEADER = "X-Minion-Trace-Id"
+TRACE_ID_PATTERN = re.compile(r"^[a-f0-9]{32}$")
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+def valid_trace_id(trace_id):
+    return trace_id is not None and TRACE_ID_PATTERN.match(trace_id) is not None
+
+
+class Timeline:
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or new_trace_id()
+        self.events = []
+
+    def event(self, name, **attributes):
+        event = { 'name': name, 'time': time.time() }
+        if attributes:
+            event['attributes'] = attributes
+        self.events.append(event)
+
+    def add_events(self, events, **attributes):
+        """Merge events that were recorded elsewhere, like in the plugin runner."""
+        for event in events or []:
+            if 'name' in event and 'time' in event:
+                event = dict(event)
+                if attributes:
+                    event['attributes'] = dict(event.get('attributes', {}), **attributes)
+                self.events.append(event)
+        self.events.sort(key=lambda event: event['time'])
+
+    def summary(self):
+        return { 'trace_id': self.trace_id, 'events': list(self.events) }
+
+
+def chrome_trace(tracks, trace_id=None):
+
+    """
+    Convert a list of (process name, thread name, events) tracks to a
+    Chrome trace. Every event becomes a slice that lasts until the
+    next event on the same track, the last event becomes an instant.
+    """
+
+    trace_events = []
+    processes = {}
+    for process_name, thread_name, events in tracks:
+        if process_name not in processes:
+            processes[process_name] = len(processes) + 1
+            trace_events.append({ 'ph': 'M', 'name': 'process_name', 'pid': processes[process_name], 'tid': 0,
+                                  'args': { 'name': process_name } })
+        pid = processes[process_name]
+        tid = len(trace_events) + 1
+        trace_events.append({ 'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid, 'args': { 'name': thread_name } })
+        events = sorted(events, key=lambda event: event['time'])
+        for event, next_event in zip(events, events[1:] + [None]):
+            trace_event = { 'name': event['name'], 'pid': pid, 'tid': tid, 'ts': int(event['time'] * 1000000),
+                            'args': event.get('attributes', {}) }
+            if next_event is None:
+                trace_event.update({ 'ph': 'i', 's': 't' })
+            else:
+                trace_event.update({ 'ph': 'X', 'dur': int((next_event['time'] - event['time']) * 1000000) })
+            trace_events.append(trace_event)
+    return { 'traceEvents': trace_events, 'displayTimeUnit': 'ms', 'otherData': { 'trace_id': trace_id } }
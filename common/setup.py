@@ -0,0 +1,20 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from setuptools import setup
+
+install_requires = [
+    'cyclone==1.0'
+]
+
+setup(name="minion.common",
+      version="0.1",
+      description="Minion Common Modules",
+      url="https://github.com/ygjb/minion",
+      author="Mozilla",
+      author_email="minion@mozilla.com",
+      packages=['minion', 'minion.common'],
+      namespace_packages=['minion','minion.common'],
+      include_package_data=True,
+      install_requires = install_requires)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Load benchmark for the plugin service. This runs a PluginServiceApplication
+# in this process and pushes many sessions of one of the synthetic plugins
+# from minion.plugins.test through it. Every session runs in a real
+# minion-plugin-runner process, so minion has to be installed (or set up
+# with setup.py develop) and minion-plugin-runner has to be on the PATH.
+#
+#  python benchmarks/plugin_service_load.py --scenario flood --sessions 200 --concurrency 20
+#
+
+import json
+import logging
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredSemaphore, gatherResults, inlineCallbacks, returnValue
+from twisted.internet.task import deferLater
+from twisted.web.client import getPage
+
+from minion.plugin_service import service, web
+
+
+SCENARIOS = {
+    'flood': ('minion.plugins.test.IssueFloodPlugin', {'issues': 1000, 'batch': 10, 'size': 256}),
+    'progress': ('minion.plugins.test.ProgressPlugin', {'updates': 500, 'rate': 0}),
+    'artifacts': ('minion.plugins.test.ArtifactsPlugin', {'directories': 10, 'files': 10, 'size': 65536}),
+    'cpu': ('minion.plugins.test.CPUBurnPlugin', {'seconds': 2}),
+    'delayed': ('minion.plugins.test.DelayedPlugin', {}),
+}
+
+
+def request(url, **kwargs):
+    return getPage(url.encode('ascii'), **kwargs).addCallback(json.loads)
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def distribution(values):
+    return { 'p50': percentile(values, 50), 'p95': percentile(values, 95), 'max': max(values) if values else None }
+
+def histogram_mean(histogram):
+    # Histogram values are the bucket counts followed by the sum
+    values = histogram.values.get((), [0, 0.0])
+    count = sum(values[:-1])
+    return { 'count': count, 'mean': values[-1] / count if count else None }
+
+class Benchmark:
+
+    def __init__(self, options, api, plugin_name, configuration):
+        self.options = options
+        self.api = api
+        self.plugin_name = plugin_name
+        self.configuration = configuration
+        self.durations = []
+        self.runner_rss = []
+        self.issues = 0
+        self.states = {}
+
+    @inlineCallbacks
+    def run_session(self):
+        response = yield request(self.api + "/session/create/" + self.plugin_name, method='PUT',
+                                 postdata=json.dumps(self.configuration))
+        session_id = response['session']['id']
+        started = time.time()
+        yield request(self.api + "/session/%s/state" % session_id, method='PUT', postdata='START')
+        while True:
+            response = yield request(self.api + "/session/%s" % session_id)
+            if response['session']['state'] in ('FINISHED', 'FAILED', 'STOPPED'):
+                break
+            yield deferLater(reactor, self.options.poll_interval, lambda: None)
+        self.durations.append(time.time() - started)
+        response = yield request(self.api + "/session/%s/results" % session_id)
+        session = response['session']
+        self.states[session['state']] = self.states.get(session['state'], 0) + 1
+        self.issues += len(response['issues'])
+        if session.get('resources'):
+            self.runner_rss.append(session['resources']['max_rss'])
+        yield request(self.api + "/session/%s" % session_id, method='DELETE')
+
+    @inlineCallbacks
+    def run(self):
+        semaphore = DeferredSemaphore(self.options.concurrency)
+        started = time.time()
+        yield gatherResults([semaphore.run(self.run_session) for n in range(self.options.sessions)])
+        elapsed = time.time() - started
+        returnValue({ 'scenario': self.options.scenario,
+                      'plugin': self.plugin_name,
+                      'configuration': self.configuration,
+                      'sessions': self.options.sessions,
+                      'concurrency': self.options.concurrency,
+                      'states': self.states,
+                      'elapsed': elapsed,
+                      'sessions_per_second': self.options.sessions / elapsed,
+                      'session_duration': distribution(self.durations),
+                      'launch_latency': histogram_mean(web.SESSION_LAUNCH_DURATION),
+                      'issues': self.issues,
+                      'issues_per_second': self.issues / elapsed,
+                      'artifacts_zip': histogram_mean(service.ARTIFACTS_ZIP_DURATION),
+                      'service_peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+                      'runner_peak_rss': distribution(self.runner_rss) })
+
+def print_report(report):
+    print "Scenario         : %s (%s)" % (report['scenario'], report['plugin'])
+    print "Sessions         : %d (%s)" % (report['sessions'], ", ".join("%s=%d" % i for i in sorted(report['states'].items())))
+    print "Concurrency      : %d" % report['concurrency']
+    print "Elapsed          : %.2fs (%.2f sessions/s)" % (report['elapsed'], report['sessions_per_second'])
+    d = report['session_duration']
+    print "Session duration : p50 %.3fs p95 %.3fs max %.3fs" % (d['p50'], d['p95'], d['max'])
+    if report['launch_latency']['count']:
+        print "Launch latency   : mean %.3fs" % report['launch_latency']['mean']
+    print "Issues ingested  : %d (%.1f/s)" % (report['issues'], report['issues_per_second'])
+    if report['artifacts_zip']['count']:
+        print "Artifacts zip    : %d zips, mean %.3fs" % (report['artifacts_zip']['count'], report['artifacts_zip']['mean'])
+    print "Service peak RSS : %.1f MB" % (report['service_peak_rss'] / 1048576.0)
+    if report['runner_peak_rss']['max']:
+        print "Runner peak RSS  : p50 %.1f MB max %.1f MB" % (report['runner_peak_rss']['p50'] / 1048576.0,
+                                                             report['runner_peak_rss']['max'] / 1048576.0)
+
+if __name__ == "__main__":
+
+    parser = optparse.OptionParser()
+    parser.add_option("-v", "--verbose", action="store_true")
+    parser.add_option("-s", "--scenario", default="flood", help="One of %s" % ", ".join(sorted(SCENARIOS)))
+    parser.add_option("-c", "--configuration", help="JSON plugin configuration that overrides the scenario defaults")
+    parser.add_option("-n", "--sessions", type="int", default=100)
+    parser.add_option("--concurrency", type="int", default=10)
+    parser.add_option("--poll-interval", type="float", default=0.25)
+    parser.add_option("--json", action="store_true", help="Print the report as JSON")
+
+    (options, args) = parser.parse_args()
+
+    if options.scenario not in SCENARIOS:
+        parser.error("Unknown scenario %s" % options.scenario)
+    plugin_name, configuration = SCENARIOS[options.scenario]
+    configuration = dict(configuration, target="http://127.0.0.1/")
+    if options.configuration:
+        configuration.update(json.loads(options.configuration))
+
+    work_directory_root = tempfile.mkdtemp()
+    settings = { 'work_directory_root': work_directory_root,
+                 'plugins': [name for name,_ in SCENARIOS.values()],
+                 'reaper': None }
+    application = web.PluginServiceApplication(settings)
+    port = reactor.listenTCP(0, application, interface='127.0.0.1')
+    api = "http://127.0.0.1:%d" % port.getHost().port
+    application.plugin_service.api = api
+
+    # The application configures debug logging, tone that down
+    logging.getLogger().setLevel(logging.DEBUG if options.verbose else logging.WARNING)
+
+    result = {}
+
+    @inlineCallbacks
+    def main():
+        try:
+            benchmark = Benchmark(options, api, plugin_name, configuration)
+            result['report'] = yield benchmark.run()
+        except Exception as e:
+            logging.exception("Benchmark failed: %s" % str(e))
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(main)
+    reactor.run()
+    shutil.rmtree(work_directory_root, ignore_errors=True)
+
+    report = result.get('report')
+    if report is None:
+        sys.exit(1)
+    if options.json:
+        print json.dumps(report, indent=4, sort_keys=True)
+    else:
+        print_report(report)
+    if report['states'].get('FINISHED', 0) != options.sessions:
+        sys.exit(1)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Micro-benchmark of the wire codecs in minion.common.codec. It
+# encodes and decodes issue batches and session results that look like
+# what plugins report and compares the cost and payload size. Codecs
+# that are not installed are skipped.
+#
+#  python benchmarks/wire_codecs.py --issues 10,100,1000
+#
+
+import datetime
+import json
+import optparse
+import random
+import sys
+import timeit
+import uuid
+
+from minion.common import codec
+
+
+SEVERITIES = ["Info", "Low", "Medium", "High"]
+
+def make_issue(n):
+    return { "Summary": "Issue %d: %s" % (n, random.choice(["Missing header", "Open port", "Outdated software", "Cookie without Secure flag"])),
+             "Description": " ".join(random.choice(["the", "server", "responded", "with", "a", "header", "that", "is", "not", "recommended"])
+                                     for i in range(random.randint(20, 80))),
+             "Severity": random.choice(SEVERITIES),
+             "URLs": ["http://www.example.com/path/%d/page-%d.html" % (n, i) for i in range(random.randint(1, 5))],
+             "FurtherInfo": [{ "URL": "https://developer.mozilla.org/en-US/docs/HTTP/X-Frame-Options", "Title": "Mozilla Developer Network" }],
+             "Id": str(uuid.uuid4()),
+             "Date": datetime.datetime.utcnow().isoformat() + "Z" }
+
+def make_results(issues):
+    # What GET /session/<id>/results returns
+    session = { "id": str(uuid.uuid4()), "state": "FINISHED", "configuration": { "target": "http://www.example.com" },
+                "plugin": { "name": "Example", "version": "0.0", "class": "minion.plugins.example.ExamplePlugin" },
+                "progress": { "percentage": 100, "description": "Done" }, "started": 1353090532, "duration": 12,
+                "issues": [], "artifacts": {}, "failure": None }
+    return { "success": True, "session": session, "issues": issues }
+
+def measure(function, repeat):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+if __name__ == "__main__":
+
+    parser = optparse.OptionParser()
+    parser.add_option("--issues", default="10,100,1000", help="Comma separated issue batch sizes")
+    parser.add_option("--repeat", type="int", default=20)
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--json", action="store_true", help="Print the report as JSON")
+
+    (options, args) = parser.parse_args()
+
+    random.seed(options.seed)
+
+    report = []
+    for count in [int(n) for n in options.issues.split(",")]:
+        issues = [make_issue(n) for n in range(count)]
+        for payload_name, payload in (("issues", issues), ("results", make_results(issues))):
+            # Decode what we send, so that both codecs decode the same (unicode) data
+            payload = json.loads(json.dumps(payload))
+            for content_type in codec.available():
+                data = codec.encode(content_type, payload)
+                if codec.decode(content_type, data) != payload:
+                    print >>sys.stderr, "%s does not round trip %s" % (content_type, payload_name)
+                    sys.exit(1)
+                report.append({ 'payload': payload_name,
+                                'issues': count,
+                                'codec': content_type,
+                                'bytes': len(data),
+                                'encode': measure(lambda: codec.encode(content_type, payload), options.repeat),
+                                'decode': measure(lambda: codec.decode(content_type, data), options.repeat) })
+
+    if options.json:
+        print json.dumps(report, indent=4, sort_keys=True)
+    else:
+        print "%-8s %7s %-22s %10s %10s %10s" % ("payload", "issues", "codec", "bytes", "encode ms", "decode ms")
+        for r in report:
+            print "%-8s %7d %-22s %10d %10.3f %10.3f" % (r['payload'], r['issues'], r['codec'], r['bytes'],
+                                                        r['encode'] * 1000, r['decode'] * 1000)
@@ -5,12 +5,19 @@
 import logging
 import os
 import sys
+import urlparse
 import uuid
+from StringIO import StringIO
 
 from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred, DeferredSemaphore, fail, maybeDeferred
 from twisted.internet.threads import deferToThread
-from twisted.internet.error import ProcessDone, ProcessTerminated
-from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.error import ProcessDone, ProcessTerminated, TimeoutError
+from twisted.internet.protocol import ProcessProtocol, Protocol
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
 import zope.interface
 
 
@@ -72,6 +79,20 @@ class AbstractPlugin:
     def version(cls):
         return getattr(cls, "PLUGIN_VERSION", "0.0")
 
+    # Plugins that can scan many targets in one run set PLUGIN_BATCH_SIZE
+    # to the most targets they want per run. They get a 'targets' list in
+    # their configuration instead of a single 'target' and should set the
+    # Target field of the issues that they report.
+
+    @classmethod
+    def batch_size(cls):
+        return getattr(cls, "PLUGIN_BATCH_SIZE", 1)
+
+    def targets(self):
+        if 'targets' in self.configuration:
+            return self.configuration['targets']
+        return [self.configuration['target']]
+
     zope.interface.implements(IPlugin, IPluginRunnerCallbacks)
 
     # Plugins can finish in three states: succesfully, stopped and failed.
@@ -149,6 +170,195 @@ class BlockingPlugin(AbstractPlugin):
         self.stopped = True
 
 
+class HTTPResponse:
+
+    """
+    The response to an AsyncHTTPPlugin.fetch(). The body is cut off at the
+    max_body_size of the plugin, in which case truncated is True.
+    """
+
+    def __init__(self, url, code, phrase, headers, body, truncated=False):
+        self.url = url
+        self.code = code
+        self.phrase = phrase
+        self.headers = headers
+        self.body = body
+        self.truncated = truncated
+
+
+class _BodyCollector(Protocol):
+
+    def __init__(self, deferred, max_size):
+        self.deferred = deferred
+        self.max_size = max_size
+        self.data = []
+        self.size = 0
+        self.truncated = False
+
+    def dataReceived(self, data):
+        if self.truncated:
+            return
+        if self.size + len(data) > self.max_size:
+            data = data[:self.max_size - self.size]
+            self.truncated = True
+        self.data.append(data)
+        self.size += len(data)
+        if self.truncated:
+            # Drops the connection, we do not want the rest
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        # Cancelled, the deferred has already failed
+        if self.deferred is None:
+            return
+        if self.truncated or reason.check(ResponseDone, PotentialDataLoss):
+            self.deferred.callback(("".join(self.data), self.truncated))
+        else:
+            self.deferred.errback(reason)
+
+
+class AsyncHTTPPlugin(AbstractPlugin):
+
+    """
+    Plugin that does many HTTP requests without blocking. do_run() is
+    called in the reactor thread and should return a Deferred that fires
+    when the plugin is done. It uses fetch() to do requests, which returns
+    a Deferred that fires with an HTTPResponse. Requests are queued so
+    that at most concurrency requests run at the same time, and at most
+    per_host_concurrency to the same host. Connections are kept alive and
+    reused. These limits and the timeouts can be changed in the plugin
+    configuration, the class attributes are the defaults.
+
+    When asked to stop, all queued and running requests are cancelled.
+    Their Deferreds fail with a CancelledError. A request that takes
+    longer than timeout seconds fails with a TimeoutError.
+    """
+
+    CONCURRENCY = 100
+    PER_HOST_CONCURRENCY = 10
+    CONNECT_TIMEOUT = 10.0
+    TIMEOUT = 30.0
+    MAX_BODY_SIZE = 1024 * 1024
+
+    def __init__(self):
+        self.stopped = False
+        self.pool = None
+        self.agent = None
+        self._semaphore = None
+        self._host_semaphores = {}
+        self._requests = set()
+
+    def do_run(self):
+        logging.error("You forgot to override AsyncHTTPPlugin.do_run()")
+
+    def _setting(self, name, default):
+        return type(default)(self.configuration.get(name, default))
+
+    def do_start(self):
+        self.concurrency = self._setting('concurrency', self.CONCURRENCY)
+        self.per_host_concurrency = self._setting('per_host_concurrency', self.PER_HOST_CONCURRENCY)
+        self.timeout = self._setting('timeout', self.TIMEOUT)
+        self.max_body_size = self._setting('max_body_size', self.MAX_BODY_SIZE)
+        self.pool = HTTPConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = self.per_host_concurrency
+        self.agent = Agent(reactor, connectTimeout=self._setting('connect_timeout', self.CONNECT_TIMEOUT), pool=self.pool)
+        self._semaphore = DeferredSemaphore(self.concurrency)
+        deferred = maybeDeferred(self.do_run)
+        deferred.addCallbacks(self._finish_with_success, self._finish_with_failure)
+        return deferred
+
+    def do_stop(self):
+        self.stopped = True
+        for deferred in list(self._requests):
+            deferred.cancel()
+
+    def _finish_with_success(self, result):
+        self.pool.closeCachedConnections()
+        if self.stopped:
+            self.report_finish(exit_code = AbstractPlugin.EXIT_STATE_STOPPED)
+        else:
+            self.report_finish(exit_code = AbstractPlugin.EXIT_STATE_FINISHED)
+
+    def _finish_with_failure(self, failure):
+        # Requests that failed because we were stopping are not a failure of the plugin
+        if self.stopped and failure.check(CancelledError):
+            return self._finish_with_success(None)
+        self.pool.closeCachedConnections()
+        self.report_issues([{"Summary":str(failure.value), "Severity":"Error"}])
+        self.report_finish(exit_code = AbstractPlugin.EXIT_STATE_FAILED)
+
+    def fetch(self, url, method="GET", headers=None, body=None):
+
+        """
+        Queue a request. Returns a Deferred that fires with an HTTPResponse.
+        Headers is a dict of header names to lists of values.
+        """
+
+        if self.stopped:
+            return fail(CancelledError())
+
+        # The Agent only takes byte strings, configurations are unicode
+        url, method = url.encode('utf-8'), method.encode('ascii')
+
+        # Wait for a slot for the host first, so that requests for a busy
+        # host do not take slots that requests for other hosts could use.
+        host = urlparse.urlparse(url).netloc
+        host_semaphore = self._host_semaphores.get(host)
+        if host_semaphore is None:
+            host_semaphore = self._host_semaphores[host] = DeferredSemaphore(self.per_host_concurrency)
+
+        acquired = []
+        deferred = host_semaphore.acquire()
+        deferred.addCallback(acquired.append)
+        deferred.addCallback(lambda _: self._semaphore.acquire())
+        deferred.addCallback(acquired.append)
+        deferred.addCallback(lambda _: self._request(url, method, headers, body))
+
+        def _done(result):
+            for semaphore in acquired:
+                semaphore.release()
+            self._requests.discard(deferred)
+            if host_semaphore.tokens == host_semaphore.limit:
+                self._host_semaphores.pop(host, None)
+            # Depending on where it was, a cancelled request fails in different ways
+            if self.stopped and isinstance(result, Failure):
+                return Failure(CancelledError())
+            return result
+        deferred.addBoth(_done)
+        self._requests.add(deferred)
+        return deferred
+
+    def _request(self, url, method, headers, body):
+        producer = FileBodyProducer(StringIO(body)) if body is not None else None
+        deferred = self.agent.request(method, url, Headers(headers or {}), producer)
+        def _read_body(response):
+            def _cancel(_):
+                # Cancelling fails collected, the collector should not fire it again
+                collector.deferred = None
+                collector.transport.stopProducing()
+            collected = Deferred(_cancel)
+            collector = _BodyCollector(collected, self.max_body_size)
+            response.deliverBody(collector)
+            def _response(result):
+                data, truncated = result
+                return HTTPResponse(url, response.code, response.phrase, response.headers, data, truncated)
+            return collected.addCallback(_response)
+        deferred.addCallback(_read_body)
+
+        timed_out = []
+        def _timeout():
+            timed_out.append(True)
+            deferred.cancel()
+        timeout = reactor.callLater(self.timeout, _timeout)
+        def _done(result):
+            if timeout.active():
+                timeout.cancel()
+            if timed_out and isinstance(result, Failure):
+                return Failure(TimeoutError("%s took longer than %s seconds" % (url, self.timeout)))
+            return result
+        return deferred.addBoth(_done)
+
+
 class ExternalProcessProtocol(ProcessProtocol):
 
     """
@@ -0,0 +1,217 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Durable plugin sessions. Session creations, changes, issue batches and
+# deletions are appended to a journal file, one JSON record per line.
+# Every compact_records records the journal is compacted: all sessions
+# are written to a snapshot and a new journal file is started. On startup
+# the plugin service reads the snapshot, replays the journals on top of
+# it and continues from there. See PluginService.start_journal().
+#
+# Journal files are numbered by generation. The snapshot records the
+# generation of the journal that was started with it, so a crash while
+# writing a snapshot simply means that more journals are replayed.
+#
+# Changes to a session are coalesced: a session that changes many times
+# within one reactor tick is written once, at the end of the tick.
+#
+
+import json
+import logging
+import os
+import re
+import time
+
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThread
+
+
+SNAPSHOT_NAME = "snapshot.json"
+JOURNAL_NAME_PATTERN = re.compile(r"^journal-(\d+)\.log$")
+
+
+def _journal_path(directory, generation):
+    return os.path.join(directory, "journal-%d.log" % generation)
+
+def _journal_generations(directory):
+    generations = []
+    for name in os.listdir(directory):
+        match = JOURNAL_NAME_PATTERN.match(name)
+        if match:
+            generations.append(int(match.group(1)))
+    return sorted(generations)
+
+def _write_snapshot(directory, snapshot, generation, fsync):
+    """Atomically replace the snapshot and remove the journals that it covers"""
+    path = os.path.join(directory, SNAPSHOT_NAME)
+    data = json.dumps(snapshot)
+    with open(path + ".tmp", "w") as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.rename(path + ".tmp", path)
+    for old_generation in _journal_generations(directory):
+        if old_generation < generation:
+            os.remove(_journal_path(directory, old_generation))
+
+def _replay(sessions, record):
+    op = record['op']
+    if op == 'create':
+        sessions[record['session']['id']] = record['session']
+    elif record['id'] not in sessions:
+        return
+    elif op == 'update':
+        sessions[record['id']].update(record['session'])
+    elif op == 'issues':
+        sessions[record['id']].setdefault('issues', []).extend(record['issues'])
+    elif op == 'delete':
+        del sessions[record['id']]
+
+
+class SessionJournal:
+
+    def __init__(self, plugin_service, directory, compact_records=10000, fsync=False):
+        self.plugin_service = plugin_service
+        self.directory = directory
+        self.compact_records = compact_records
+        self.fsync = fsync
+        self.generation = 0
+        self.records = 0
+        self.compacting = False
+        self.stats = { 'records': 0, 'compactions': 0, 'last_compaction': None,
+                       'recovered': 0, 'adopted': 0, 'failed': 0, 'reaped': 0 }
+        self._file = None
+        self._dirty = {}
+        self._flush_call = None
+
+    def recover(self):
+
+        """
+        Read the snapshot and replay the journals. Returns the session
+        records in the order in which the sessions were created.
+        """
+
+        if not os.path.exists(self.directory):
+            logging.info("Creating session journal directory %s" % self.directory)
+            os.makedirs(self.directory)
+
+        started = time.time()
+        sessions, generation = {}, 0
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_NAME)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path) as f:
+                snapshot = json.load(f)
+            generation = snapshot['generation']
+            for session in snapshot['sessions']:
+                sessions[session['id']] = session
+
+        replayed = 0
+        for journal_generation in _journal_generations(self.directory):
+            if journal_generation < generation:
+                continue
+            with open(_journal_path(self.directory, journal_generation)) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A partial last line if we died while writing it
+                        logging.warning("Skipping corrupt record in journal %d" % journal_generation)
+                        continue
+                    _replay(sessions, record)
+                    replayed += 1
+            self.generation = journal_generation
+
+        self.generation = max(self.generation, generation)
+        self.stats['recovered'] = len(sessions)
+        logging.info("Recovered %d sessions from snapshot %d and %d journal records in %.3f seconds"
+                     % (len(sessions), generation, replayed, time.time() - started))
+        return sorted(sessions.values(), key=lambda session: session['started'])
+
+    def open(self):
+        """Start journaling. Writes the current sessions to a new snapshot."""
+        snapshot = self._start_generation()
+        _write_snapshot(self.directory, snapshot, self.generation, self.fsync)
+        self.stats['compactions'] += 1
+        self.stats['last_compaction'] = int(time.time())
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _start_generation(self):
+        # Take the snapshot here, in the reactor thread, so that it is
+        # consistent with the point where the new journal starts. It is
+        # serialized in a thread. Snapshots are new dicts and issues are
+        # only ever appended, so copying the lists of issues is enough.
+        self.flush()
+        self.generation += 1
+        snapshot = { 'generation': self.generation,
+                     'sessions': [dict(session.snapshot(), issues=list(session.results))
+                                  for session in self.plugin_service.sessions.values()] }
+        if self._file is not None:
+            self._file.close()
+        self._file = open(_journal_path(self.directory, self.generation), "a")
+        self.records = 0
+        return snapshot
+
+    def compact(self):
+        if self.compacting:
+            return
+        self.compacting = True
+        snapshot = self._start_generation()
+        def _done(result):
+            self.compacting = False
+            self.stats['compactions'] += 1
+            self.stats['last_compaction'] = int(time.time())
+        def _failed(failure):
+            self.compacting = False
+            logging.error("Failed to write session snapshot: %s" % failure.value)
+        deferToThread(_write_snapshot, self.directory, snapshot, self.generation, self.fsync).addCallbacks(_done, _failed)
+
+    def _append(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self.records += 1
+        self.stats['records'] += 1
+        if self._flush_call is None:
+            self._flush_call = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if self._file is None:
+            return
+        dirty, self._dirty = self._dirty, {}
+        for session in dirty.values():
+            self._file.write(json.dumps({ 'op': 'update', 'id': session.id, 'session': session.snapshot() }) + "\n")
+            self.records += 1
+            self.stats['records'] += 1
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        if self.records >= self.compact_records:
+            self.compact()
+
+    # Called by the PluginService
+
+    def session_created(self, session):
+        self._append({ 'op': 'create', 'session': dict(session.snapshot(), issues=list(session.results)) })
+
+    def session_changed(self, session):
+        self._dirty[session.id] = session
+        if self._flush_call is None:
+            self._flush_call = reactor.callLater(0, self.flush)
+
+    def session_issues_added(self, session, issues):
+        self._append({ 'op': 'issues', 'id': session.id, 'issues': issues })
+
+    def session_deleted(self, session):
+        self._dirty.pop(session.id, None)
+        self._append({ 'op': 'delete', 'id': session.id })
@@ -7,8 +7,12 @@
 import datetime
 import json
 import logging
+import multiprocessing
 import optparse
 import os
+import re
+import shutil
+import signal
 import time
 import uuid
 import zipfile
@@ -16,9 +20,119 @@ import zipfile
 import zope.interface
 from twisted.internet import protocol
 from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
 from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
 
+from minion.common import codec
+from minion.common import metrics
+from minion.common.priority import DEFAULT_PRIORITY, FairQueue
+from minion.common import tracing
 from minion.plugin_api import AbstractPlugin
+from minion.plugin_service.journal import SessionJournal
+
+
+# The url that plugin runners use to report back to us
+PLUGIN_SERVICE_API = "http://127.0.0.1:8181"
+
+RESOURCE_SAMPLE_INTERVAL = 5.0
+
+# How often we check if an adopted plugin-runner is still alive
+ADOPTED_RUNNER_POLL_INTERVAL = 1.0
+
+ARTIFACTS_ZIP_DURATION = metrics.registry.histogram("minion_plugin_service_artifacts_zip_duration_seconds",
+                                                    "Time it takes to zip the artifacts of a session")
+
+# Limits on the issues that a single session can report. Issues beyond
+# these are dropped and the session is marked as truncated. They can be
+# changed or disabled (with null) in the limits settings.
+DEFAULT_LIMITS = { 'issues': 100000, 'issue_bytes': 64 * 1024 * 1024 }
+
+# Resource limits that are passed to the plugin-runner, which will
+# apply them to itself with setrlimit(). The plugin and any tools it
+# spawns inherit them.
+RLIMITS = ('cpu', 'as', 'fsize', 'nofile', 'nproc')
+
+#
+# Resource accounting helpers. These read from /proc and are Linux
+# only. On other platforms we simply do not collect live usage.
+#
+
+def _process_children(pid):
+    try:
+        with open("/proc/%d/task/%d/children" % (pid, pid)) as f:
+            return [int(child) for child in f.read().split()]
+    except (IOError, ValueError):
+        return []
+
+def _process_tree(pid):
+    pids = [pid]
+    for child in _process_children(pid):
+        pids += _process_tree(child)
+    return pids
+
+def _process_usage(pid):
+    """Return the (cpu seconds, rss bytes) of a single process"""
+    with open("/proc/%d/stat" % pid) as f:
+        # The command name can contain spaces, so skip past it
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu_ticks = sum(int(field) for field in fields[11:15]) # utime, stime, cutime, cstime
+    return (float(cpu_ticks) / os.sysconf('SC_CLK_TCK'), int(fields[21]) * os.sysconf('SC_PAGE_SIZE'))
+
+def _process_tree_usage(pids):
+    cpu_time, rss = 0.0, 0
+    for pid in pids:
+        try:
+            usage = _process_usage(pid)
+            cpu_time += usage[0]
+            rss += usage[1]
+        except (IOError, OSError, IndexError, ValueError):
+            pass
+    return cpu_time, rss
+
+def _process_command(pid):
+    """Return the command line of a process or an empty list if it is gone or a zombie"""
+    try:
+        with open("/proc/%d/cmdline" % pid) as f:
+            return f.read().split("\0")[:-1]
+    except IOError:
+        return []
+
+def _runner_options(command):
+    """Return the options of a plugin-runner command line or None if it is not a plugin-runner"""
+    if not [arg for arg in command[:2] if os.path.basename(arg) == "minion-plugin-runner"]:
+        return None
+    options = {}
+    for name, value in zip(command, command[1:]):
+        if name.startswith("--"):
+            options[name[2:]] = value
+    return options
+
+def _find_runners(work_directory_root):
+    """Find the plugin-runners of a plugin service with this work directory root. Returns a session id to pid dict."""
+    runners = {}
+    work_directory_root = os.path.realpath(work_directory_root)
+    for name in os.listdir("/proc"):
+        if not name.isdigit() or int(name) == os.getpid():
+            continue
+        options = _runner_options(_process_command(int(name)))
+        if options is None or options.get('mode') != 'plugin-service' or 'session-id' not in options:
+            continue
+        if os.path.realpath(options.get('work-root', '/tmp')) == work_directory_root:
+            runners[options['session-id']] = int(name)
+    return runners
+
+def _directory_size(path):
+    size = 0
+    for base, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(base, file)).st_size
+            except OSError:
+                pass
+    return size
 
 class PluginRunnerProcessProtocol(protocol.ProcessProtocol):
 
@@ -39,14 +153,23 @@ class PluginRunnerProcessProtocol(protocol.ProcessProtocol):
 
     def processEnded(self, reason):
         #logging.debug("PluginRunnerProcessProtocol.processEnded %s" % str(reason))
+        self.plugin_session.process_ended()
+        self.plugin_session.timeline.event('runner-ended', exit_code=getattr(reason.value, 'exitCode', None))
         self.plugin_session.duration = int(time.time()) - self.plugin_session.started
-        if isinstance(reason.value, ProcessDone):
+        if self.plugin_session.failure:
+            # The watchdog killed the runner because it went over budget
+            self.plugin_session.set_state('FAILED')
+        elif isinstance(reason.value, ProcessDone):
             # TODO This should happen async to not block. Probably better in the success callback of spawnProcess() ?
             if self.plugin_session.artifacts:
+                self.plugin_session.timeline.event('zipping-artifacts')
+                self.plugin_session.changed()
+                started = time.time()
                 try:
                     logging.debug("Opening zip file %s" % self.plugin_session.artifacts_path())
                     os.chdir(self.plugin_session.work_directory) # This is cheating a little but it makes path handling easier
                     with zipfile.ZipFile(self.plugin_session.artifacts_path(), "w") as zip:
+                        zip.comment = ARTIFACTS_ZIP_COMMENT
                         for name,paths in self.plugin_session.artifacts.items():
                             for path in paths:
                                 if os.path.isfile(path):
@@ -60,11 +183,63 @@ class PluginRunnerProcessProtocol(protocol.ProcessProtocol):
                                             zip.write(fn, fn, zipfile.ZIP_DEFLATED)
                 except Exception as e:
                     logging.exception("Failed to create artifacts zip file: " + str(e))
+                ARTIFACTS_ZIP_DURATION.observe(time.time() - started)
             # TODO Is this the right thing to do now that we set the state from /session/id/report/finish ?
-            self.plugin_session.state = 'FINISHED'
+            self.plugin_session.set_state('FINISHED')
         elif isinstance(reason.value, ProcessTerminated):
             # TODO Is this the right thing to do now that we set the state from /session/id/report/finish ?
-            self.plugin_session.state = 'FAILED'
+            self.plugin_session.set_state('FAILED')
+
+class AdoptedRunnerProcess:
+
+    """
+    A plugin-runner that was started by a previous run of the plugin
+    service and that is still running. It is not our child, so we do
+    not get its exit status. Instead we poll /proc to see when it is
+    gone and then let the protocol know like a child process would.
+    """
+
+    def __init__(self, pid, protocol):
+        self.pid = pid
+        self.protocol = protocol
+        self._looper = LoopingCall(self._check)
+        self._looper.start(ADOPTED_RUNNER_POLL_INTERVAL, now=False)
+
+    def signalProcess(self, signal_name):
+        signum = { 'KILL': signal.SIGKILL, 'TERM': signal.SIGTERM, 'INT': signal.SIGINT }.get(signal_name, signal_name)
+        try:
+            os.kill(self.pid, signum)
+        except OSError:
+            pass
+
+    def _check(self):
+        if _process_command(self.pid):
+            return
+        self._looper.stop()
+        # A runner that reported that it finished exits normally. If it
+        # did not then we have no idea what happened to it.
+        session = self.protocol.plugin_session
+        if session.state in TERMINAL_STATES:
+            reason = ProcessDone(0)
+        else:
+            session.failure = session.failure or "plugin-runner exited without reporting that it finished"
+            reason = ProcessTerminated()
+        self.protocol.processEnded(Failure(reason))
+
+# Sessions in these states are done and will not change anymore
+TERMINAL_STATES = ('FINISHED', 'STOPPED', 'FAILED')
+
+# Session versions are only meaningful within one run of the plugin
+# service, so the ETags that we make from them include this epoch.
+VERSION_EPOCH = uuid.uuid4().hex[:8]
+
+SESSION_ID_PATTERN = re.compile(r"^[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}(\.zip)?$")
+
+# The work directory root can be shared with others, it is /tmp by
+# default, so we mark the work directories and artifact zips that we
+# create. The reaper only removes orphans that carry these marks.
+WORK_DIRECTORY_MARKER = ".minion-plugin-session"
+ARTIFACTS_ZIP_COMMENT = "minion-plugin-session"
 
 class PluginSession:
 
@@ -73,12 +248,19 @@ class PluginSession:
     collecting from the plugin, etc.
     """
 
-    def __init__(self, plugin_name, plugin_class, configuration, work_directory_root, debug = False):
+    def __init__(self, plugin_name, plugin_class, configuration, work_directory_root, debug = False, listener = None,
+                 limits = None, rlimits = None, plugin_service_api = PLUGIN_SERVICE_API, trace_id = None,
+                 priority = DEFAULT_PRIORITY):
         self.plugin_name = plugin_name
         self.plugin_class = plugin_class
         self.configuration = configuration
         self.work_directory_root = work_directory_root
         self.debug = debug
+        self.listener = listener
+        self.limits = limits or {}
+        self.rlimits = rlimits or {}
+        self.plugin_service_api = plugin_service_api
+        self.priority = priority
         
         self.id = str(uuid.uuid4())
         self.state = 'CREATED'
@@ -89,11 +271,135 @@ class PluginSession:
         self.progress = None
         self.artifacts = {}
         self.work_directory = os.path.join(self.work_directory_root, self.id)
-        
+        self.finished = None
+        self.runner_started = None
+        self.resources = { 'cpu_time': 0.0, 'max_rss': 0, 'disk_usage': 0 }
+        self.failure = None
+        self.issue_bytes = 0
+        self.truncated = None
+        self.process = None
+        self._pids = []
+        self._watchdog = None
+        self.timeline = tracing.Timeline(trace_id)
+        self.timeline.event('created')
+        self.version = 0
+
+    #
+    # The version is bumped on every change to the session (state, progress,
+    # issues, artifacts, resources, timeline) so that pollers can ask if
+    # anything changed since they last looked. Note that the duration of a
+    # running session is computed and does not bump the version.
+    #
+
+    def changed(self):
+        self.version += 1
+        if self.listener is not None:
+            self.listener.session_changed(self)
+
+    def etag(self):
+        return 'W/"%s.%d"' % (VERSION_EPOCH, self.version)
+
+    #
+    # All state changes go through here so that the listener (the
+    # PluginService) can keep its counters up to date without having
+    # to walk over all sessions.
+    #
+
+    def set_state(self, state):
+        previous_state = self.state
+        self.state = state
+        if previous_state != state:
+            self.timeline.event(state.lower())
+            self.changed()
+        if state in TERMINAL_STATES and self.finished is None:
+            self.finished = int(time.time())
+        if self.listener is not None and previous_state != state:
+            self.listener.session_state_changed(self, previous_state, state)
+
+    def process_ended(self):
+        if self._watchdog is not None and self._watchdog.running:
+            self._watchdog.stop()
+        deferToThread(_directory_size, self.work_directory).addCallback(self._update_disk_usage)
+        self.changed()
+        if self.listener is not None:
+            self.listener.session_process_ended(self)
+
+    #
+    # Resource accounting. While the plugin-runner is alive we periodically
+    # sample the cpu time and memory of the runner and all its children
+    # from /proc and the size of the work directory. If any of these go
+    # over the configured limits then we kill the runner and the session
+    # will be marked as FAILED with the reason. When the runner finishes
+    # it reports its own (more accurate) rusage.
+    #
+
+    def _sample_resources(self):
+        self._pids = _process_tree(self.process.pid)
+        cpu_time, rss = _process_tree_usage(self._pids)
+        if cpu_time > self.resources['cpu_time'] or rss > self.resources['max_rss']:
+            self.resources['cpu_time'] = max(self.resources['cpu_time'], cpu_time)
+            self.resources['max_rss'] = max(self.resources['max_rss'], rss)
+            self.changed()
+        d = deferToThread(_directory_size, self.work_directory)
+        d.addCallback(self._update_disk_usage)
+        d.addCallback(lambda _: self._check_limits())
+        d.addErrback(lambda failure: logging.error("Failed to sample resources of session %s: %s" % (self.id, failure.value)))
+        return d
+
+    def _update_disk_usage(self, size):
+        if size != self.resources['disk_usage']:
+            self.resources['disk_usage'] = size
+            self.changed()
+
+    def _check_limits(self):
+        if self.state not in ('STARTED', 'STOPPING') or self.failure:
+            return
+        if self.limits.get('cpu_time') and self.resources['cpu_time'] > self.limits['cpu_time']:
+            self.terminate("cpu time limit of %d seconds exceeded" % self.limits['cpu_time'])
+        elif self.limits.get('memory') and self.resources['max_rss'] > self.limits['memory']:
+            self.terminate("memory limit of %d bytes exceeded" % self.limits['memory'])
+        elif self.limits.get('disk') and self.resources['disk_usage'] > self.limits['disk']:
+            self.terminate("disk limit of %d bytes exceeded" % self.limits['disk'])
+        # The duration is that of the runner, time spent waiting to be started does not count
+        elif (self.limits.get('duration') and self.runner_started is not None
+              and time.time() - self.runner_started > self.limits['duration']):
+            self.terminate("duration limit of %d seconds exceeded" % self.limits['duration'])
+
+    def terminate(self, reason):
+        logging.error("Terminating plugin session %s %s: %s" % (self.id, self.plugin_name, reason))
+        self.failure = reason
+        self.timeline.event('terminated', reason=reason)
+        self.changed()
+        # Kill the tools that the runner spawned too, not just the runner
+        for pid in reversed(self._pids):
+            if pid != self.process.pid:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        self.process.signalProcess('KILL')
+
+    #
+    # Adopt a plugin-runner that was started by a previous run of the
+    # plugin service and that survived its restart. The runner keeps
+    # retrying its reports while we are down, so it simply continues.
+    #
+
+    def adopt(self, pid):
+        logging.info("Adopting plugin-runner %d of session %s %s" % (pid, self.id, self.plugin_name))
+        self.process = AdoptedRunnerProcess(pid, PluginRunnerProcessProtocol(self))
+        self.timeline.event('runner-adopted', pid=pid)
+        self.changed()
+        if self.listener is not None:
+            self.listener.session_process_started(self)
+        self._watchdog = LoopingCall(self._sample_resources)
+        self._watchdog.start(RESOURCE_SAMPLE_INTERVAL, now=False)
+
     def start(self):
         logging.debug("PluginSession %s %s start()" % (self.id, self.plugin_name))
         if not os.path.exists(self.work_directory):
             os.mkdir(self.work_directory)
+            open(os.path.join(self.work_directory, WORK_DIRECTORY_MARKER), "w").close()
         protocol = PluginRunnerProcessProtocol(self)
         arguments = ["minion-plugin-runner"]
         if self.debug:
@@ -102,14 +408,25 @@ class PluginSession:
         arguments += ["--work-root", self.work_directory_root]
         arguments += ["--session-id", self.id]
         arguments += ["--mode", "plugin-service"]
-        arguments += ["--plugin-service-api", "http://127.0.0.1:8181"]
+        arguments += ["--plugin-service-api", self.plugin_service_api]
+        arguments += ["--trace-id", self.timeline.trace_id]
+        arguments += ["--codec", codec.preferred()]
+        for name,value in self.rlimits.items():
+            arguments += ["--rlimit", "%s=%d" % (name, value)]
         environment = { 'PATH': os.getenv('PATH') }
+        self.runner_started = time.time()
+        self.timeline.event('spawning-runner')
+        self.changed()
         self.process = reactor.spawnProcess(protocol, "minion-plugin-runner", arguments, environment, path=self.work_directory)
-        self.state = 'STARTED'
+        if self.listener is not None:
+            self.listener.session_process_started(self)
+        self._watchdog = LoopingCall(self._sample_resources)
+        self._watchdog.start(RESOURCE_SAMPLE_INTERVAL, now=False)
+        self.set_state('STARTED')
 
     #
     # This is called by the user of the plugin-service by setting the state of
-    # a session to STOPPED. If we are only CREATED then we move immediately to
+    # a session to STOPPED. If we are only CREATED or QUEUED then we move immediately to
     # STOPPED. If we are STARTED then we send a USR1 signal to the plugin-runner
     # and let it stop.
     #
@@ -118,22 +435,42 @@ class PluginSession:
     #
 
     def stop(self):
-        if self.state == 'CREATED':
-            self.state = 'STOPPED'
+        if self.state in ('CREATED', 'QUEUED'):
+            self.set_state('STOPPED')
         elif self.state == 'STARTED':
             self.process.signalProcess(30) # USR1
-            self.state = 'STOPPING'
+            self.set_state('STOPPING')
 
     #
     # This is called by the plugin-runner through the /session/ID/report/results api. It
-    # simply collects the reported issues.
+    # simply collects the reported issues. The size is the size of the
+    # encoded issues, it is used to enforce the issue_bytes limit. Returns
+    # how many of the issues were accepted, the rest went over the limits.
     #
     # TODO I just realized that the ID generation should actually
     #      happen in the plugin-runner and not here. Otherwise it
     #      is not possible to submit updated issues later on.
     #
 
-    def add_results(self, results):
+    def add_results(self, results, size=None):
+        if size is None:
+            size = len(json.dumps(results))
+        issue_size = float(size) / len(results) if results else 0.0
+        accepted, reason = len(results), None
+        if self.limits.get('issues') and len(self.results) + accepted > self.limits['issues']:
+            accepted = max(0, self.limits['issues'] - len(self.results))
+            reason = "issue limit of %d issues exceeded" % self.limits['issues']
+        if self.limits.get('issue_bytes') and self.issue_bytes + issue_size * accepted > self.limits['issue_bytes']:
+            accepted = max(0, int((self.limits['issue_bytes'] - self.issue_bytes) / issue_size))
+            reason = "issue limit of %d bytes exceeded" % self.limits['issue_bytes']
+        if self.truncated is not None:
+            accepted = 0
+        dropped = len(results) - accepted
+        results = results[:accepted]
+        if dropped:
+            marker = self._truncate(dropped, reason)
+            if marker is not None:
+                results.append(marker)
         # Add a timestamp to the results. This is not super accurate but that is ok, it is
         # just to get them incrementally later from the task engine api.
         for result in results:
@@ -142,6 +479,36 @@ class PluginSession:
         for result in results:
             result['Id'] = str(uuid.uuid4())
         self.results += results
+        self.issue_bytes += int(issue_size * accepted)
+        if self.listener is not None and results:
+            self.listener.session_issues_added(self, results)
+        self.changed()
+        return accepted
+
+    #
+    # When a session goes over its issue limits we keep what we have and
+    # drop the rest. The first time this happens we add an issue that says
+    # so, after that we only count what was dropped.
+    #
+
+    def _truncate(self, dropped, reason):
+        if self.truncated is not None:
+            self.truncated['issues'] += dropped
+            return None
+        logging.error("Truncating issues of plugin session %s %s: %s" % (self.id, self.plugin_name, reason))
+        self.truncated = { 'issues': dropped, 'reason': reason }
+        return { 'Summary': "Issues were truncated",
+                 'Severity': "Info",
+                 'Description': "The plugin reported more issues than allowed (%s). Issues reported after this one were dropped." % reason,
+                 'Truncated': True }
+
+    def set_progress(self, progress):
+        self.progress = progress
+        self.changed()
+
+    def configuration_fetched(self):
+        self.timeline.event('configuration-fetched')
+        self.changed()
 
     #
     # This is called by the plugin-runner through the /session/ID/finish api. It
@@ -153,8 +520,24 @@ class PluginSession:
 
     def finish(self, result):
         state = result['state']
+        self.timeline.add_events(result.get('timeline'), source='runner')
+        self.changed()
+        resources = result.get('resources')
+        if resources:
+            self.resources['cpu_time'] = max(self.resources['cpu_time'], resources.get('cpu_time', 0.0))
+            self.resources['max_rss'] = max(self.resources['max_rss'], resources.get('max_rss', 0))
         if state in ('FINISHED', 'STOPPED', 'FAILED'):
-            self.state = state            
+            self.set_state(state)
+
+    #
+    # This is called by the plugin-runner through the /session/ID/report/start
+    # api when the plugin has been configured and started. The runner sends
+    # the timeline events it recorded so far.
+    #
+
+    def report_start(self, result):
+        self.timeline.add_events(result.get('timeline'), source='runner')
+        self.changed()
 
     #
     # Add artifacts to this session. The format is an array that
@@ -172,6 +555,7 @@ class PluginSession:
     def add_artifacts(self, artifacts):
         for artifact in artifacts:
             self.artifacts.setdefault(artifact["name"], set()).update(artifact["paths"])
+        self.changed()
 
     def flatten_artifacts(self):
         artifacts = {}
@@ -179,20 +563,70 @@ class PluginSession:
             artifacts[name] = sorted(list(paths))
         return artifacts
 
+    def plugin_class_name(self):
+        return self.plugin_class.__module__ + "." + self.plugin_class.__name__
+
     def artifacts_path(self):
         return os.path.join(self.work_directory_root, self.id + ".zip")
 
+    #
+    # The durable state of this session, for the journal. This is
+    # everything but the issues, which are journaled as they come in.
+    #
+
+    def snapshot(self):
+        return { 'id': self.id,
+                 'plugin_name': self.plugin_name,
+                 'configuration': self.configuration,
+                 'debug': self.debug,
+                 'priority': self.priority,
+                 'state': self.state,
+                 'started': self.started,
+                 'duration': self.duration,
+                 'finished': self.finished,
+                 'runner_started': self.runner_started,
+                 'progress': self.progress,
+                 'artifacts': self.flatten_artifacts(),
+                 'resources': dict(self.resources),
+                 'failure': self.failure,
+                 'issue_bytes': self.issue_bytes,
+                 'truncated': self.truncated,
+                 'pid': self.process.pid if self.process is not None else None,
+                 'timeline': self.timeline.summary() }
+
+    def restore(self, snapshot):
+        self.id = snapshot['id']
+        self.state = snapshot['state']
+        self.started = snapshot['started']
+        self.duration = snapshot['duration']
+        self.finished = snapshot['finished']
+        self.runner_started = snapshot['runner_started']
+        self.progress = snapshot['progress']
+        self.results = snapshot.get('issues', [])
+        self.artifacts = dict((name, set(paths)) for name,paths in snapshot['artifacts'].items())
+        self.resources = snapshot['resources']
+        self.failure = snapshot['failure']
+        self.issue_bytes = snapshot.get('issue_bytes', 0)
+        self.truncated = snapshot.get('truncated')
+        self.work_directory = os.path.join(self.work_directory_root, self.id)
+        self.timeline.events = snapshot['timeline']['events']
+
     def summary(self):
         return { 'id': self.id,
                  'state': self.state,
+                 'priority': self.priority,
                  'configuration': self.configuration,
                  'plugin': { 'name': self.plugin_class.name(),
                              'version': self.plugin_class.version(),
-                             'class': self.plugin_class.__module__ + "." + self.plugin_class.__name__ },
+                             'class': self.plugin_class_name() },
                  'progress': self.progress,
                  'started': self.started,
                  'issues': [],
                  'artifacts' : self.flatten_artifacts(),
+                 'resources': dict(self.resources),
+                 'failure': self.failure,
+                 'truncated': self.truncated,
+                 'timeline': self.timeline.summary(),
                  'duration': self.duration if self.duration else int(time.time()) - self.started }
 
 
@@ -200,28 +634,411 @@ class PluginSession:
 def _plugin_descriptor(plugin):
     return {'class': plugin.__module__ + "." + plugin.__name__,
             'name': plugin.name(),
-            'version': plugin.version()}
+            'version': plugin.version(),
+            'batch_size': plugin.batch_size()}
+
+# Sessions in these states have (or are about to have) a plugin-runner process
+RUNNING_STATES = ('STARTED', 'STOPPING')
+
+
+def _host_status():
+    status = {'cpus': multiprocessing.cpu_count(), 'load': None, 'memory': None}
+    try:
+        status['load'] = list(os.getloadavg())
+    except OSError:
+        pass
+    # /proc/meminfo is Linux only. We simply skip memory info elsewhere.
+    try:
+        meminfo = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                meminfo[name] = int(value.split()[0]) * 1024
+        status['memory'] = { 'total': meminfo.get('MemTotal'),
+                             'available': meminfo.get('MemAvailable', meminfo.get('MemFree')) }
+    except (IOError, ValueError):
+        pass
+    return status
+
+def _path_size(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        return _directory_size(path)
+    return os.lstat(path).st_size
+
+def _remove_paths(paths):
+    """Remove files and directory trees. Returns (count, bytes) of what was removed."""
+    count, size = 0, 0
+    for path in paths:
+        try:
+            if not os.path.lexists(path):
+                continue
+            path_size = _path_size(path)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            count += 1
+            size += path_size
+        except (IOError, OSError) as e:
+            logging.error("Reaper failed to remove %s: %s" % (path, str(e)))
+    return count, size
+
+def _created_by_service(path):
+    """True if path is a work directory or artifacts zip that we created"""
+    try:
+        if os.path.islink(path):
+            return False
+        if os.path.isdir(path):
+            return os.path.isfile(os.path.join(path, WORK_DIRECTORY_MARKER))
+        with zipfile.ZipFile(path) as zip:
+            return zip.comment == ARTIFACTS_ZIP_COMMENT
+    except (IOError, OSError, zipfile.BadZipfile):
+        return False
+
+def _find_orphans(work_directory_root, session_ids, max_age):
+    """Find session work directories and zip files that we created but
+    that do not belong to a known session"""
+    orphans = []
+    now = time.time()
+    for name in os.listdir(work_directory_root):
+        if not SESSION_ID_PATTERN.match(name):
+            continue
+        if name.split('.')[0] in session_ids:
+            continue
+        path = os.path.join(work_directory_root, name)
+        try:
+            if now - os.lstat(path).st_mtime > max_age and _created_by_service(path):
+                orphans.append(path)
+        except OSError:
+            pass
+    return orphans
+
+class PluginSessionReaper:
+
+    """
+    Periodically removes sessions that have been done for longer than
+    session_ttl seconds (or that were created but never started) and
+    their work directories and artifact zips. Also removes work
+    directories and zips in the work directory root that do not belong
+    to any session, for example those of deleted sessions or left over
+    from a previous run, once they are older than orphan_ttl seconds.
+    Orphans are only removed if they carry the marks that the plugin
+    service puts on what it creates, never other files in the root.
+
+    All file system work happens in a thread, in batches of batch_size
+    paths, so that we do not block the reactor.
+    """
+
+    def __init__(self, plugin_service, interval=300, session_ttl=86400, orphan_ttl=86400, batch_size=100):
+        self.plugin_service = plugin_service
+        self.interval = interval
+        self.session_ttl = session_ttl
+        self.orphan_ttl = orphan_ttl
+        self.batch_size = batch_size
+        self.running = False
+        self.stats = { 'runs': 0, 'sessions': 0, 'paths': 0, 'bytes': 0, 'last_run': None }
+        self._looper = None
+
+    def start(self):
+        self._looper = LoopingCall(self.reap)
+        reactor.callWhenRunning(self._looper.start, self.interval, now=False)
+
+    def _expired_sessions(self):
+        now = time.time()
+        expired = []
+        for session in self.plugin_service.sessions.values():
+            if session.state in TERMINAL_STATES and now - session.finished > self.session_ttl:
+                expired.append(session)
+            elif session.state == 'CREATED' and now - session.started > self.session_ttl:
+                expired.append(session)
+        return expired
+
+    @inlineCallbacks
+    def reap(self):
+        if self.running:
+            return
+        self.running = True
+        try:
+            paths = []
+            expired = self._expired_sessions()
+            for session in expired:
+                self.plugin_service.delete_session(session)
+                paths += [session.work_directory, session.artifacts_path()]
+            # Take a snapshot of the session ids here, in the reactor
+            # thread, so that the thread does not look at self.sessions.
+            session_ids = set(self.plugin_service.sessions.keys())
+            orphans = yield deferToThread(_find_orphans, self.plugin_service.work_directory_root,
+                                          session_ids, self.orphan_ttl)
+            paths += [path for path in orphans if path not in paths]
+            removed_count, removed_bytes = 0, 0
+            for n in range(0, len(paths), self.batch_size):
+                count, size = yield deferToThread(_remove_paths, paths[n:n+self.batch_size])
+                removed_count += count
+                removed_bytes += size
+            self.stats['runs'] += 1
+            self.stats['sessions'] += len(expired)
+            self.stats['paths'] += removed_count
+            self.stats['bytes'] += removed_bytes
+            self.stats['last_run'] = int(time.time())
+            if expired or removed_count:
+                logging.info("Reaper removed %d sessions and %d paths, reclaimed %d bytes" % (len(expired), removed_count, removed_bytes))
+        except Exception as e:
+            logging.exception("Reaper failed: %s" % str(e))
+        finally:
+            self.running = False
+
+class PluginSessionDispatcher:
+
+    """
+    Starts sessions when there is room for another plugin-runner. At most
+    max_running runners run at a time. Sessions that are started beyond
+    that are QUEUED and started in weighted fair order of their priority
+    as runners end. See priority.FairQueue.
+    """
+
+    def __init__(self, plugin_service, max_running=None, weights=None):
+        self.plugin_service = plugin_service
+        self.max_running = max_running or multiprocessing.cpu_count() * 4
+        self.queue = FairQueue(weights)
+
+    def submit(self, session):
+        if not len(self.queue) and self.plugin_service.processes < self.max_running:
+            self._start(session)
+        else:
+            self.enqueue(session)
+            self.dispatch()
+
+    def enqueue(self, session):
+        session.set_state('QUEUED')
+        self.queue.append(session, session.priority)
+
+    def cancel(self, session):
+        # Stopped or deleted while it was waiting
+        self.queue.remove(session, session.priority)
+
+    def dispatch(self):
+        while len(self.queue) and self.plugin_service.processes < self.max_running:
+            self._start(self.queue.popleft())
+
+    def _start(self, session):
+        try:
+            session.start()
+        except Exception as e:
+            logging.exception("Failed to start session %s: %s" % (session.id, str(e)))
+            session.failure = "failed to start the plugin-runner: %s" % str(e)
+            session.set_state('FAILED')
+
+    def summary(self):
+        return { 'max_running': self.max_running, 'queued': self.queue.counts() }
+
+class ReactorLag:
+
+    """
+    Measures how late the reactor runs a timer that should fire every
+    interval seconds. A reactor that is busy handling requests runs it
+    late. The lag goes up immediately and comes down gradually, so that
+    a single quiet tick does not hide an overloaded service.
+    """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.lag = 0.0
+        self._expected = None
+
+    def start(self):
+        reactor.callWhenRunning(self._tick)
+
+    def _tick(self):
+        now = time.time()
+        if self._expected is not None:
+            self.lag = max(now - self._expected, self.lag * 0.8)
+        self._expected = now + self.interval
+        reactor.callLater(self.interval, self._tick)
 
 class PluginService:
     
-    def __init__(self, work_directory_root):
+    def __init__(self, work_directory_root, limits = None, rlimits = None, api = PLUGIN_SERVICE_API):
         self.work_directory_root = work_directory_root
+        self.api = api
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.rlimits = dict((name,value) for name,value in (rlimits or {}).items() if name in RLIMITS)
         self.sessions = {}
         self.plugins = {}
+        # Counters that are kept up to date on every session state
+        # change. These are cheap to report in status().
+        self.state_counts = {}
+        self.running_counts = {}
+        self.processes = 0
+        self.reaper = None
+        self.journal = None
+        self.backpressure = None
+        self.reactor_lag = None
+        self.dispatcher = None
 
     def get_session(self, session_id):
         return self.sessions.get(session_id)
 
-    def create_session(self, plugin_name, configuration, debug):
+    def create_session(self, plugin_name, configuration, debug, trace_id=None, priority=DEFAULT_PRIORITY):
         plugin_class = self.plugins.get(plugin_name)
         if plugin_class:
-            session = PluginSession(plugin_name, plugin_class, configuration, self.work_directory_root, debug)
+            session = PluginSession(plugin_name, plugin_class, configuration, self.work_directory_root, debug, listener=self,
+                                    limits=self.limits, rlimits=self.rlimits, plugin_service_api=self.api,
+                                    trace_id=trace_id, priority=priority)
             self.sessions[session.id] = session
+            self._count_state(session, session.state, 1)
+            if self.journal is not None:
+                self.journal.session_created(session)
             return session
 
+    def start_session(self, session):
+        if self.dispatcher is not None:
+            self.dispatcher.submit(session)
+        else:
+            session.start()
+
     def delete_session(self, session):
         if session.id in self.sessions:
             del self.sessions[session.id]
+            self._count_state(session, session.state, -1)
+            if self.dispatcher is not None and session.state == 'QUEUED':
+                self.dispatcher.cancel(session)
+            if self.journal is not None:
+                self.journal.session_deleted(session)
+
+    def _count_state(self, session, state, delta):
+        self.state_counts[state] = self.state_counts.get(state, 0) + delta
+        if state in RUNNING_STATES:
+            plugin_class_name = session.plugin_class_name()
+            self.running_counts[plugin_class_name] = self.running_counts.get(plugin_class_name, 0) + delta
+            if self.running_counts[plugin_class_name] == 0:
+                del self.running_counts[plugin_class_name]
+
+    # Called by PluginSession
+
+    def session_state_changed(self, session, previous_state, state):
+        if session.id in self.sessions:
+            self._count_state(session, previous_state, -1)
+            self._count_state(session, state, 1)
+        if self.dispatcher is not None and previous_state == 'QUEUED' and state != 'STARTED':
+            self.dispatcher.cancel(session)
+
+    def session_changed(self, session):
+        if self.journal is not None and session.id in self.sessions:
+            self.journal.session_changed(session)
+
+    def session_issues_added(self, session, issues):
+        if self.journal is not None and session.id in self.sessions:
+            self.journal.session_issues_added(session, issues)
+
+    def session_process_started(self, session):
+        self.processes += 1
+
+    def session_process_ended(self, session):
+        self.processes -= 1
+        if self.dispatcher is not None:
+            self.dispatcher.dispatch()
+
+    def status(self):
+        return { 'sessions': dict((state,count) for state,count in self.state_counts.items() if count),
+                 'running': sum(self.running_counts.values()),
+                 'queued': self.state_counts.get('CREATED', 0) + self.state_counts.get('QUEUED', 0),
+                 'processes': self.processes,
+                 'plugins': dict(self.running_counts),
+                 'reaper': self.reaper.stats if self.reaper else None,
+                 'journal': self.journal.stats if self.journal else None,
+                 'lag': self.reactor_lag.lag if self.reactor_lag else None,
+                 'dispatcher': self.dispatcher.summary() if self.dispatcher else None,
+                 'host': _host_status() }
+
+    def start_reaper(self, settings):
+        self.reaper = PluginSessionReaper(self, **settings)
+        self.reaper.start()
+
+    #
+    # Limit the number of plugin-runners. Sessions that are started when
+    # we are at max_running are queued and started by priority, see
+    # PluginSessionDispatcher.
+    #
+
+    def start_dispatcher(self, settings):
+        self.dispatcher = PluginSessionDispatcher(self, **settings)
+
+    #
+    # Backpressure. When the reactor falls behind by more than max_lag
+    # seconds then plugin-runners are told to slow down and retry their
+    # reports after retry_after seconds. Runners hold on to their reports
+    # in the meantime. This returns the number of seconds to wait or None.
+    #
+
+    def start_backpressure(self, settings):
+        self.backpressure = { 'max_lag': settings.get('max_lag', 0.5),
+                              'retry_after': settings.get('retry_after', 1) }
+        self.reactor_lag = ReactorLag(settings.get('interval', 0.1))
+        self.reactor_lag.start()
+
+    def slow_down(self):
+        if self.backpressure is not None and self.reactor_lag.lag > self.backpressure['max_lag']:
+            return self.backpressure['retry_after']
+
+    #
+    # Recover the sessions of a previous run from the journal and start
+    # journaling. Plugins have to be registered before this is called.
+    # Running sessions whose plugin-runner is still alive are adopted, if
+    # the runner is gone then the session has FAILED. Queued sessions are
+    # queued again. Runners that do not belong to a running session are
+    # killed.
+    #
+
+    def _restore_session(self, snapshot):
+        plugin_class = self.plugins.get(snapshot['plugin_name'])
+        if plugin_class is None:
+            logging.error("Cannot recover session %s: unknown plugin %s" % (snapshot['id'], snapshot['plugin_name']))
+            return None
+        session = PluginSession(snapshot['plugin_name'], plugin_class, snapshot['configuration'], self.work_directory_root,
+                                snapshot['debug'], listener=self, limits=self.limits, rlimits=self.rlimits,
+                                plugin_service_api=self.api, trace_id=snapshot['timeline']['trace_id'],
+                                priority=snapshot.get('priority', DEFAULT_PRIORITY))
+        session.restore(snapshot)
+        self.sessions[session.id] = session
+        self._count_state(session, session.state, 1)
+        return session
+
+    def start_journal(self, settings):
+        settings = dict(settings)
+        directory = settings.pop('directory', os.path.join(self.work_directory_root, "journal"))
+        journal = SessionJournal(self, os.path.expanduser(directory), **settings)
+        runners = _find_runners(self.work_directory_root)
+        for snapshot in journal.recover():
+            session = self._restore_session(snapshot)
+            if session is not None and session.state == 'QUEUED':
+                # Back in line, or back to CREATED to be started again if we no longer queue
+                if self.dispatcher is not None:
+                    self.dispatcher.queue.append(session, session.priority)
+                else:
+                    session.set_state('CREATED')
+                continue
+            if session is None or session.state not in RUNNING_STATES:
+                continue
+            pid = runners.pop(session.id, None)
+            if pid is not None:
+                session.adopt(pid)
+                journal.stats['adopted'] += 1
+            else:
+                session.failure = "plugin-runner exited while the plugin service was down"
+                session.set_state('FAILED')
+                journal.stats['failed'] += 1
+        for session_id, pid in runners.items():
+            logging.info("Killing plugin-runner %d of unknown session %s" % (pid, session_id))
+            for tree_pid in reversed(_process_tree(pid)):
+                try:
+                    os.kill(tree_pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            journal.stats['reaped'] += 1
+        self.journal = journal
+        self.journal.open()
+        if self.dispatcher is not None:
+            reactor.callWhenRunning(self.dispatcher.dispatch)
 
     def register_plugin(self, plugin_class):
         self.plugins[str(plugin_class)] = plugin_class
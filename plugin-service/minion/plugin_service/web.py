@@ -2,9 +2,11 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import importlib
 import json
 import logging
 import os
+import sys
 import time
 import uuid
 
@@ -12,18 +14,121 @@ import cyclone.web
 from twisted.internet.defer import inlineCallbacks
 from twisted.python import log
 
-from minion.plugin_service.service import PluginService
+from minion.common import codec
+from minion.common.compression import Compression
+from minion.common import metrics
+from minion.common import priority
+from minion.common import streaming
+from minion.common import tracing
+from minion.common.profiling import ReactorProfiler, DEFAULT_PROFILE_SECONDS
+from minion.plugin_service.service import PluginService, PLUGIN_SERVICE_API
 
 
 PLUGIN_SERVICE_SYSTEM_SETTINGS_PATH = "/etc/minion/plugin-service.conf"
 PLUGIN_SERVICE_USER_SETTINGS_PATH = "~/.minion/plugin-service.conf"
 
 
+REQUESTS = metrics.registry.counter("minion_plugin_service_requests_total",
+                                    "HTTP requests handled", ("handler", "method", "status"))
+REQUEST_DURATION = metrics.registry.histogram("minion_plugin_service_request_duration_seconds",
+                                              "HTTP request latency", ("handler",))
+ISSUES_RECEIVED = metrics.registry.counter("minion_plugin_service_issues_received_total",
+                                           "Issues reported by plugin runners")
+SESSION_LAUNCH_DURATION = metrics.registry.histogram("minion_plugin_service_session_launch_duration_seconds",
+                                                    "Time between starting a session and its runner asking for its configuration")
+ISSUES_DROPPED = metrics.registry.counter("minion_plugin_service_issues_dropped_total",
+                                          "Issues dropped because sessions went over their issue limits")
+REPORTS_REJECTED = metrics.registry.counter("minion_plugin_service_reports_rejected_total",
+                                            "Reports that plugin runners were asked to retry later", ("report",))
+ARTIFACT_BYTES_SERVED = metrics.registry.counter("minion_plugin_service_artifact_bytes_served_total",
+                                                 "Bytes of artifact zips served")
+
+
+# Clients can ask for a more compact encoding than JSON with the Accept
+# header and can send their bodies in it. See codec.py. Large responses
+# are compressed if the client accepts that. This returns a Deferred
+# that handlers have to return.
+
+def _finish(handler, data):
+    content_type = codec.negotiate(handler.request.headers.get("Accept"))
+    body = codec.encode(content_type, data)
+    if handler.application.compression is None:
+        handler.set_header("Content-Type", content_type)
+        handler.finish(body)
+        return
+    return handler.application.compression.finish(handler, body, content_type)
+
+def _body(handler):
+    return codec.decode(handler.request.headers.get("Content-Type"), handler.request.body)
+
+# Answer with a 304 if the client already has this version of the
+# session. This saves building and encoding the summary.
+
+def _not_modified(handler, session):
+    etag = session.etag()
+    handler.set_header("Etag", etag)
+    if etag in [e.strip() for e in handler.request.headers.get("If-None-Match", "").split(",")]:
+        handler.set_status(304)
+        handler.finish()
+        return True
+    return False
+
+# Ask the plugin-runner to try again later if we are falling behind. This
+# is checked before the report is decoded, so rejecting is cheap.
+
+def _slow_down(handler, report):
+    retry_after = handler.application.plugin_service.slow_down()
+    if retry_after is None:
+        return False
+    REPORTS_REJECTED.inc(labels=(report,))
+    handler.set_status(503)
+    handler.set_header("Retry-After", str(retry_after))
+    handler.finish({'success': False, 'error': 'slow-down'})
+    return True
+
+# Formatting full report payloads for the debug log is expensive on the
+# reporting path. Unless log_payloads is enabled we only log what was
+# received. The payload is only formatted if debug logging is enabled.
+
+def _log_report(handler, kind, session, payload):
+    if handler.settings.log_payloads:
+        logging.debug("Received %s from plugin session %s: %s", kind, session.id, payload)
+    else:
+        logging.debug("Received %s from plugin session %s", kind, session.id)
+
+
+class MetricsHandler(cyclone.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.finish(metrics.registry.exposition())
+
+class ProfileHandler(cyclone.web.RequestHandler):
+    def post(self):
+        profiler = self.application.profiler
+        if profiler is None:
+            self.finish({'success': False, 'error': 'profiling-disabled'})
+            return
+        try:
+            seconds = int(self.get_argument('seconds', DEFAULT_PROFILE_SECONDS))
+        except ValueError:
+            self.finish({'success': False, 'error': 'invalid-seconds'})
+            return
+        path = profiler.start(seconds)
+        if path is None:
+            self.finish({'success': False, 'error': 'already-profiling'})
+            return
+        self.finish({'success': True, 'path': path})
+
 class PluginsHandler(cyclone.web.RequestHandler):
     def get(self):
         plugin_service = self.application.plugin_service
         self.finish({'success': True, 'plugins': plugin_service.plugin_descriptors()})
 
+class StatusHandler(cyclone.web.RequestHandler):
+    def get(self):
+        plugin_service = self.application.plugin_service
+        self.finish({'success': True, 'status': plugin_service.status()})
+
 class PluginHandler(cyclone.web.RequestHandler):
     def get(self, plugin_name):
         plugin_service = self.application.plugin_service
@@ -40,10 +145,20 @@ class CreatePluginSessionHandler(cyclone.web.RequestHandler):
         if not plugin:
             self.finish({'success': False, 'error': 'no-such-plugin'})
             return
-        configuration = json.loads(self.request.body)
-        session = plugin_service.create_session(plugin_name, configuration, self.settings.debug)
+        configuration = _body(self)
+        # The task engine passes the trace id of the scan, otherwise we start a new trace
+        trace_id = self.request.headers.get(tracing.TRACE_ID_HEADER)
+        if not tracing.valid_trace_id(trace_id):
+            trace_id = None
+        # And the priority of the scan, which decides how soon the session starts when we are busy
+        session_priority = self.request.headers.get(priority.PRIORITY_HEADER, priority.DEFAULT_PRIORITY)
+        if not priority.valid_priority(session_priority):
+            self.finish({'success': False, 'error': 'invalid-priority'})
+            return
+        session = plugin_service.create_session(plugin_name, configuration, self.settings.debug, trace_id,
+                                                session_priority)
         if session:
-            self.finish({'success': True, 'session': session.summary()})
+            return _finish(self, {'success': True, 'session': session.summary()})
 
 class PutPluginSessionStateHandler(cyclone.web.RequestHandler):
     def put(self, session_id):
@@ -61,9 +176,9 @@ class PutPluginSessionStateHandler(cyclone.web.RequestHandler):
             if session.state != 'CREATED':
                 self.finish({'success': False, 'error': 'unknown-state-transition'})
                 return
-            session.start()
+            plugin_service.start_session(session)
         elif state == 'STOP':
-            if session.state not in ('STARTED', 'CREATED'):
+            if session.state not in ('STARTED', 'CREATED', 'QUEUED'):
                 self.finish({'success': False, 'error': 'unknown-state-transition'})
                 return
             session.stop()
@@ -76,14 +191,16 @@ class PluginSessionHandler(cyclone.web.RequestHandler):
         if not session:
             self.finish({'success': False, 'error': 'no-such-session'})
             return
-        self.finish({'success': True, 'session': session.summary()})
+        if _not_modified(self, session):
+            return
+        return _finish(self, {'success': True, 'session': session.summary()})
     def delete(self, session_id):
         plugin_service = self.application.plugin_service
         session = plugin_service.get_session(session_id)
         if not session:
             self.finish({'success': False, 'error': 'no-such-session'})
             return
-        if session.state not in ('CREATED', 'STOPPED', 'FINISHED', 'FAILED'):
+        if session.state not in ('CREATED', 'QUEUED', 'STOPPED', 'FINISHED', 'FAILED'):
             self.finish({'success': False, 'error': 'invalid-state'})
             return
         plugin_service.delete_session(session)
@@ -96,7 +213,9 @@ class GetPluginSessionResultsHandler(cyclone.web.RequestHandler):
         if not session:
             self.finish({'success': False, 'error': 'no-such-session'})
             return
-        self.finish({'success': True, 'session': session.summary(), 'issues': session.results})
+        if _not_modified(self, session):
+            return
+        return _finish(self, {'success': True, 'session': session.summary(), 'issues': session.results})
 
 class GetPluginSessionArtifactsHandler(cyclone.web.RequestHandler):
     def get(self, session_id):
@@ -105,16 +224,37 @@ class GetPluginSessionArtifactsHandler(cyclone.web.RequestHandler):
         if not session:
             self.finish({'success': False, 'error': 'no-such-session'})
             return
-        # TODO This blocks the server. What is the right way to serve files?
         artifacts_path = session.artifacts_path()
         if not os.path.exists(artifacts_path):
             raise cyclone.web.HTTPError(404)
-        with open(artifacts_path) as f:
-            data = f.read()
-            self.set_header("Content-Type", "application/zip")
-            filename = session_id + ".zip"
-            self.set_header("Content-Disposition", "inline; filename=\"%s\"" % filename)
-            self.finish(data)
+        d = streaming.serve_file(self, artifacts_path, "application/zip", session_id + ".zip")
+        return d.addCallback(ARTIFACT_BYTES_SERVED.inc)
+
+#
+# A task engine on the same host can take the artifacts zip of a session
+# with a hard link instead of downloading it. This tells it where the zip
+# is. The device and inode let the task engine check that it sees the
+# same file as we do. Set artifact_handoff to false to not expose paths.
+#
+
+class GetPluginSessionArtifactsHandoffHandler(cyclone.web.RequestHandler):
+    def get(self, session_id):
+        if not self.settings.artifact_handoff:
+            self.finish({'success': False, 'error': 'handoff-disabled'})
+            return
+        plugin_service = self.application.plugin_service
+        session = plugin_service.get_session(session_id)
+        if not session:
+            self.finish({'success': False, 'error': 'no-such-session'})
+            return
+        artifacts_path = os.path.abspath(session.artifacts_path())
+        try:
+            stat = os.stat(artifacts_path)
+        except OSError:
+            self.finish({'success': False, 'error': 'no-such-artifacts'})
+            return
+        self.finish({'success': True, 'artifacts': { 'path': artifacts_path, 'size': stat.st_size,
+                                                     'device': stat.st_dev, 'inode': stat.st_ino }})
 
 #
 
@@ -126,8 +266,24 @@ class PluginRunnerGetConfigurationHandler(cyclone.web.RequestHandler):
         if not session:
             self.finish({'success': False, 'error': 'no-such-session'})
             return
+        if session.runner_started is not None:
+            SESSION_LAUNCH_DURATION.observe(time.time() - session.runner_started)
+        session.configuration_fetched()
         self.finish(session.configuration)
 
+class PluginRunnerReportStartHandler(cyclone.web.RequestHandler):
+
+    def post(self, session_id):
+        plugin_service = self.application.plugin_service
+        session = plugin_service.get_session(session_id)
+        if not session:
+            self.finish({'success': False, 'error': 'no-such-session'})
+            return
+        result = _body(self)
+        _log_report(self, "start", session, result)
+        session.report_start(result)
+        self.finish({'success':True})
+
 class PluginRunnerReportProgressHandler(cyclone.web.RequestHandler):
 
     def post(self, session_id):
@@ -136,9 +292,11 @@ class PluginRunnerReportProgressHandler(cyclone.web.RequestHandler):
         if not session:
             self.finish({'success': False, 'error': 'no-such-session'})
             return
-        progress = json.loads(self.request.body)
-        logging.debug("Received progress from plugin session %s: " + str(progress))
-        session.progress = progress
+        if _slow_down(self, 'progress'):
+            return
+        progress = _body(self)
+        _log_report(self, "progress", session, progress)
+        session.set_progress(progress)
         self.finish({'success':True})
 
 class PluginRunnerReportIssuesHandler(cyclone.web.RequestHandler):
@@ -149,10 +307,15 @@ class PluginRunnerReportIssuesHandler(cyclone.web.RequestHandler):
         if not session:
             self.finish({'success': False, 'error': 'no-such-session'})
             return
-        results = json.loads(self.request.body)
-        logging.debug("Received results from plugin session %s: %s" % (session,str(results)))
-        session.add_results(results)
-        self.finish({'success':True})
+        if _slow_down(self, 'issues'):
+            return
+        results = _body(self)
+        _log_report(self, "%d issues" % len(results), session, results)
+        accepted = session.add_results(results, len(self.request.body))
+        ISSUES_RECEIVED.inc(accepted)
+        ISSUES_DROPPED.inc(len(results) - accepted)
+        # Once a session is truncated the runner can stop sending issues
+        self.finish({'success':True, 'accepted': accepted, 'truncated': session.truncated is not None})
 
 class PluginRunnerReportArtifactsHandler(cyclone.web.RequestHandler):
 
@@ -162,8 +325,8 @@ class PluginRunnerReportArtifactsHandler(cyclone.web.RequestHandler):
         if not session:
             self.finish({'success': False, 'error': 'no-such-session'})
             return
-        artifacts = json.loads(self.request.body)
-        logging.debug("Received artifacts from plugin session %s: %s" % (session,str(artifacts)))
+        artifacts = _body(self)
+        _log_report(self, "artifacts", session, artifacts)
         session.add_artifacts(artifacts)
         self.finish({'success':True})
 
@@ -177,7 +340,7 @@ class PluginRunnerReportErrorsHandler(cyclone.web.RequestHandler):
             self.finish({'success': False, 'error': 'no-such-session'})
             return
         body = self.request.body
-        logging.debug("Received errors from plugin session %s: %s" % (session,body))
+        _log_report(self, "errors", session, body)
         self.finish({'success':True})
 
 class PluginRunnerReportFinishHandler(cyclone.web.RequestHandler):
@@ -188,15 +351,15 @@ class PluginRunnerReportFinishHandler(cyclone.web.RequestHandler):
         if not session:
             self.finish({'success': False, 'error': 'no-such-session'})
             return
-        result = json.loads(self.request.body)
+        result = _body(self)
         session.finish(result)
-        logging.debug("Received finish from plugin session %s: %s" % (session,str(result)))
+        _log_report(self, "finish", session, result)
         self.finish({'success':True})
         
 
 class PluginServiceApplication(cyclone.web.Application):
 
-    def __init__(self):
+    def __init__(self, plugin_service_settings=None):
 
         # I don't think this should be in here? Where does it go?
         
@@ -207,23 +370,39 @@ class PluginServiceApplication(cyclone.web.Application):
 
         # Configure our settings. We have basic default settings that just work for development
         # and then override those with what is defined in either ~/.minion/ or /etc/minion/
-
-        plugin_service_settings = {"work_directory_root": "/tmp"}
-
-        for settings_path in (PLUGIN_SERVICE_USER_SETTINGS_PATH, PLUGIN_SERVICE_SYSTEM_SETTINGS_PATH):
-            settings_path = os.path.expanduser(settings_path)
-            if os.path.exists(settings_path):
-                with open(settings_path) as file:
-                    try:
-                        plugin_service_settings = json.load(file)
-                        break
-                    except Exception as e:
-                        logging.error("Failed to parse configuration file %s: %s" % (settings_path, str(e)))
-                        sys.exit(1)
+        # Settings can also be passed in directly, which is what the benchmarks do.
+
+        if plugin_service_settings is None:
+            plugin_service_settings = {"work_directory_root": "/tmp"}
+
+            for settings_path in (PLUGIN_SERVICE_USER_SETTINGS_PATH, PLUGIN_SERVICE_SYSTEM_SETTINGS_PATH):
+                settings_path = os.path.expanduser(settings_path)
+                if os.path.exists(settings_path):
+                    with open(settings_path) as file:
+                        try:
+                            plugin_service_settings = json.load(file)
+                            break
+                        except Exception as e:
+                            logging.error("Failed to parse configuration file %s: %s" % (settings_path, str(e)))
+                            sys.exit(1)
         
         # Create the Plugin Service and register plugins
 
-        self.plugin_service = PluginService(plugin_service_settings['work_directory_root'])
+        # Optional resource budgets. The limits are enforced by a watchdog
+        # in the plugin service, the rlimits are applied by the runner.
+
+        self.plugin_service = PluginService(plugin_service_settings['work_directory_root'],
+                                            limits=plugin_service_settings.get('limits'),
+                                            rlimits=plugin_service_settings.get('rlimits'),
+                                            api=plugin_service_settings.get('plugin_service_api', PLUGIN_SERVICE_API))
+
+        # Periodically remove old sessions and their files. The reaper
+        # settings can configure interval, session_ttl, orphan_ttl and
+        # batch_size. It can be disabled by setting reaper to null.
+
+        reaper_settings = plugin_service_settings.get('reaper', {})
+        if reaper_settings is not None:
+            self.plugin_service.start_reaper(reaper_settings)
 
         # These are the only (test) plugins that we include
 
@@ -259,13 +438,83 @@ class PluginServiceApplication(cyclone.web.Application):
         except ImportError as e:
             pass
 
+        # Additional plugins can be listed in the settings, for example the
+        # plugins in minion.plugins.test for testing and benchmarking.
+
+        for plugin_name in plugin_service_settings.get('plugins', []):
+            try:
+                module_name, class_name = plugin_name.rsplit('.', 1)
+                self.plugin_service.register_plugin(getattr(importlib.import_module(module_name), class_name))
+            except (ImportError, AttributeError, ValueError) as e:
+                logging.error("Failed to register plugin %s: %s" % (plugin_name, str(e)))
+
         for plugin in self.plugin_service.plugin_descriptors():
             logging.info("Registered plugin {} v{}".format(plugin['class'], plugin['version']))
 
+        # Tell plugin-runners to slow down when we cannot keep up with
+        # their reports. The backpressure settings can configure max_lag,
+        # retry_after and interval. It can be disabled by setting it to null.
+
+        backpressure_settings = plugin_service_settings.get('backpressure', {})
+        if backpressure_settings is not None:
+            self.plugin_service.start_backpressure(backpressure_settings)
+
+        # Limit the number of plugin-runners. Sessions beyond that are queued
+        # and started in weighted fair order of their priority. The dispatch
+        # settings can configure max_running (defaults to 4 per cpu) and the
+        # weights of the high, normal and low priorities. It can be disabled
+        # by setting dispatch to null, sessions then start right away.
+
+        dispatch_settings = plugin_service_settings.get('dispatch', {})
+        if dispatch_settings is not None:
+            self.plugin_service.start_dispatcher(dispatch_settings)
+
+        # Sessions are journaled so that they survive a restart of the plugin
+        # service. The journal settings can configure directory (defaults to
+        # journal/ in the work directory root), compact_records and fsync.
+        # It can be disabled by setting journal to null.
+
+        journal_settings = plugin_service_settings.get('journal', {})
+        if journal_settings is not None:
+            self.plugin_service.start_journal(journal_settings)
+
+        # These gauges are computed from the plugin service counters when /metrics is scraped
+
+        plugin_service = self.plugin_service
+        metrics.registry.gauge("minion_plugin_service_sessions", "Plugin sessions by state", ("state",),
+                               lambda: dict(((state,),count) for state,count in plugin_service.state_counts.items()))
+        metrics.registry.gauge("minion_plugin_service_running_sessions", "Running plugin sessions by plugin", ("plugin",),
+                               lambda: dict(((plugin,),count) for plugin,count in plugin_service.running_counts.items()))
+        metrics.registry.gauge("minion_plugin_service_processes", "Live plugin-runner processes",
+                               function=lambda: plugin_service.processes)
+        metrics.registry.gauge("minion_plugin_service_reactor_lag_seconds", "How far the reactor is behind",
+                               function=lambda: plugin_service.reactor_lag.lag if plugin_service.reactor_lag else 0.0)
+        metrics.registry.gauge("minion_plugin_service_queued_sessions", "Sessions waiting for a plugin-runner by priority", ("priority",),
+                               lambda: dict(((p,),count) for p,count in plugin_service.dispatcher.queue.counts().items())
+                                       if plugin_service.dispatcher else {})
+
+        # On-demand profiling. SIGUSR2 always profiles for the default
+        # time. The /debug/profile api has to be enabled explicitly.
+
+        profiling_settings = plugin_service_settings.get('profiling', {})
+        profiler = ReactorProfiler("plugin-service", profiling_settings.get('directory', '/tmp'))
+        profiler.install_signal_handler()
+        self.profiler = profiler if profiling_settings.get('enabled') else None
+
+        # Compress large session and results responses. The compression
+        # settings can configure minimum_size, thread_size (above which we
+        # compress in a thread) and level. Set it to null to disable.
+
+        compression_settings = plugin_service_settings.get('compression', {})
+        self.compression = Compression(**compression_settings) if compression_settings is not None else None
+
         # Setup our routes and initialize the Cyclone application
 
         handlers = [
             # Public API
+            (r"/metrics", MetricsHandler),
+            (r"/debug/profile", ProfileHandler),
+            (r"/status", StatusHandler),
             (r"/plugins", PluginsHandler),
             (r"/plugin/(.+)", PluginHandler),
             (r"/session/create/(.+)", CreatePluginSessionHandler),
@@ -273,8 +522,10 @@ class PluginServiceApplication(cyclone.web.Application):
             (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})", PluginSessionHandler),
             (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/results", GetPluginSessionResultsHandler),
             (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/artifacts", GetPluginSessionArtifactsHandler),
+            (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/artifacts/handoff", GetPluginSessionArtifactsHandoffHandler),
             # Plugin Runner API
             (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/configuration", PluginRunnerGetConfigurationHandler),
+            (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/report/start", PluginRunnerReportStartHandler),
             (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/report/progress", PluginRunnerReportProgressHandler),
             (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/report/issues", PluginRunnerReportIssuesHandler),
             (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/report/artifacts", PluginRunnerReportArtifactsHandler),
@@ -284,10 +535,18 @@ class PluginServiceApplication(cyclone.web.Application):
 
         settings = dict(
             debug=True,
+            log_payloads=plugin_service_settings.get('log_payloads', False),
+            artifact_handoff=plugin_service_settings.get('artifact_handoff', True),
             plugin_service=plugin_service_settings,
         )
 
         cyclone.web.Application.__init__(self, handlers, **settings)
 
+    def log_request(self, handler):
+        cyclone.web.Application.log_request(self, handler)
+        name = handler.__class__.__name__
+        REQUESTS.inc(labels=(name, handler.request.method, handler.get_status()))
+        REQUEST_DURATION.observe(handler.request.request_time(), (name,))
+
 
 Application = lambda: PluginServiceApplication()
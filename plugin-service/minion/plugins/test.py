@@ -2,9 +2,13 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
 import time
 
-from minion.plugin_api import BlockingPlugin
+from twisted.internet.defer import DeferredList
+from twisted.python.failure import Failure
+
+from minion.plugin_api import AsyncHTTPPlugin, BlockingPlugin
 
 class DelayedPlugin(BlockingPlugin):
     def do_run(self):
@@ -18,3 +22,146 @@ class DelayedPlugin(BlockingPlugin):
 class FailingPlugin(BlockingPlugin):
     def do_run(self):
         raise Exception("Failing plugins gonna fail")
+
+#
+# Synthetic plugins for stress testing and benchmarking the plugin
+# service. They are not registered by default. They can be enabled by
+# listing them in the 'plugins' setting of the plugin service.
+#
+
+class IssueFloodPlugin(BlockingPlugin):
+
+    """
+    Reports issues as fast as configured. Configuration:
+
+      issues  - total number of issues to report (default 1000)
+      rate    - issues per second, 0 for as fast as possible (default 0)
+      batch   - issues per report (default 10)
+      size    - size in bytes of the Description of each issue (default 256)
+    """
+
+    def do_run(self):
+        total = int(self.configuration.get('issues', 1000))
+        rate = float(self.configuration.get('rate', 0))
+        batch = max(1, int(self.configuration.get('batch', 10)))
+        description = "x" * int(self.configuration.get('size', 256))
+        started = time.time()
+        reported = 0
+        while reported < total and not self.stopped:
+            count = min(batch, total - reported)
+            self.report_issues([{ "Summary": "Synthetic issue %d" % (reported + n), "Severity": "Info",
+                                  "Description": description } for n in range(count)])
+            reported += count
+            if rate:
+                delay = started + reported / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+class ProgressPlugin(BlockingPlugin):
+
+    """
+    Reports progress at a high frequency. Configuration:
+
+      updates - number of progress reports (default 1000)
+      rate    - reports per second, 0 for as fast as possible (default 100)
+    """
+
+    def do_run(self):
+        updates = int(self.configuration.get('updates', 1000))
+        rate = float(self.configuration.get('rate', 100))
+        for n in range(updates):
+            if self.stopped:
+                return
+            self.report_progress(100 * (n + 1) / updates, "Update %d of %d" % (n + 1, updates))
+            if rate:
+                time.sleep(1.0 / rate)
+
+class ArtifactsPlugin(BlockingPlugin):
+
+    """
+    Generates a tree of artifact files in the work directory and reports
+    them. Configuration:
+
+      directories - number of directories (default 10)
+      files       - files per directory (default 10)
+      size        - size in bytes of each file (default 65536)
+      random      - use random instead of compressible data (default false)
+    """
+
+    def do_run(self):
+        directories = int(self.configuration.get('directories', 10))
+        files = int(self.configuration.get('files', 10))
+        size = int(self.configuration.get('size', 65536))
+        paths = []
+        for d in range(directories):
+            if self.stopped:
+                return
+            directory = os.path.join("artifacts", "directory-%d" % d)
+            os.makedirs(os.path.join(self.work_directory, directory))
+            for f in range(files):
+                data = os.urandom(size) if self.configuration.get('random') else ("%d" % f) * (size / len(str(f)))
+                with open(os.path.join(self.work_directory, directory, "file-%d.txt" % f), "w") as fd:
+                    fd.write(data)
+            paths.append(directory)
+        self.report_artifacts("Synthetic", paths)
+
+class CPUBurnPlugin(BlockingPlugin):
+
+    """
+    Keeps a cpu busy. Configuration:
+
+      seconds - how long to burn (default 10)
+    """
+
+    def do_run(self):
+        deadline = time.time() + float(self.configuration.get('seconds', 10))
+        n = 0
+        while time.time() < deadline and not self.stopped:
+            for i in xrange(10000):
+                n += i * i
+
+class RequestFloodPlugin(AsyncHTTPPlugin):
+
+    """
+    Requests the target many times with the AsyncHTTPPlugin machinery and
+    reports the status codes that came back. Configuration:
+
+      requests - total number of requests (default 1000)
+
+    The concurrency, per_host_concurrency and timeout settings of the
+    AsyncHTTPPlugin apply.
+    """
+
+    def do_run(self):
+        total = int(self.configuration.get('requests', 1000))
+        self.counts = {}
+        self.done = 0
+        def _count(result):
+            code = str(result.code) if not isinstance(result, Failure) else result.type.__name__
+            self.counts[code] = self.counts.get(code, 0) + 1
+            self.done += 1
+            if self.done % max(1, total / 10) == 0:
+                self.report_progress(100 * self.done / total, "%d of %d requests done" % (self.done, total))
+        requests = [self.fetch(self.configuration['target']).addBoth(_count) for n in range(total)]
+        def _report(result):
+            self.report_issues([{ "Summary": "Responses: " + ", ".join("%s=%d" % c for c in sorted(self.counts.items())),
+                                  "Severity": "Info" }])
+        return DeferredList(requests).addCallback(_report)
+
+class TargetsPlugin(BlockingPlugin):
+
+    """
+    Scans many targets per run and reports one issue for each of them,
+    for testing multi-target scans. Configuration:
+
+      issues - issues per target (default 1)
+    """
+
+    PLUGIN_BATCH_SIZE = 50
+
+    def do_run(self):
+        for target in self.targets():
+            if self.stopped:
+                return
+            self.report_issues([{ "Summary": "Synthetic issue %d" % n, "Severity": "Info", "Target": target }
+                                for n in range(int(self.configuration.get('issues', 1)))])
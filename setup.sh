@@ -11,6 +11,7 @@ fi
 
 case $1 in
     develop)
+        (cd common && python setup.py develop)
         (cd plugin-service && python setup.py develop)
         (cd task-engine && python setup.py develop)
         ;;
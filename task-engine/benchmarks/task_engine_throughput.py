@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# End-to-end throughput benchmark for the task engine. This starts a
+# TaskEngineApplication and a fake plugin service in this process and
+# drives a number of concurrent scans through the public api, just like
+# a client would. The fake plugin service does not spawn anything, it
+# simulates api latency, plugin run time and issue rates, so this runs
+# offline and is cheap enough for CI.
+#
+#  python benchmarks/task_engine_throughput.py --scans 200 --concurrency 50
+#
+
+import json
+import logging
+import optparse
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import cyclone.web
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredSemaphore, gatherResults, inlineCallbacks, returnValue
+from twisted.internet.task import deferLater
+from twisted.web.client import getPage
+
+from minion.task_engine import engine
+from minion.task_engine.web import TaskEngineApplication
+
+
+BENCHMARK_PLAN = 'benchmark'
+
+
+#
+# Fake Plugin Service
+#
+
+class FakePluginSession:
+
+    def __init__(self, plugin_name, configuration, options):
+        self.id = str(uuid.uuid4())
+        self.plugin_name = plugin_name
+        self.configuration = configuration
+        self.options = options
+        self.state = 'CREATED'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.duration = random.uniform(options.min_duration, options.max_duration)
+        self.issues = []
+
+    def start(self):
+        self.started = time.time()
+        self.state = 'STARTED'
+
+    def update(self):
+        if self.state != 'STARTED':
+            return
+        now = time.time()
+        elapsed = min(now - self.started, self.duration)
+        # Generate the issues that the plugin would have reported by now
+        while len(self.issues) < int(elapsed * self.options.issue_rate):
+            date = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + ".%06dZ" % (int(now * 1000000) % 1000000)
+            self.issues.append({ 'Id': str(uuid.uuid4()), 'Date': date, 'Severity': 'Info',
+                                 'Summary': 'Benchmark issue %d' % len(self.issues) })
+        if now - self.started >= self.duration:
+            self.state = 'FINISHED'
+            self.finished = self.started + self.duration
+
+    def summary(self):
+        return { 'id': self.id,
+                 'state': self.state,
+                 'configuration': self.configuration,
+                 'plugin': { 'name': self.plugin_name.split('.')[-1], 'version': '0.0', 'class': self.plugin_name },
+                 'progress': None,
+                 'started': int(self.created),
+                 'issues': [],
+                 'artifacts': {},
+                 'duration': int(time.time() - self.created) }
+
+class FakePluginService:
+
+    def __init__(self, options):
+        self.options = options
+        self.plugins = ['minion.plugins.benchmark.FakePlugin%d' % n for n in range(options.plugins)]
+        self.sessions = {}
+        # Plugin finish times survive session deletion so that we can
+        # measure how long it took the task engine to notice.
+        self.finished = {}
+
+    def get_session(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.update()
+            if session.finished is not None:
+                self.finished[session.id] = session.finished
+        return session
+
+class FakeHandler(cyclone.web.RequestHandler):
+
+    @inlineCallbacks
+    def prepare_response(self):
+        latency = self.application.options.latency
+        if latency:
+            yield deferLater(reactor, latency, lambda: None)
+
+class FakePluginsHandler(FakeHandler):
+    @inlineCallbacks
+    def get(self):
+        yield self.prepare_response()
+        plugins = [{'class': p, 'name': p.split('.')[-1], 'version': '0.0'} for p in self.application.fake.plugins]
+        self.finish({'success': True, 'plugins': plugins})
+
+class FakePluginHandler(FakeHandler):
+    @inlineCallbacks
+    def get(self, plugin_name):
+        yield self.prepare_response()
+        self.finish({'success': True, 'plugin': {'class': plugin_name, 'name': plugin_name.split('.')[-1], 'version': '0.0'}})
+
+class FakeCreateSessionHandler(FakeHandler):
+    @inlineCallbacks
+    def put(self, plugin_name):
+        yield self.prepare_response()
+        fake = self.application.fake
+        session = FakePluginSession(plugin_name, json.loads(self.request.body), self.application.options)
+        fake.sessions[session.id] = session
+        self.finish({'success': True, 'session': session.summary()})
+
+class FakeSessionStateHandler(FakeHandler):
+    @inlineCallbacks
+    def put(self, session_id):
+        yield self.prepare_response()
+        session = self.application.fake.get_session(session_id)
+        if session is None:
+            self.finish({'success': False, 'error': 'no-such-session'})
+            return
+        if self.request.body == 'START' and session.state == 'CREATED':
+            session.start()
+        elif self.request.body == 'STOP':
+            session.state = 'STOPPED'
+        self.finish({'success': True})
+
+class FakeSessionHandler(FakeHandler):
+    @inlineCallbacks
+    def get(self, session_id):
+        yield self.prepare_response()
+        session = self.application.fake.get_session(session_id)
+        if session is None:
+            self.finish({'success': False, 'error': 'no-such-session'})
+            return
+        self.finish({'success': True, 'session': session.summary()})
+    @inlineCallbacks
+    def delete(self, session_id):
+        yield self.prepare_response()
+        self.application.fake.sessions.pop(session_id, None)
+        self.finish({'success': True})
+
+class FakeSessionResultsHandler(FakeHandler):
+    @inlineCallbacks
+    def get(self, session_id):
+        yield self.prepare_response()
+        session = self.application.fake.get_session(session_id)
+        if session is None:
+            self.finish({'success': False, 'error': 'no-such-session'})
+            return
+        self.finish({'success': True, 'session': session.summary(), 'issues': session.issues})
+
+class FakePluginServiceApplication(cyclone.web.Application):
+
+    def __init__(self, fake, options):
+        self.fake = fake
+        self.options = options
+        session = r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})"
+        handlers = [
+            (r"/plugins", FakePluginsHandler),
+            (r"/plugin/(.+)", FakePluginHandler),
+            (r"/session/create/(.+)", FakeCreateSessionHandler),
+            (session + "/state", FakeSessionStateHandler),
+            (session + "/results", FakeSessionResultsHandler),
+            (session, FakeSessionHandler),
+        ]
+        cyclone.web.Application.__init__(self, handlers)
+
+    def log_request(self, handler):
+        pass
+
+#
+# Benchmark driver
+#
+
+def request(url, **kwargs):
+    return getPage(url.encode('ascii'), **kwargs).addCallback(json.loads)
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def distribution(values):
+    return { 'p50': percentile(values, 50), 'p95': percentile(values, 95), 'max': max(values) if values else None }
+
+class Benchmark:
+
+    def __init__(self, options, task_engine_api, fake):
+        self.options = options
+        self.task_engine_api = task_engine_api
+        self.fake = fake
+        self.create_latencies = []
+        self.finish_lags = []
+        self.states = {}
+
+    @inlineCallbacks
+    def run_scan(self):
+        api = self.task_engine_api
+        started = time.time()
+        response = yield request(api + "/scan/create/" + BENCHMARK_PLAN, method='PUT',
+                                 postdata=json.dumps({'target': 'http://127.0.0.1/'}))
+        self.create_latencies.append(time.time() - started)
+        if not response['success']:
+            self.states['CREATE-FAILED'] = self.states.get('CREATE-FAILED', 0) + 1
+            return
+        scan_id = response['scan']['id']
+        yield request(api + "/scan/%s/state" % scan_id, method='POST', postdata='START')
+        while True:
+            response = yield request(api + "/scan/%s" % scan_id)
+            scan = response['scan']
+            if scan['state'] in ('FINISHED', 'FAILED', 'STOPPED'):
+                break
+            yield request(api + "/scan/%s/results" % scan_id)
+            yield deferLater(reactor, self.options.poll_interval, lambda: None)
+        finished = time.time()
+        self.states[scan['state']] = self.states.get(scan['state'], 0) + 1
+        plugin_finished = [self.fake.finished[s['id']] for s in scan['sessions'] if s['id'] in self.fake.finished]
+        if plugin_finished:
+            self.finish_lags.append(finished - max(plugin_finished))
+
+    @inlineCallbacks
+    def run(self):
+        semaphore = DeferredSemaphore(self.options.concurrency)
+        started = time.time()
+        yield gatherResults([semaphore.run(self.run_scan) for n in range(self.options.scans)])
+        elapsed = time.time() - started
+        # Histogram values are the bucket counts followed by the sum
+        idle_ticks = engine.IDLE_TICK_DURATION.values.get((), [0, 0.0])
+        idle_tick_count = sum(idle_ticks[:-1])
+        report = { 'scans': self.options.scans,
+                   'concurrency': self.options.concurrency,
+                   'states': self.states,
+                   'elapsed': elapsed,
+                   'scans_per_second': self.options.scans / elapsed,
+                   'create_latency': distribution(self.create_latencies),
+                   'finish_lag': distribution(self.finish_lags),
+                   'idle_ticks': idle_tick_count,
+                   'idle_tick_mean': idle_ticks[-1] / idle_tick_count if idle_tick_count else None,
+                   'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024) }
+        returnValue(report)
+
+def print_report(report):
+    print "Scans            : %d (%s)" % (report['scans'], ", ".join("%s=%d" % i for i in sorted(report['states'].items())))
+    print "Concurrency      : %d" % report['concurrency']
+    print "Elapsed          : %.2fs" % report['elapsed']
+    print "Throughput       : %.2f scans/s" % report['scans_per_second']
+    for name in ('create_latency', 'finish_lag'):
+        d = report[name]
+        if d['max'] is not None:
+            print "%-17s: p50 %.3fs p95 %.3fs max %.3fs" % (name.replace('_', ' ').capitalize(), d['p50'], d['p95'], d['max'])
+    if report['idle_tick_mean'] is not None:
+        print "Idle tick        : %d ticks, mean %.4fs" % (report['idle_ticks'], report['idle_tick_mean'])
+    print "Peak RSS         : %.1f MB" % (report['peak_rss'] / 1048576.0)
+
+if __name__ == "__main__":
+
+    parser = optparse.OptionParser()
+    parser.add_option("-v", "--verbose", action="store_true")
+    parser.add_option("-n", "--scans", type="int", default=100)
+    parser.add_option("-c", "--concurrency", type="int", default=20)
+    parser.add_option("--plugins", type="int", default=3, help="Plugins per scan plan")
+    parser.add_option("--latency", type="float", default=0.0, help="Fake plugin service response latency")
+    parser.add_option("--min-duration", type="float", default=0.5, help="Minimum plugin run time")
+    parser.add_option("--max-duration", type="float", default=2.0, help="Maximum plugin run time")
+    parser.add_option("--issue-rate", type="float", default=5.0, help="Issues reported per plugin per second")
+    parser.add_option("--poll-interval", type="float", default=0.25)
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--json", action="store_true", help="Print the report as JSON")
+    parser.add_option("--max-finish-lag", type="float", help="Fail if the p95 finish lag is above this")
+
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.WARNING,
+                        format='%(asctime)s %(levelname).1s %(message)s', datefmt='%y-%m-%d %H:%M:%S')
+    random.seed(options.seed)
+
+    fake = FakePluginService(options)
+    fake_port = reactor.listenTCP(0, FakePluginServiceApplication(fake, options), interface='127.0.0.1')
+
+    engine.PLANS[BENCHMARK_PLAN] = {
+        'name': BENCHMARK_PLAN,
+        'description': 'Benchmark plan with fake plugins',
+        'workflow': [{'plugin_name': plugin, 'description': None, 'configuration': {}} for plugin in fake.plugins]
+    }
+
+    artifacts_path = tempfile.mkdtemp()
+    settings = dict(plugin_service_api="http://127.0.0.1:%d" % fake_port.getHost().port,
+                    scan_database_type="memory",
+                    scan_database_location=None,
+                    artifacts_path=artifacts_path)
+    task_engine_port = reactor.listenTCP(0, TaskEngineApplication(settings), interface='127.0.0.1')
+
+    result = {}
+
+    @inlineCallbacks
+    def main():
+        try:
+            benchmark = Benchmark(options, "http://127.0.0.1:%d" % task_engine_port.getHost().port, fake)
+            result['report'] = yield benchmark.run()
+        except Exception as e:
+            logging.exception("Benchmark failed: %s" % str(e))
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(main)
+    reactor.run()
+    shutil.rmtree(artifacts_path, ignore_errors=True)
+
+    report = result.get('report')
+    if report is None:
+        sys.exit(1)
+    if options.json:
+        print json.dumps(report, indent=4, sort_keys=True)
+    else:
+        print_report(report)
+    if report['states'].get('FINISHED', 0) != options.scans:
+        sys.exit(1)
+    if options.max_finish_lag is not None and report['finish_lag']['p95'] > options.max_finish_lag:
+        sys.exit(1)
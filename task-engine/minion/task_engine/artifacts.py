@@ -0,0 +1,288 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Content addressed artifact store. Instead of keeping the artifact zip
+# of every plugin session, the files in it are stored once as blobs that
+# are named by the sha256 of their content, and each session gets a
+# manifest that lists its files and their blobs. Repeated scans of the
+# same target mostly produce the same files, which are then stored only
+# once.
+#
+# Blobs are kept as raw deflate streams, exactly what goes into a zip, so
+# a zip can be put together on download from the manifest without
+# compressing anything again. See zip_segments().
+#
+# Blobs that are not in any manifest anymore are removed by a periodic
+# garbage collection. Blobs that were written or reused recently are
+# left alone, so that we do not race with a manifest being written. Both
+# run in threads, a lock makes sure that a blob that an ingest decides to
+# reuse is not removed at the same time.
+#
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+
+from minion.common import metrics
+
+
+READ_SIZE = 64 * 1024
+
+# We do not write ZIP64 archives, sessions with more or larger artifacts
+# than fit in a plain zip keep their zip as it is.
+ZIP_MAX_ENTRIES = 0xffff
+ZIP_MAX_SIZE = 0xffffffff
+
+# The general purpose flag that says the member name is UTF-8. It is the
+# only flag that we carry over from the original zip, the others describe
+# how the original was written.
+ZIP_FLAG_UTF8 = 0x800
+
+ARTIFACT_BLOBS = metrics.registry.counter("minion_task_engine_artifact_blobs_total",
+                                          "Artifact files stored, by whether their blob was new or reused", ("result",))
+ARTIFACT_BLOBS_COLLECTED = metrics.registry.counter("minion_task_engine_artifact_blobs_collected_total",
+                                                    "Unreferenced artifact blobs that were removed")
+
+
+def _dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time[:6]
+    return (((year - 1980) << 9) | (month << 5) | day), ((hour << 11) | (minute << 5) | (second // 2))
+
+def _raw_name(info):
+    # The member name exactly as it is in the zip. Python decodes it only
+    # if the UTF-8 flag is set, otherwise it is the bytes from the zip.
+    name = info.orig_filename
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return name
+
+def _display_name(name, flag_bits):
+    if flag_bits & ZIP_FLAG_UTF8:
+        return name.decode('utf-8', 'replace')
+    try:
+        return name.decode('utf-8')
+    except UnicodeDecodeError:
+        return name.decode('cp437')
+
+def _entry_name(entry):
+    # Manifests from before raw names were kept only have the name
+    if 'raw_name' in entry:
+        return base64.b64decode(entry['raw_name']), entry['flag_bits']
+    name = entry['name'].encode('utf-8')
+    return name, ZIP_FLAG_UTF8 if len(name) != len(entry['name']) else 0
+
+def _local_header(entry, name, flag_bits):
+    date, time_ = _dos_date_time(entry['date_time'])
+    method = zipfile.ZIP_DEFLATED if entry['blob'] else zipfile.ZIP_STORED
+    return struct.pack("<IHHHHHIIIHH", 0x04034b50, 20, flag_bits, method, time_, date, entry['crc'],
+                       entry['compressed_size'], entry['size'], len(name), 0) + name
+
+def _central_header(entry, name, flag_bits, offset):
+    date, time_ = _dos_date_time(entry['date_time'])
+    method = zipfile.ZIP_DEFLATED if entry['blob'] else zipfile.ZIP_STORED
+    external_attr = (0o40755 << 16) | 0x10 if not entry['blob'] else 0o100644 << 16
+    return struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, 20, 20, flag_bits, method, time_, date, entry['crc'],
+                       entry['compressed_size'], entry['size'], len(name), 0, 0, 0, 0, external_attr, offset) + name
+
+def zip_segments(files, blob_path):
+
+    """
+    The segments, see streaming.SegmentProducer, of a zip file with the
+    given manifest files. Returns the segments and the size of the zip.
+    """
+
+    segments, central_directory, offset = [], [], 0
+    for entry in files:
+        name, flag_bits = _entry_name(entry)
+        header = _local_header(entry, name, flag_bits)
+        central_directory.append(_central_header(entry, name, flag_bits, offset))
+        segments.append(header)
+        offset += len(header)
+        if entry['blob']:
+            segments.append((blob_path(entry['blob']), 0, entry['compressed_size']))
+            offset += entry['compressed_size']
+    central_directory = "".join(central_directory)
+    segments.append(central_directory)
+    segments.append(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, len(files), len(files),
+                                len(central_directory), offset, 0))
+    return segments, offset + len(central_directory) + 22
+
+
+class ArtifactStore:
+
+    def __init__(self, path, gc_interval=3600, gc_grace=3600):
+        self.path = os.path.expanduser(path)
+        self.blobs_path = os.path.join(self.path, "blobs")
+        self.manifests_path = os.path.join(self.path, "manifests")
+        self.gc_interval = gc_interval
+        self.gc_grace = gc_grace
+        self.collecting = False
+        self._blob_lock = threading.Lock()
+        for path in (self.blobs_path, self.manifests_path):
+            if not os.path.exists(path):
+                logging.info("Creating artifact store directory %s" % path)
+                os.makedirs(path)
+        if gc_interval:
+            LoopingCall(self.collect_garbage).start(gc_interval, now=False)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs_path, digest[:2], digest)
+
+    def manifest_path(self, session_id):
+        return os.path.join(self.manifests_path, session_id + ".json")
+
+    def load_manifest(self, session_id):
+        """The manifest of a session and its mtime, or None if the session has no artifacts in the store"""
+        path = self.manifest_path(session_id)
+        try:
+            with open(path) as f:
+                data = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+        except (IOError, OSError):
+            return None
+        manifest = json.loads(data)
+        manifest['etag'] = '"%s"' % hashlib.sha1(data).hexdigest()
+        manifest['mtime'] = mtime
+        return manifest
+
+    def zip_segments(self, manifest):
+        return zip_segments(manifest['files'], self.blob_path)
+
+    # Ingesting an artifact zip
+
+    def ingest(self, session_id, zip_path):
+        """Move the files of an artifact zip into the store. Returns a Deferred that fires with the manifest, or None if the zip was kept."""
+        def _ingested(manifest):
+            if manifest is not None:
+                ARTIFACT_BLOBS.inc(manifest['reused'], labels=('reused',))
+                ARTIFACT_BLOBS.inc(manifest['stored'], labels=('new',))
+            return manifest
+        return deferToThread(self._ingest, session_id, zip_path).addCallback(_ingested)
+
+    def _hash_member(self, z, info):
+        digest, crc = hashlib.sha256(), 0
+        with z.open(info) as f:
+            while True:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                crc = zlib.crc32(data, crc)
+        return digest.hexdigest(), crc & 0xffffffff
+
+    def _store_member(self, z, info, path):
+        # Raw deflate, no zlib header, which is what a zip entry contains
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        tmp_path = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass # Created by another ingest
+        with z.open(info) as f, open(tmp_path, "wb") as out:
+            while True:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+                out.write(compressor.compress(data))
+            out.write(compressor.flush())
+        os.rename(tmp_path, path)
+
+    def _ingest(self, session_id, zip_path):
+        files, stored, reused = [], 0, 0
+        with zipfile.ZipFile(zip_path) as z:
+            infos = z.infolist()
+            if len(infos) > ZIP_MAX_ENTRIES or sum(info.file_size for info in infos) > ZIP_MAX_SIZE:
+                logging.warning("Keeping the artifact zip of session %s, it is too large for the artifact store" % session_id)
+                return None
+            for info in infos:
+                name, flag_bits = _raw_name(info), info.flag_bits & ZIP_FLAG_UTF8
+                entry = { 'name': _display_name(name, flag_bits), 'raw_name': base64.b64encode(name),
+                          'flag_bits': flag_bits, 'blob': None, 'crc': 0, 'size': 0, 'compressed_size': 0,
+                          'date_time': list(info.date_time) }
+                if not name.endswith("/"):
+                    digest, crc = self._hash_member(z, info)
+                    path = self.blob_path(digest)
+                    with self._blob_lock:
+                        exists = os.path.exists(path)
+                        if exists:
+                            # Keeps the blob away from the garbage collection until our manifest is written
+                            os.utime(path, None)
+                    if exists:
+                        reused += 1
+                    else:
+                        self._store_member(z, info, path)
+                        stored += 1
+                    entry.update(blob=digest, crc=crc, size=info.file_size, compressed_size=os.path.getsize(path))
+                files.append(entry)
+        if sum(entry['compressed_size'] for entry in files) > ZIP_MAX_SIZE:
+            logging.warning("Keeping the artifact zip of session %s, it is too large for the artifact store" % session_id)
+            return None
+        manifest = { 'session': session_id, 'files': files }
+        path = self.manifest_path(session_id)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.rename(path + ".tmp", path)
+        os.remove(zip_path)
+        return dict(manifest, stored=stored, reused=reused)
+
+    def delete(self, session_id):
+        """Forget the artifacts of a session. Its blobs are removed by the next garbage collection."""
+        try:
+            os.remove(self.manifest_path(session_id))
+        except OSError:
+            pass
+
+    # Garbage collection
+
+    def collect_garbage(self):
+        if self.collecting:
+            return
+        self.collecting = True
+        def _done(removed):
+            self.collecting = False
+            ARTIFACT_BLOBS_COLLECTED.inc(removed)
+            if removed:
+                logging.info("Removed %d unreferenced artifact blobs" % removed)
+        def _failed(failure):
+            self.collecting = False
+            logging.error("Artifact garbage collection failed: %s" % failure.value)
+        return deferToThread(self._collect_garbage).addCallbacks(_done, _failed)
+
+    def _collect_garbage(self):
+        referenced = set()
+        for name in os.listdir(self.manifests_path):
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(self.manifests_path, name)) as f:
+                        referenced.update(entry['blob'] for entry in json.load(f)['files'])
+                except (IOError, OSError):
+                    pass # Deleted while we were looking
+        removed, cutoff = 0, time.time() - self.gc_grace
+        for prefix in os.listdir(self.blobs_path):
+            directory = os.path.join(self.blobs_path, prefix)
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    # Left behind temporary files as well as unreferenced blobs
+                    if name not in referenced:
+                        with self._blob_lock:
+                            if os.path.getmtime(path) < cutoff:
+                                os.remove(path)
+                                removed += 1
+                except OSError:
+                    pass
+        return removed
@@ -2,22 +2,35 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import collections
 import copy
+import datetime
+import hashlib
 import json
 import logging
 import os
+import time
+import urlparse
 import uuid
+from StringIO import StringIO
 
 import cyclone.web
 
 from twisted.internet import reactor
 from twisted.internet.defer import DeferredSemaphore
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.error import ConnectError, TimeoutError
 from twisted.internet.task import deferLater, LoopingCall
 from twisted.internet.threads import deferToThread
-from twisted.web.client import getPage
+from twisted.web.client import Agent, FileBodyProducer, downloadPage, readBody
+from twisted.web.error import Error
+from twisted.web.http_headers import Headers
 
-import cyclone.httpclient
+from minion.common import codec
+from minion.common import compression
+from minion.common import metrics
+from minion.common.priority import DEFAULT_PRIORITY, PRIORITY_HEADER, FairQueue, priority_rank
+from minion.common import tracing
 
 PLANS = {}
 
@@ -166,6 +179,126 @@ PLUGIN_SERVICE_API = "http://localhost:8181"
 PLUGIN_SERVICE_POLL_INTERVAL = 1.0
 
 
+IDLE_TICK_DURATION = metrics.registry.histogram("minion_task_engine_idle_tick_duration_seconds",
+                                                "Time it takes to idle all scans once")
+PLUGIN_SERVICE_REQUEST_DURATION = metrics.registry.histogram("minion_task_engine_plugin_service_request_duration_seconds",
+                                                             "Latency of calls to the plugin service", ("operation",))
+ISSUES_RECEIVED = metrics.registry.counter("minion_task_engine_issues_received_total",
+                                           "Issues collected from plugin sessions")
+RESULT_CACHE_REQUESTS = metrics.registry.counter("minion_task_engine_result_cache_requests_total",
+                                                "Result cache lookups", ("plugin", "result"))
+ARTIFACT_BYTES = metrics.registry.counter("minion_task_engine_artifact_bytes_total",
+                                          "Bytes of artifacts downloaded from plugin services")
+ARTIFACT_TRANSFERS = metrics.registry.counter("minion_task_engine_artifact_transfers_total",
+                                              "Artifact zips taken from plugin services", ("method",))
+
+
+def _plugin_service_request(operation, url, headers=None, method='GET', postdata=None):
+    # Fires with the response and its decoded body. Like getPage, responses
+    # other than 2xx fail with a twisted.web.error.Error.
+    started = time.time()
+    def _read(response):
+        return readBody(response).addCallback(lambda body: (response, body))
+    def _observe(result):
+        PLUGIN_SERVICE_REQUEST_DURATION.observe(time.time() - started, (operation,))
+        return result
+    def _decode(result):
+        response, body = result
+        if not 200 <= response.code < 300:
+            raise Error(str(response.code), response.phrase, body)
+        content_encoding = (response.headers.getRawHeaders('content-encoding') or [None])[0]
+        content_type = (response.headers.getRawHeaders('content-type') or [None])[0]
+        return response, codec.decode(content_type, compression.decompress(content_encoding, body))
+    headers = dict(headers or {}, Accept=codec.accept_header())
+    headers['Accept-Encoding'] = 'gzip'
+    headers = Headers(dict((name, [str(value)]) for name, value in headers.items()))
+    body = FileBodyProducer(StringIO(postdata)) if postdata is not None else None
+    d = Agent(reactor).request(method, url.encode('ascii'), headers, body)
+    return d.addCallback(_read).addBoth(_observe).addCallback(_decode)
+
+def plugin_service_request(operation, url, headers=None, **kwargs):
+    """Call the plugin service and decode the response. Records the latency per operation."""
+    return _plugin_service_request(operation, url, headers, **kwargs).addCallback(lambda result: result[1])
+
+def plugin_service_conditional_request(operation, url, etag):
+    """GET with If-None-Match. Fires with (etag, response), the response is None if nothing changed."""
+    d = _plugin_service_request(operation, url, {'If-None-Match': etag} if etag else None)
+    def _not_modified(failure):
+        failure.trap(Error)
+        if failure.value.status != '304':
+            return failure
+        return etag, None
+    d.addCallback(lambda result: ((result[0].headers.getRawHeaders('etag') or [None])[0], result[1]))
+    d.addErrback(_not_modified)
+    return d
+
+
+def _normalize_target(target):
+    # http://Example.com:80 and http://example.com/ are the same target
+    url = urlparse.urlparse(target)
+    scheme = url.scheme.lower()
+    netloc = (url.hostname or "").lower()
+    if url.port and url.port != {'http': 80, 'https': 443}.get(scheme):
+        netloc += ":%d" % url.port
+    return urlparse.urlunparse((scheme, netloc, url.path or "/", url.params, url.query, url.fragment))
+
+def configuration_targets(configuration):
+    """The targets of a scan or plugin session, which has either a target or a list of targets"""
+    if 'targets' in configuration:
+        return configuration['targets']
+    return [configuration['target']] if 'target' in configuration else []
+
+def _scan_key(scan):
+    # Scans of the same plan against the same targets are compared with each other
+    targets = sorted(_normalize_target(target) for target in configuration_targets(scan['configuration']))
+    target = targets[0] if len(targets) == 1 else targets or ''
+    return hashlib.sha1(json.dumps([scan['plan']['name'], target])).hexdigest()
+
+def _attribute_issues(session, issues):
+    # Issues of a session with a single target are about that target.
+    # Plugins that scan a batch of targets set the Target themselves.
+    target = session['configuration'].get('target')
+    if target is not None:
+        for issue in issues:
+            issue.setdefault('Target', target)
+    return issues
+
+def _target_issues(issues, targets):
+    return [issue for issue in issues if issue.get('Target') in targets]
+
+# Where a plugin session lives and its result cache key are for the task
+# engine only, they are not stored or served with the scan.
+PRIVATE_SESSION_KEYS = ('_plugin_service_api', '_cache_key')
+
+def _public_session(session):
+    return dict((name,value) for name,value in session.items() if name not in PRIVATE_SESSION_KEYS)
+
+#
+# Issues are compared between scans by a fingerprint of the plugin that
+# found them and everything but the fields that change on every run.
+#
+
+def issue_fingerprint(plugin_class, issue):
+    issue = dict((name,value) for name,value in issue.items() if name not in ('Id', 'Date'))
+    return hashlib.sha1(json.dumps([plugin_class, issue], sort_keys=True)).hexdigest()
+
+def _scan_issues(scan):
+    issues = {}
+    for session in scan['sessions']:
+        for issue in session.get('issues', []):
+            issues[issue_fingerprint(session['plugin']['class'], issue)] = dict(issue, Plugin=session['plugin']['class'])
+    return issues
+
+def diff_scans(previous, scan):
+    """Compare the issues of two scans. Returns the new and resolved issues and the unchanged fingerprints."""
+    previous_issues = _scan_issues(previous) if previous else {}
+    issues = _scan_issues(scan)
+    return { 'scan': scan['id'],
+             'previous': previous['id'] if previous else None,
+             'new': [issues[f] for f in sorted(issues) if f not in previous_issues],
+             'resolved': [previous_issues[f] for f in sorted(previous_issues) if f not in issues],
+             'unchanged': [f for f in sorted(issues) if f in previous_issues] }
+
 class ScanDatabase:
     def load(self, scan_id):
         pass
@@ -173,11 +306,28 @@ class ScanDatabase:
         pass
     def delete(self, scan_id):
         pass
+    # The id of the last finished scan of the same plan and target
+    def latest(self, scan):
+        pass
+    def load_diff(self, scan_id):
+        pass
+    def store_diff(self, diff):
+        pass
+    # Recurring scans, see scheduler.py
+    def load_schedules(self):
+        pass
+    def store_schedule(self, schedule):
+        pass
+    def delete_schedule(self, schedule_id):
+        pass
 
 class MemoryScanDatabase(ScanDatabase):
 
     def __init__(self, path):
         self._scans = {}
+        self._diffs = {}
+        self._latest = {}
+        self._schedules = {}
 
     def load(self, scan_id):
         def _main():
@@ -187,12 +337,47 @@ class MemoryScanDatabase(ScanDatabase):
     def store(self, scan):
         def _main():
             self._scans[scan['id']] = scan
+            if scan['state'] == 'FINISHED':
+                self._latest[_scan_key(scan)] = scan['id']
         return deferLater(reactor, 0, _main)
 
     def delete(self, scan_id):
         def _main():
             if scan_id in self._scans:
-                del self._scans[scan_id]
+                scan = self._scans.pop(scan_id)
+                if self._latest.get(_scan_key(scan)) == scan_id:
+                    del self._latest[_scan_key(scan)]
+            self._diffs.pop(scan_id, None)
+        return deferLater(reactor, 0, _main)
+
+    def latest(self, scan):
+        def _main():
+            return self._latest.get(_scan_key(scan))
+        return deferLater(reactor, 0, _main)
+
+    def load_diff(self, scan_id):
+        def _main():
+            return self._diffs.get(scan_id)
+        return deferLater(reactor, 0, _main)
+
+    def store_diff(self, diff):
+        def _main():
+            self._diffs[diff['scan']] = diff
+        return deferLater(reactor, 0, _main)
+
+    def load_schedules(self):
+        def _main():
+            return [dict(schedule) for schedule in self._schedules.values()]
+        return deferLater(reactor, 0, _main)
+
+    def store_schedule(self, schedule):
+        def _main():
+            self._schedules[schedule['id']] = dict(schedule)
+        return deferLater(reactor, 0, _main)
+
+    def delete_schedule(self, schedule_id):
+        def _main():
+            self._schedules.pop(schedule_id, None)
         return deferLater(reactor, 0, _main)
 
 class FileScanDatabase(ScanDatabase):
@@ -216,11 +401,85 @@ class FileScanDatabase(ScanDatabase):
             path = os.path.join(self._path, scan['id'])
             with open(path, "w") as file:
                 json.dump(scan, file, indent=4)
+            if scan['state'] == 'FINISHED':
+                with open(self._latest_path(scan), "w") as file:
+                    file.write(scan['id'])
         return deferToThread(_main)
 
     def delete(self, scan_id):
         def _main():
             path = os.path.join(self._path, scan_id)
+            if os.path.isfile(path):
+                with open(path) as file:
+                    scan = json.load(file)
+                latest_path = self._latest_path(scan)
+                if os.path.isfile(latest_path):
+                    with open(latest_path) as file:
+                        latest = file.read()
+                    if latest == scan_id:
+                        os.remove(latest_path)
+                os.remove(path)
+            diff_path = os.path.join(self._path, scan_id + ".diff")
+            if os.path.isfile(diff_path):
+                os.remove(diff_path)
+        return deferToThread(_main)
+
+    # The latest finished scan per plan and target is kept in a small
+    # index file so that we do not have to look at all the scans.
+
+    def _latest_path(self, scan):
+        return os.path.join(self._path, "latest-" + _scan_key(scan))
+
+    def latest(self, scan):
+        def _main():
+            path = self._latest_path(scan)
+            if os.path.isfile(path):
+                with open(path) as file:
+                    return file.read()
+        return deferToThread(_main)
+
+    def load_diff(self, scan_id):
+        def _main():
+            path = os.path.join(self._path, scan_id + ".diff")
+            if os.path.isfile(path):
+                with open(path) as file:
+                    return json.load(file)
+        return deferToThread(_main)
+
+    def store_diff(self, diff):
+        def _main():
+            path = os.path.join(self._path, diff['scan'] + ".diff")
+            with open(path, "w") as file:
+                json.dump(diff, file)
+        return deferToThread(_main)
+
+    def _schedule_path(self, schedule_id):
+        return os.path.join(self._path, "schedule-" + schedule_id)
+
+    def load_schedules(self):
+        def _main():
+            schedules = []
+            for name in os.listdir(self._path):
+                if name.startswith("schedule-") and not name.endswith(".tmp"):
+                    with open(os.path.join(self._path, name)) as file:
+                        schedules.append(json.load(file))
+            return schedules
+        return deferToThread(_main)
+
+    def store_schedule(self, schedule):
+        data = json.dumps(schedule)
+        def _main():
+            # Schedules are rewritten on every run, do that atomically
+            path = self._schedule_path(schedule['id'])
+            tmp_path = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+            with open(tmp_path, "w") as file:
+                file.write(data)
+            os.rename(tmp_path, path)
+        return deferToThread(_main)
+
+    def delete_schedule(self, schedule_id):
+        def _main():
+            path = self._schedule_path(schedule_id)
             if os.path.isfile(path):
                 os.remove(path)
         return deferToThread(_main)
@@ -228,20 +487,217 @@ class FileScanDatabase(ScanDatabase):
 SCAN_DATABASE_CLASSES = { 'files': FileScanDatabase, 'memory': MemoryScanDatabase }
 
 
+PLUGIN_SERVICE_REFRESH_INTERVAL = 10.0
+
+# The plugin service recovers its sessions when it is restarted. This is
+# how long we keep trying to reach it before we give up on a session.
+PLUGIN_SERVICE_RESTART_GRACE = 120.0
+
+
+class PluginServiceBackend:
+
+    """
+    One plugin service that we can run plugin sessions on. We keep
+    track of the plugins it supports, whether it is reachable and
+    how many of our plugin sessions are currently placed on it.
+
+    If the plugin service reports its status then we use the number
+    of running and queued sessions per cpu as its load, plus whatever
+    we placed on it since the last refresh. Otherwise we fall back to
+    the number of sessions that we have placed on it ourselves.
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.healthy = True
+        self.plugins = None
+        self.sessions = 0
+        self.status = None
+        self.placed = 0
+
+    def load(self):
+        if self.status is None:
+            return float(self.sessions)
+        cpus = self.status['host'].get('cpus') or 1
+        return float(self.status['running'] + self.status['queued'] + self.placed) / cpus
+
+    def supports(self, plugin_name):
+        # If we have not been able to fetch the plugin list yet then we
+        # optimistically assume that the plugin is there.
+        return self.plugins is None or plugin_name in self.plugins
+
+    def mark_unhealthy(self, reason):
+        if self.healthy:
+            logging.error("Marking plugin service %s unhealthy: %s" % (self.api, reason))
+        self.healthy = False
+
+    @inlineCallbacks
+    def refresh(self):
+        try:
+            url = self.api + "/plugins"
+            response = yield plugin_service_request('get-plugins', url)
+            self.plugins = set(plugin['class'] for plugin in response['plugins'])
+            yield self._refresh_status()
+            if not self.healthy:
+                logging.info("Plugin service %s is healthy again" % self.api)
+            self.healthy = True
+        except Exception as e:
+            self.mark_unhealthy(str(e))
+
+    @inlineCallbacks
+    def _refresh_status(self):
+        # Older plugin services do not have a /status resource
+        try:
+            url = self.api + "/status"
+            response = yield plugin_service_request('get-status', url)
+            self.status = response['status']
+        except Error:
+            self.status = None
+        self.placed = 0
+
+    def summary(self):
+        return { 'api': self.api,
+                 'healthy': self.healthy,
+                 'plugins': sorted(self.plugins) if self.plugins is not None else None,
+                 'load': self.load(),
+                 'status': self.status }
+
+class PluginServicePool:
+
+    """
+    The set of plugin services that the task engine dispatches plugin
+    sessions to. A new session is placed on the least loaded healthy
+    backend that supports its plugin. Once placed, a session stays on
+    that backend; we remember where it lives in the session itself.
+    """
+
+    def __init__(self, apis):
+        if isinstance(apis, basestring):
+            apis = [apis]
+        self.backends = [PluginServiceBackend(api) for api in apis]
+        self._looper = None
+
+    def start(self):
+        if self._looper is None:
+            self._looper = LoopingCall(self.refresh)
+            self._looper.start(PLUGIN_SERVICE_REFRESH_INTERVAL)
+
+    @inlineCallbacks
+    def refresh(self):
+        for backend in self.backends:
+            yield backend.refresh()
+
+    def get_backend(self, api):
+        for backend in self.backends:
+            if backend.api == api:
+                return backend
+
+    def select(self, plugin_name):
+        candidates = [b for b in self.backends if b.healthy and b.supports(plugin_name)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda b: b.load())
+
+    def acquire(self, plugin_name):
+        backend = self.select(plugin_name)
+        if backend is not None:
+            backend.sessions += 1
+            backend.placed += 1
+        return backend
+
+    def release(self, api):
+        backend = self.get_backend(api)
+        if backend is not None and backend.sessions > 0:
+            backend.sessions -= 1
+
+    def summary(self):
+        return [backend.summary() for backend in self.backends]
+
+
+class ResultCache:
+
+    """
+    Remembers the issues of finished plugin sessions so that running the
+    same plugin with the same configuration against the same target again
+    can reuse them instead of spawning a new plugin runner. Entries are
+    keyed by plugin class, plugin version and the normalized configuration
+    (which includes the target).
+
+    The cache is opt-in. The ttl is the default time in seconds that a
+    result can be reused, plugins maps plugin classes to their own ttl.
+    A ttl of 0 disables caching for a plugin. Sessions that produced
+    artifacts are not cached, since we do not keep those around.
+    """
+
+    def __init__(self, ttl=3600, plugins=None, max_entries=10000):
+        self.ttl = ttl
+        self.plugins = plugins or {}
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+
+    def _ttl(self, plugin):
+        return self.plugins.get(plugin['class'], self.ttl)
+
+    def key(self, plugin, configuration):
+        if plugin is None or not self._ttl(plugin):
+            return None
+        configuration = dict(configuration)
+        if 'target' in configuration:
+            configuration['target'] = _normalize_target(configuration['target'])
+        if 'targets' in configuration:
+            configuration['targets'] = sorted(_normalize_target(target) for target in configuration['targets'])
+        return hashlib.sha1(json.dumps([plugin['class'], plugin['version'], configuration], sort_keys=True)).hexdigest()
+
+    def get(self, plugin, key):
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry['time'] > self._ttl(plugin):
+            del self.entries[key]
+            entry = None
+        RESULT_CACHE_REQUESTS.inc(labels=(plugin['class'], 'hit' if entry else 'miss'))
+        return entry
+
+    def store(self, key, session):
+        self.entries.pop(key, None)
+        self.entries[key] = { 'time': time.time(), 'session': session['id'], 'issues': session['issues'] }
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+# Scan versions are only meaningful within one run of the task engine,
+# so the ETags that we make from them include this epoch.
+VERSION_EPOCH = uuid.uuid4().hex[:8]
+
 class TaskEngineSession:
 
-    def __init__(self, plan, configuration, database, plugin_service_api, artifacts_path):
+    def __init__(self, plan, configuration, database, plugin_services, artifacts_path, result_cache=None,
+                 artifact_handoff=True, artifact_store=None):
         self.plan = plan
         self.configuration = configuration
         self.database = database
-        self.plugin_service_api = plugin_service_api
+        self.plugin_services = plugin_services
         self.artifacts_path = artifacts_path
+        self.result_cache = result_cache
+        self.artifact_handoff = artifact_handoff
+        self.artifact_store = artifact_store
+        # The priority is a property of the scan, it is not passed on to the plugins
+        self.priority = self.configuration.pop('priority', DEFAULT_PRIORITY)
         self.id = str(uuid.uuid4())
         self.state = 'CREATED'
         self.plugin_configurations = []
         self.semaphore = DeferredSemaphore(1)
         self.plugin_sessions = []
         self.delete_when_stopped = False
+        self._issue_counts = {}
+        # The scan and each of its plugin sessions get their own timeline,
+        # all sharing the trace id that we also give to the plugin service.
+        self.timeline = tracing.Timeline()
+        self.timeline.event('created')
+        self._session_timelines = {}
+        self.diff = None
+        # Bumped on every change to the scan or its sessions. The ETags of
+        # the plugin sessions are used to only fetch what has changed.
+        self.version = 0
+        self._etags = {}
+        self._unreachable = {}
 
     #
     # Return True if all plugins have completed.
@@ -250,10 +706,108 @@ class TaskEngineSession:
     def _all_sessions_are_done(self):
         # TODO We should really check for the reverse here: see if they are all in FINISHED or STOPPED
         for session in self.plugin_sessions:
-            if session['state'] in ('CREATED', 'STARTED', 'STOPPING'):
+            if session['state'] in ('CREATED', 'QUEUED', 'STARTED', 'STOPPING'):
                 return False
         return True
 
+    #
+    # Plugin sessions are bound to the plugin service they were created
+    # on. All calls for a session go to that backend. If the backend
+    # cannot be reached then we mark it unhealthy so that no new
+    # sessions are placed on it.
+    #
+
+    def _plugin_service_api(self, session):
+        return session['_plugin_service_api']
+
+    def _plugin_service_failed(self, session, e):
+        if isinstance(e, (ConnectError, TimeoutError)):
+            backend = self.plugin_services.get_backend(self._plugin_service_api(session))
+            if backend is not None:
+                backend.mark_unhealthy(str(e))
+
+    def _plugin_service_restarting(self, session, e):
+        if not isinstance(e, ConnectError):
+            return False
+        since = self._unreachable.setdefault(session['id'], time.time())
+        return time.time() - since < PLUGIN_SERVICE_RESTART_GRACE
+
+    def _changed(self):
+        self.version += 1
+
+    def etag(self):
+        return 'W/"%s.%d"' % (VERSION_EPOCH, self.version)
+
+    def _session_event(self, session, name, **attributes):
+        timeline = self._session_timelines.get(session['id'])
+        if timeline is not None:
+            timeline.event(name, **attributes)
+        self._changed()
+
+    def _update_session(self, session, update):
+        # Record state changes as we observe them. The plugin service has
+        # the exact times in its own timeline, the difference between the
+        # two is the time it takes us to notice.
+        previous_state = session['state']
+        session.update(update)
+        self._changed()
+        if session['state'] != previous_state:
+            self._session_event(session, session['state'].lower())
+
+    def _set_state(self, state):
+        self.state = state
+        self.timeline.event(state.lower())
+        self._changed()
+
+    #
+    # Fetch the latest state of a plugin session. This is a conditional
+    # request, if the session did not change then we get a 304 and there
+    # is nothing to decode or update.
+    #
+
+    @inlineCallbacks
+    def _refresh_session(self, session):
+        url = "%s/session/%s" % (self._plugin_service_api(session), session['id'])
+        etag = self._etags.get(('get-session', session['id']))
+        etag, response = yield plugin_service_conditional_request('get-session', url, etag)
+        self._unreachable.pop(session['id'], None)
+        self._etags[('get-session', session['id'])] = etag
+        if response is not None:
+            self._update_session(session, response['session'])
+
+    #
+    # If the plugin service runs on the same host, and its work directory is
+    # on the same filesystem as our artifacts, then we take the artifacts
+    # zip with a hard link instead of downloading a copy. The plugin service
+    # tells us where the zip is; if we see a file with the same device and
+    # inode there then it is the same file. Returns True if that worked,
+    # otherwise the zip has to be downloaded.
+    #
+
+    @inlineCallbacks
+    def _handoff_artifacts(self, session, path):
+        url = self._plugin_service_api(session) + "/session/%s/artifacts/handoff" % session['id']
+        try:
+            response = yield plugin_service_request('get-artifacts-handoff', url)
+        except Error:
+            # An older plugin service that does not know about handoffs
+            returnValue(False)
+        if not response.get('success'):
+            returnValue(False)
+        artifacts = response['artifacts']
+        try:
+            stat = os.stat(artifacts['path'])
+            if (stat.st_dev, stat.st_ino, stat.st_size) != (artifacts['device'], artifacts['inode'], artifacts['size']):
+                returnValue(False)
+            if os.path.exists(path):
+                os.remove(path)
+            os.link(artifacts['path'], path)
+        except OSError as e:
+            # Most likely a different filesystem (EXDEV) or no permission
+            logging.debug("Cannot hand off artifacts of session %s: %s" % (session['id'], str(e)))
+            returnValue(False)
+        returnValue(True)
+
     @inlineCallbacks
     def _stop_sessions(self):
         for session in self.plugin_sessions:
@@ -261,18 +815,22 @@ class TaskEngineSession:
             if session['state'] not in ('FINISHED', 'FAILED', 'STOPPED', 'STOPPING'):
                 try:
                     # Get the latest session state
-                    url = "%s/session/%s" % (self.plugin_service_api, session['id'])
-                    response = yield getPage(url.encode('ascii')).addCallback(json.loads)
-                    session.update(response['session'])
+                    yield self._refresh_session(session)
                     # If this session is not already STOPPING then we stop it
                     if session['state'] != 'STOPPING':
-                        logging.debug("TaskEngineSession._periodic_session_task - Going to stop " + session['plugin']['class'])
-                        url = self.plugin_service_api + "/session/%s/state" % session['id']
-                        result = yield getPage(url.encode('ascii'), method='PUT', postdata='STOP').addCallback(json.loads)
+                        logging.debug("TaskEngineSession._periodic_session_task - Going to stop %s", session['plugin']['class'])
+                        self._session_event(session, 'stop-requested')
+                        url = self._plugin_service_api(session) + "/session/%s/state" % session['id']
+                        result = yield plugin_service_request('change-state', url, method='PUT', postdata='STOP')
                 except Exception as e:
+                    self._plugin_service_failed(session, e)
+                    if self._plugin_service_restarting(session, e):
+                        logging.warning("Cannot reach the plugin service to stop session %s: %s" % (session['id'], str(e)))
+                        continue
                     logging.exception("Failed to stop session %s: %s" % (session['id'], str(e)))
                     # Mark the session as FAILED so that we won't look at it again
                     session['state'] = 'FAILED'
+                    self._changed()
     
     #
     # Periodically decide what to do in our workflow. We simply walk
@@ -285,8 +843,9 @@ class TaskEngineSession:
         logging.debug("TaskEngineSession._periodic_session_task")
 
         try:
-            # Skip sessions that are in their final finished state
-            if self.state in ('FINISHED', 'FAILED', 'STOPPED'):
+            # Skip sessions that are in their final finished state, or
+            # that are still waiting for their plugin sessions to be created
+            if self.state in ('QUEUED', 'FINISHED', 'FAILED', 'STOPPED'):
                 return
 
             if self.state == 'STOPPING':
@@ -300,39 +859,75 @@ class TaskEngineSession:
                     try:
                         # Update the session so that we have the most recent info
                         if session['state'] not in ('FINISHED', 'STOPPED', 'FAILED'):
-                            url = "%s/session/%s" % (self.plugin_service_api, session['id'])
-                            response = yield getPage(url.encode('ascii')).addCallback(json.loads)
-                            session.update(response['session'])
+                            yield self._refresh_session(session)
                         # Now decide what to do based on the session state
                         if session['state'] == 'CREATED':
                             # Start this plugin session
-                            logging.debug("TaskEngineSession._periodic_session_task - Going to start " + session['plugin']['class'])
-                            url = self.plugin_service_api + "/session/%s/state" % session['id']
-                            result = yield getPage(url.encode('ascii'), method='PUT', postdata='START').addCallback(json.loads)
+                            logging.debug("TaskEngineSession._periodic_session_task - Going to start %s", session['plugin']['class'])
+                            self._session_event(session, 'start-requested')
+                            url = self._plugin_service_api(session) + "/session/%s/state" % session['id']
+                            result = yield plugin_service_request('change-state', url, method='PUT', postdata='START')
                             break
                         elif session['state'] in ('STARTED', 'FINISHED') and session.get('_done') != True:
                             # If the status is STARTED or FINISHED then collect the results periodically
-                            logging.debug("TaskEngineSession._periodic_session_task - Going to get results from " + session['plugin']['class'])
-                            url = self.plugin_service_api + "/session/%s/results" % session['id']
-                            result = yield getPage(url.encode('ascii')).addCallback(json.loads)
-                            session['issues'] = result['issues']
+                            logging.debug("TaskEngineSession._periodic_session_task - Going to get results from %s", session['plugin']['class'])
+                            url = self._plugin_service_api(session) + "/session/%s/results" % session['id']
+                            etag = self._etags.get(('get-results', session['id']))
+                            etag, result = yield plugin_service_conditional_request('get-results', url, etag)
+                            self._etags[('get-results', session['id'])] = etag
+                            if result is not None:
+                                session['issues'] = _attribute_issues(session, result['issues'])
+                                ISSUES_RECEIVED.inc(len(result['issues']) - self._issue_counts.get(session['id'], 0))
+                                self._issue_counts[session['id']] = len(result['issues'])
+                                self._changed()
                             # If the task is finished, and we just grabbed the final results, then mark it as done
                             if session['state'] == 'FINISHED':
+                                self._session_event(session, 'results-collected', issues=len(session['issues']))
                                 # If the session has artifacts, download them and store them
                                 if session['artifacts']:
+                                    self._session_event(session, 'downloading-artifacts')
                                     try:
-                                        url = self.plugin_service_api + "/session/%s/artifacts" % session['id']
-                                        response = yield cyclone.httpclient.fetch(url)
-                                        with open("%s/%s.zip" % (self.artifacts_path, session['id']), "w") as f:
-                                            f.write(response.body)
+                                        url = self._plugin_service_api(session) + "/session/%s/artifacts" % session['id']
+                                        path = "%s/%s.zip" % (self.artifacts_path, session['id'])
+                                        handed_off = False
+                                        if self.artifact_handoff:
+                                            handed_off = yield self._handoff_artifacts(session, path)
+                                        if handed_off:
+                                            ARTIFACT_TRANSFERS.inc(labels=('handoff',))
+                                        else:
+                                            # Streamed straight to disk, artifact zips can be large
+                                            started = time.time()
+                                            yield downloadPage(url.encode('ascii'), path)
+                                            PLUGIN_SERVICE_REQUEST_DURATION.observe(time.time() - started, ('get-artifacts',))
+                                            ARTIFACT_BYTES.inc(os.path.getsize(path))
+                                            ARTIFACT_TRANSFERS.inc(labels=('download',))
+                                        self._session_event(session, 'artifacts-stored', bytes=os.path.getsize(path),
+                                                            handoff=handed_off)
+                                        # Deduplicate the files in the zip into the artifact store
+                                        if self.artifact_store is not None:
+                                            manifest = yield self.artifact_store.ingest(session['id'], path)
+                                            if manifest is not None:
+                                                self._session_event(session, 'artifacts-ingested', files=len(manifest['files']),
+                                                                    stored=manifest['stored'], reused=manifest['reused'])
                                     except Exception as e:
                                         logging.exception("Unable to store scan artifacts: " + str(e))
+                                elif self.result_cache is not None and session.get('_cache_key'):
+                                    self.result_cache.store(session['_cache_key'], session)
                                 session['_done'] = True
                             break
+                        elif session['state'] in ('QUEUED', 'STOPPING'):
+                            # Waiting for a plugin-runner, or for it to stop. Like a running
+                            # session, the next session does not start until this one is done.
+                            break
                     except Exception as e:
+                        self._plugin_service_failed(session, e)
+                        if self._plugin_service_restarting(session, e):
+                            logging.warning("Cannot reach the plugin service of session %s: %s" % (session['id'], str(e)))
+                            break
                         logging.exception("Failed to idle session %s: %s" % (session['id'], str(e)))
                         # Mark the session as FAILED so that we won't look at it again
                         session['state'] = 'FAILED'
+                        self._session_event(session, 'failed', error=str(e))
 
             # If we have more work to do then we schedule ourself again.
 
@@ -343,36 +938,77 @@ class TaskEngineSession:
                     # We have finished executing all plugins so we
                     # transition to the FINISHED state. We store our
                     # session in the database.
-                    self.state = 'FINISHED'
+                    state = 'FINISHED'
                     # If any of the sessions failed, then we also set our scan to failed
                     for session in self.plugin_sessions:
                         if session['state'] == 'FAILED':
-                            self.state = 'FAILED'
+                            state = 'FAILED'
                             break
+                    self._set_state(state)
+                    if self.state == 'FINISHED':
+                        yield self._diff_with_previous_scan()
                     result = yield self.database.store(self.summary())
                 elif self.state == 'STOPPING':
                     # We have finished stopping so we transition to
                     # STOPPED. If we were asked to delete this session
                     # then simply do not store it in the database.
-                    self.state = 'STOPPED'
+                    self._set_state('STOPPED')
                     if not self.delete_when_stopped:
                         result = yield self.database.store(self.summary())
                 # Always delete all the plugin sessions, since they are
                 # not needed anymore.
-                for session in self.plugin_sessions:
-                    url = self.plugin_service_api + "/session/%s" % session['id']
-                    try:
-                        result = yield getPage(url.encode('ascii'), method='DELETE').addCallback(json.loads)
-                        if not result['success']:
-                            logging.error("Failed to delete plugin session %s: %s" % (session['id'], result['error']))
-                    except Exception as e:
-                        logging.exception("Unable to delete plugin session %s: %s" % (session['id'], str(e)))
+                yield self._delete_sessions()
                 returnValue(True)
         except Exception as e:
             logging.exception("Uncaught exception in _idle_tasks: " + str(e))
             returnValue(False)
             
     
+    #
+    # Delete all plugin sessions from their plugin services and release
+    # the backends that they were placed on.
+    #
+
+    @inlineCallbacks
+    def _delete_sessions(self):
+        for session in self.plugin_sessions:
+            # Cached sessions never existed on a plugin service
+            if session.get('cached'):
+                continue
+            url = self._plugin_service_api(session) + "/session/%s" % session['id']
+            try:
+                result = yield plugin_service_request('delete-session', url, method='DELETE')
+                self._session_event(session, 'deleted')
+                if not result['success']:
+                    logging.error("Failed to delete plugin session %s: %s" % (session['id'], result['error']))
+            except Exception as e:
+                logging.exception("Unable to delete plugin session %s: %s" % (session['id'], str(e)))
+                self._plugin_service_failed(session, e)
+            self.plugin_services.release(self._plugin_service_api(session))
+
+    #
+    # Compare the issues of this scan with those of the previous scan of
+    # the same plan and target. The full diff is stored separately, the
+    # scan itself only gets the counts.
+    #
+
+    @inlineCallbacks
+    def _diff_with_previous_scan(self):
+        try:
+            previous = None
+            previous_id = yield self.database.latest(self.summary())
+            if previous_id is not None:
+                previous = yield self.database.load(previous_id)
+            diff = diff_scans(previous, self.summary())
+            yield self.database.store_diff(diff)
+            self._changed()
+            self.diff = { 'previous': diff['previous'],
+                          'new': len(diff['new']),
+                          'resolved': len(diff['resolved']),
+                          'unchanged': len(diff['unchanged']) }
+        except Exception as e:
+            logging.exception("Failed to diff scan %s: %s" % (self.id, str(e)))
+
     #
     # Start the scan. We change the status to STARTED and call our periodic
     # poller which will be responsible for starting the plugins in the right
@@ -382,7 +1018,7 @@ class TaskEngineSession:
     def start(self):
         if self.state != 'CREATED':
             return deferLater(reactor, 0, lambda: False)
-        self.state = 'STARTED'
+        self._set_state('STARTED')
         return deferLater(reactor, 0, lambda: True)
 
     #
@@ -391,19 +1027,93 @@ class TaskEngineSession:
     
     @inlineCallbacks
     def create(self):
-        # Create plugin sessions
-        for step in self.plan['workflow']:
-            # Create the plugin configuration by overlaying the default configuration with the given configuration
-            configuration = step['configuration']
-            configuration.update(self.configuration)
-            # Create the pligin session
-            url = self.plugin_service_api + "/session/create/%s" % step['plugin_name']
-            response = yield getPage(url.encode('ascii'), method='PUT', postdata=json.dumps(configuration)).addCallback(json.loads)
-            self.plugin_sessions.append(response['session'])
+        # Create plugin sessions. A scan can have many targets. Plugins that
+        # can scan many targets at once get them in batches of at most their
+        # batch size. Other plugins get a session per target.
+        targets = configuration_targets(self.configuration)
+        try:
+            for step in self.plan['workflow']:
+                batch_size = max(1, (step.get('plugin') or {}).get('batch_size', 1))
+                for start in range(0, len(targets), batch_size):
+                    batch = targets[start:start + batch_size]
+                    # Create the plugin configuration by overlaying the default configuration with the given configuration
+                    configuration = dict(step['configuration'])
+                    configuration.update((name, value) for name, value in self.configuration.items()
+                                         if name not in ('target', 'targets'))
+                    if len(batch) == 1:
+                        configuration['target'] = batch[0]
+                    else:
+                        configuration['targets'] = batch
+                    yield self._create_session(step, configuration)
+        except Exception as e:
+            # Do not leave the sessions that we did create behind on the plugin services
+            yield self._delete_sessions()
+            raise e
         summary = { 'id': self.id, 'state': self.state, 'plan': self.plan, 'configuration': self.configuration,
                     'sessions': self.plugin_sessions }
         returnValue(summary)
 
+    @inlineCallbacks
+    def _create_session(self, step, configuration):
+        # Reuse the results of an earlier identical run if we can
+        cache_key = None
+        if self.result_cache is not None:
+            cache_key = self.result_cache.key(step.get('plugin'), configuration)
+            entry = self.result_cache.get(step['plugin'], cache_key) if cache_key else None
+            if entry is not None:
+                self._add_cached_session(step, configuration, entry)
+                return
+        # Pick the plugin service to run this session on
+        backend = self.plugin_services.acquire(step['plugin_name'])
+        if backend is None:
+            raise Exception("No healthy plugin service available for %s" % step['plugin_name'])
+        # Create the pligin session
+        url = backend.api + "/session/create/%s" % step['plugin_name']
+        timeline = tracing.Timeline(self.timeline.trace_id)
+        timeline.event('creating', plugin_service=backend.api)
+        try:
+            response = yield plugin_service_request('create-session', url, method='PUT', postdata=json.dumps(configuration),
+                                                    headers={tracing.TRACE_ID_HEADER: self.timeline.trace_id,
+                                                             PRIORITY_HEADER: self.priority})
+        except Exception as e:
+            self.plugin_services.release(backend.api)
+            if isinstance(e, (ConnectError, TimeoutError)):
+                backend.mark_unhealthy(str(e))
+            raise
+        session = response['session']
+        session['_plugin_service_api'] = backend.api
+        session['_cache_key'] = cache_key
+        self.plugin_sessions.append(session)
+        timeline.event('created')
+        self._session_timelines[session['id']] = timeline
+
+    #
+    # Add a session that is already finished with the issues from the
+    # result cache. Issues get new ids and dates so that clients that
+    # fetch incremental results see them.
+    #
+
+    def _add_cached_session(self, step, configuration, entry):
+        date = datetime.datetime.utcnow().isoformat() + 'Z'
+        issues = [dict(issue, Id=str(uuid.uuid4()), Date=date) for issue in entry['issues']]
+        session = { 'id': str(uuid.uuid4()),
+                    'state': 'FINISHED',
+                    'configuration': configuration,
+                    'plugin': step['plugin'],
+                    'progress': None,
+                    'started': int(time.time()),
+                    'duration': 0,
+                    'issues': _attribute_issues({ 'configuration': configuration }, issues),
+                    'artifacts': {},
+                    'cached': True,
+                    'cached_from': { 'session': entry['session'], 'time': entry['time'] },
+                    '_plugin_service_api': None,
+                    '_done': True }
+        self.plugin_sessions.append(session)
+        timeline = tracing.Timeline(self.timeline.trace_id)
+        timeline.event('cached', session=entry['session'])
+        self._session_timelines[session['id']] = timeline
+
     #
     # Stop the current scan - Stop all plugin sessions that are in the
     # CREATED state. Set our own state to STOPPING.
@@ -415,17 +1125,26 @@ class TaskEngineSession:
 
         # Don't do anything if we are already STOPPING or STOPPED
         if self.state in ('STOPPING', 'STOPPED'):
-            returnValue(True)
+            return deferLater(reactor, 0, lambda: True)
 
         # We can only be stopped in STARTED state
         if self.state not in ('STARTED'):
-            returnValue(False)
+            return deferLater(reactor, 0, lambda: False)
             
         # Set our state to STOPPING. The periodic task will pick this
         # up and stop all the sessions and move us to the STOPPED
         # state when they are all done.
-        self.state = 'STOPPING'
-        returnValue(True)
+        self._set_state('STOPPING')
+        return deferLater(reactor, 0, lambda: True)
+
+    #
+    # Return the timeline of the scan as seen by the task engine. The
+    # timelines recorded by the plugin service are part of the sessions.
+    #
+
+    def timeline_summary(self):
+        sessions = dict((session_id, timeline.events) for session_id,timeline in self._session_timelines.items())
+        return { 'trace_id': self.timeline.trace_id, 'events': self.timeline.events, 'sessions': sessions }
 
     #
     # Return a summary of the current plugin. Contains its state,
@@ -436,23 +1155,31 @@ class TaskEngineSession:
     def summary(self):
         return { 'id': self.id,
                  'state': self.state,
+                 'priority': self.priority,
                  'plan': self.plan,
                  'configuration': self.configuration,
-                 'sessions': self.plugin_sessions }
+                 'sessions': [_public_session(session) for session in self.plugin_sessions],
+                 'diff': self.diff,
+                 'timeline': self.timeline_summary() }
 
     #
     # Return just the results of the scan. Condensed form of summary()
     # that has an optional since parameter that will let you specify
-    # incremental results.
+    # incremental results. With targets only the sessions and issues of
+    # those targets are returned.
     #
 
-    def results(self, since = "1975-09-23T00:00:00.000000Z"):
+    def results(self, since = "1975-09-23T00:00:00.000000Z", targets = None):
         sessions = []
         for session in self.plugin_sessions:
+            if targets is not None and not targets.intersection(configuration_targets(session['configuration'])):
+                continue
             issues = []
             for i in session['issues']:
                 if i['Date'] > since:
                     issues.append(i)
+            if targets is not None:
+                issues = _target_issues(issues, targets)
             s = { 'id': session['id'],
                   'plugin': session['plugin'],
                   'state': session['state'],
@@ -464,48 +1191,168 @@ class TaskEngineSession:
 
 class TaskEngine:
 
-    def __init__(self, scans_database, plugin_service_api, artifacts_path):
+    def __init__(self, scans_database, plugin_service_apis, artifacts_path, result_cache=None, artifact_handoff=True,
+                 artifact_store=None, create_concurrency=10, priority_weights=None):
         self._scans_database = scans_database
-        self._plugin_service_api = plugin_service_api
+        self._result_cache = result_cache
+        self._artifact_handoff = artifact_handoff
+        self._artifact_store = artifact_store
+        self._plugin_services = PluginServicePool(plugin_service_apis)
         self._artifacts_path = artifacts_path
         self._sessions = {}
         self._looper = None
+        self._create_queue = FairQueue(priority_weights)
+        self._start_when_created = set()
+        self._create_concurrency = create_concurrency
+        self._creating = 0
 
         self._artifacts_path = os.path.expanduser(self._artifacts_path)
         if not os.path.exists(self._artifacts_path):
             logging.info("Creating scan artifacts directory %s" % self._artifacts_path)
             os.mkdir(self._artifacts_path)
 
+        reactor.callWhenRunning(self._plugin_services.start)
+
+        metrics.registry.gauge("minion_task_engine_scans", "Live scans by state", ("state",), self._count_scans)
+        metrics.registry.gauge("minion_task_engine_plugin_services_healthy", "Healthy plugin services",
+                               function=lambda: len([b for b in self._plugin_services.backends if b.healthy]))
+        metrics.registry.gauge("minion_task_engine_scans_queued", "Submitted scans waiting to be created",
+                               function=lambda: len(self._create_queue))
+
+    def _count_scans(self):
+        counts = {}
+        for session in self._sessions.values():
+            counts[(session.state,)] = counts.get((session.state,), 0) + 1
+        return counts
+
+    def get_plugin_services(self):
+        return self._plugin_services.summary()
+
     def get_plan_descriptions(self):
         plans = [{'name': plan['name'], 'description': plan['description']} for plan in PLANS.values()]
         return deferLater(reactor, 0, lambda: plans)
 
     @inlineCallbacks
     def get_plan(self, plan_name):
-        plan = PLANS.get(plan_name)
+        plan = copy.deepcopy(PLANS.get(plan_name))
         if plan is not None:
             # Loop over all the plugins part of this plan and get their extended info
             for w in plan['workflow']:
-                url = "%s/plugin/%s" % (self._plugin_service_api, w['plugin_name'])
-                response = yield getPage(url.encode('ascii')).addCallback(json.loads)
+                backend = self._plugin_services.select(w['plugin_name'])
+                if backend is None:
+                    w['plugin'] = None
+                    continue
+                url = "%s/plugin/%s" % (backend.api, w['plugin_name'])
+                response = yield plugin_service_request('get-plugin', url)
                 w['plugin'] = response['plugin']
         returnValue(plan)
 
-    @inlineCallbacks
-    def create_session(self, plan, configuration):
-        plan = copy.deepcopy(plan)
-        configuration = copy.deepcopy(configuration)
-        scan = TaskEngineSession(plan, configuration, self._scans_database, self._plugin_service_api, self._artifacts_path)
-        yield scan.create()
-        self._sessions[scan.id] = scan
+    def _new_session(self, plan, configuration):
+        return TaskEngineSession(copy.deepcopy(plan), copy.deepcopy(configuration), self._scans_database,
+                                 self._plugin_services, self._artifacts_path, self._result_cache,
+                                 self._artifact_handoff, self._artifact_store)
 
+    def _start_looper(self):
         # If we have not yet started a looping call to idle the sessions, do that now
         if self._looper is None:
             self._looper = LoopingCall(self._idleSessions)
             self._looper.start(2.0)
-        
+
+    @inlineCallbacks
+    def create_session(self, plan, configuration):
+        scan = self._new_session(plan, configuration)
+        yield scan.create()
+        self._sessions[scan.id] = scan
+        self._start_looper()
         returnValue(scan)
 
+    #
+    # Bulk submission. Scans are returned right away in the QUEUED state
+    # and their plugin sessions are created in the background, at most
+    # create_concurrency scans at a time, in weighted fair order of their
+    # priority. Once created a scan moves to CREATED, or to STARTED if it
+    # was submitted with start. A scan that cannot be created is stored as
+    # FAILED.
+    #
+
+    def submit_sessions(self, submissions, start=False):
+        scans = []
+        for plan, configuration in submissions:
+            scan = self._new_session(plan, configuration)
+            scan._set_state('QUEUED')
+            self._sessions[scan.id] = scan
+            self._create_queue.append(scan, scan.priority)
+            if start:
+                self._start_when_created.add(scan.id)
+            scans.append(scan)
+        self._start_looper()
+        self._create_queued()
+        return scans
+
+    def _create_queued(self):
+        while self._create_queue and self._creating < self._create_concurrency:
+            scan = self._create_queue.popleft()
+            start = scan.id in self._start_when_created
+            self._start_when_created.discard(scan.id)
+            self._creating += 1
+            self._create_queued_session(scan, start).addBoth(self._created)
+
+    def _created(self, result):
+        self._creating -= 1
+        self._create_queued()
+
+    @inlineCallbacks
+    def _create_queued_session(self, scan, start):
+        try:
+            yield scan.create()
+        except Exception as e:
+            logging.error("Failed to create queued scan %s: %s" % (scan.id, str(e)))
+            # Stopped or deleted while it was being created, that is what it is
+            if scan.state != 'QUEUED':
+                return
+            scan.timeline.event('create-failed', error=str(e))
+            scan._set_state('FAILED')
+            try:
+                yield self._scans_database.store(scan.summary())
+            except Exception as e:
+                logging.exception("Failed to store scan %s: %s" % (scan.id, str(e)))
+            deferLater(reactor, 60, self.delete_session, scan.id)
+            return
+        # Stopped or deleted while it was being created
+        if scan.state != 'QUEUED':
+            yield scan._delete_sessions()
+            return
+        scan._set_state('CREATED')
+        if start:
+            yield scan.start()
+
+    #
+    # Scans that were not started have no plugin sessions that need to be
+    # stopped and are STOPPED right away. A QUEUED scan is taken out of the
+    # create queue, if it is being created then its plugin sessions are
+    # deleted once they are. The plugin sessions of a CREATED scan are
+    # deleted now. Other scans stop themselves, see TaskEngineSession.stop().
+    #
+
+    @inlineCallbacks
+    def stop_session(self, scan, delete=False):
+        if scan.state not in ('QUEUED', 'CREATED'):
+            success = yield scan.stop(delete)
+            returnValue(success)
+        if scan.state == 'QUEUED':
+            self._create_queue.remove(scan, scan.priority)
+            self._start_when_created.discard(scan.id)
+            scan._set_state('STOPPED')
+        else:
+            scan._set_state('STOPPED')
+            yield scan._delete_sessions()
+        if delete:
+            self.delete_session(scan.id)
+        else:
+            yield self._scans_database.store(scan.summary())
+            deferLater(reactor, 60, self.delete_session, scan.id)
+        returnValue(True)
+
     def get_session(self, scan_id):
         # If this scan is still running then we grab it from in-memory
         # else we load it from the database.
@@ -516,14 +1363,22 @@ class TaskEngine:
         if scan_id in self._sessions:
             del self._sessions[scan_id]
 
+    #
+    # Scans are idled in order of their priority, so that the plugin
+    # sessions of high priority scans are started and their results are
+    # collected first. Every scan is still idled on every tick.
+    #
+
     @inlineCallbacks
     def _idleSessions(self):
-        for scan_id,session in self._sessions.items():
-            logging.debug("Idling session {}".format(scan_id))
+        started = time.time()
+        for scan_id,session in sorted(self._sessions.items(), key=lambda item: priority_rank(item[1].priority)):
+            logging.debug("Idling session %s", scan_id)
             done = yield session.idle()
             # We delete the session after a minute. This gives web clients who are polling
             # enough time to poll the final results. This is not the best solution but it
             # will do until we have changed the persistence code in the task engine.
             if done:
                 deferLater(reactor, 60, self.delete_session, scan_id)
+        IDLE_TICK_DURATION.observe(time.time() - started)
                 
@@ -0,0 +1,158 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Recurring scans. A schedule is a plan, a scan configuration and an
+# interval in seconds. The schedules are kept in the scan database and
+# their next runs in a heap, with a single timer for the earliest one.
+#
+# Schedules do not run at the start of their interval. Each schedule has
+# a fixed offset within its interval that is derived from its id, so
+# that many schedules with the same interval are spread out over it and
+# a schedule keeps its slot when the task engine is restarted. On top of
+# that scans are started at most rate per second; runs that are due at
+# the same time wait for their turn. A rate of 0 or None means no limit.
+#
+# A run is skipped when the scan of the previous run is still going.
+#
+
+import hashlib
+import heapq
+import logging
+import time
+import uuid
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from minion.common import metrics
+
+
+SCHEDULED_SCANS = metrics.registry.counter("minion_task_engine_scheduled_scans_total",
+                                           "Runs of recurring scans", ("result",))
+
+MIN_INTERVAL = 60
+
+# Scans in these states are still going
+ACTIVE_STATES = ('QUEUED', 'CREATED', 'STARTED', 'STOPPING')
+
+
+def _offset(schedule):
+    # The same schedule always gets the same slot in its interval
+    return int(hashlib.sha1(schedule['id']).hexdigest()[:8], 16) % schedule['interval']
+
+def next_run(schedule, now):
+    """The first time after now that is at the offset of the schedule in its interval"""
+    interval, offset = schedule['interval'], _offset(schedule)
+    return (int(now - offset) // interval + 1) * interval + offset
+
+
+class Scheduler:
+
+    def __init__(self, task_engine, database, rate=1.0):
+        if rate is not None and rate < 0:
+            raise ValueError("Scheduler rate must be 0 or more, not %s" % rate)
+        self.task_engine = task_engine
+        self.database = database
+        self.rate = rate
+        self.schedules = {}
+        self._heap = []
+        self._timer = None
+        self._next_start = 0
+        metrics.registry.gauge("minion_task_engine_schedules", "Recurring scans", function=lambda: len(self.schedules))
+
+    @inlineCallbacks
+    def start(self):
+        schedules = yield self.database.load_schedules()
+        now = time.time()
+        for schedule in schedules or []:
+            # Runs that were missed while we were down are done once, right away
+            if schedule['next_run'] < now:
+                schedule['next_run'] = now
+            self._add(schedule)
+        logging.info("Loaded %d scan schedules" % len(self.schedules))
+
+    def _add(self, schedule):
+        self.schedules[schedule['id']] = schedule
+        heapq.heappush(self._heap, (schedule['next_run'], schedule['id']))
+        self._arm()
+
+    def _arm(self):
+        # One timer for the earliest run, or for the next start that the rate allows
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        if self._heap:
+            when = max(self._heap[0][0], self._next_start)
+            self._timer = reactor.callLater(max(0, when - time.time()), self._run_due)
+
+    def _run_due(self):
+        self._timer = None
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now and self._next_start <= now:
+            when, schedule_id = heapq.heappop(self._heap)
+            schedule = self.schedules.get(schedule_id)
+            # Deleted or rescheduled, the heap entry is stale
+            if schedule is None or schedule['next_run'] != when:
+                continue
+            if self.rate:
+                self._next_start = max(now, self._next_start) + 1.0 / self.rate
+            schedule['next_run'] = next_run(schedule, now)
+            heapq.heappush(self._heap, (schedule['next_run'], schedule_id))
+            self._run(schedule).addErrback(lambda failure: logging.error("Failed to store schedule: %s" % failure.value))
+        self._arm()
+
+    @inlineCallbacks
+    def _run(self, schedule):
+        try:
+            previous = None
+            if schedule.get('last_scan'):
+                previous = yield self.task_engine.get_session(schedule['last_scan'])
+            if previous is not None and previous.state in ACTIVE_STATES:
+                logging.info("Skipping run of schedule %s, scan %s is still %s"
+                             % (schedule['id'], previous.id, previous.state))
+                schedule['skipped'] += 1
+                SCHEDULED_SCANS.inc(labels=('skipped',))
+            else:
+                plan = yield self.task_engine.get_plan(schedule['plan'])
+                if plan is None:
+                    raise Exception("No such plan %s" % schedule['plan'])
+                scan, = self.task_engine.submit_sessions([(plan, schedule['configuration'])], start=True)
+                schedule['last_scan'] = scan.id
+                schedule['last_run'] = time.time()
+                schedule['runs'] += 1
+                schedule['error'] = None
+                SCHEDULED_SCANS.inc(labels=('started',))
+        except Exception as e:
+            logging.error("Failed to run schedule %s: %s" % (schedule['id'], str(e)))
+            schedule['error'] = str(e)
+            SCHEDULED_SCANS.inc(labels=('failed',))
+        if schedule['id'] in self.schedules:
+            yield self.database.store_schedule(schedule)
+
+    # Called from the api
+
+    @inlineCallbacks
+    def create(self, plan_name, configuration, interval):
+        schedule = { 'id': str(uuid.uuid4()),
+                     'plan': plan_name,
+                     'configuration': configuration,
+                     'interval': interval,
+                     'created': int(time.time()),
+                     'last_run': None,
+                     'last_scan': None,
+                     'runs': 0,
+                     'skipped': 0,
+                     'error': None }
+        schedule['next_run'] = next_run(schedule, time.time())
+        yield self.database.store_schedule(schedule)
+        self._add(schedule)
+        returnValue(schedule)
+
+    @inlineCallbacks
+    def delete(self, schedule_id):
+        schedule = self.schedules.pop(schedule_id, None)
+        if schedule is not None:
+            yield self.database.delete_schedule(schedule_id)
+        returnValue(schedule)
@@ -4,21 +4,95 @@
 
 import base64
 import json
+import logging
 import os
 import re
 import sys
 import urlparse
 
 import cyclone.web
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, succeed
 
-from minion.task_engine.engine import TaskEngine, SCAN_DATABASE_CLASSES
+from minion.common import metrics
+from minion.common import priority
+from minion.common import streaming
+from minion.common.compression import Compression
+from minion.common import tracing
+from minion.common.profiling import ReactorProfiler, DEFAULT_PROFILE_SECONDS
+from minion.task_engine.artifacts import ArtifactStore
+from minion.task_engine.engine import TaskEngine, ResultCache, SCAN_DATABASE_CLASSES, configuration_targets
+from minion.task_engine.scheduler import Scheduler, MIN_INTERVAL
 
 
 TASK_ENGINE_SYSTEM_SETTINGS_PATH = "/etc/minion/task-engine.conf"
 TASK_ENGINE_USER_SETTINGS_PATH = "~/.minion/task-engine.conf"
 
 
+REQUESTS = metrics.registry.counter("minion_task_engine_requests_total",
+                                    "HTTP requests handled", ("handler", "method", "status"))
+REQUEST_DURATION = metrics.registry.histogram("minion_task_engine_request_duration_seconds",
+                                              "HTTP request latency", ("handler",))
+
+
+# Scans and results can be large. They are compressed if the client
+# accepts that. This returns a Deferred that handlers have to wait for.
+
+def _finish_json(handler, data):
+    body = json.dumps(data)
+    if handler.application.compression is None:
+        handler.set_header("Content-Type", "application/json")
+        handler.finish(body)
+        return succeed(None)
+    return handler.application.compression.finish(handler, body, "application/json")
+
+
+# Answer with a 304 if the client already has this version of a running
+# scan. This saves building and encoding the summary.
+
+def _not_modified(handler, session):
+    etag = session.etag()
+    handler.set_header("Etag", etag)
+    if etag in [e.strip() for e in handler.request.headers.get("If-None-Match", "").split(",")]:
+        handler.set_status(304)
+        handler.finish()
+        return True
+    return False
+
+
+class MetricsHandler(cyclone.web.RequestHandler):
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.finish(metrics.registry.exposition())
+
+
+class ProfileHandler(cyclone.web.RequestHandler):
+
+    def post(self):
+        profiler = self.application.profiler
+        if profiler is None:
+            self.finish({'success': False, 'error': 'profiling-disabled'})
+            return
+        try:
+            seconds = int(self.get_argument('seconds', DEFAULT_PROFILE_SECONDS))
+        except ValueError:
+            self.finish({'success': False, 'error': 'invalid-seconds'})
+            return
+        path = profiler.start(seconds)
+        if path is None:
+            self.finish({'success': False, 'error': 'already-profiling'})
+            return
+        self.finish({'success': True, 'path': path})
+
+
+class PluginServicesHandler(cyclone.web.RequestHandler):
+
+    def get(self):
+        task_engine = self.application.task_engine
+        self.finish({'success': True, 'plugin-services': task_engine.get_plugin_services()})
+
+
 class PlansHandler(cyclone.web.RequestHandler):
 
     @inlineCallbacks
@@ -45,9 +119,12 @@ class CreateScanHandler(cyclone.web.RequestHandler):
     # This is pretty strict configuration validation where we just accept
     # configs of the form: { "target": "http://some.site.com" } .. the url
     # is not allowed to have embedded authentication, a query or a fragment
-    # to avoid abuse of the service.
+    # to avoid abuse of the service. A scan of many sites has a list of
+    # targets instead: { "targets": ["http://a.site.com", "http://b.site.com"] }
+    # A scan can have a priority, one of "high", "normal" (the default) or "low".
 
-    ALLOWED_CONFIGURATION_FIELDS = ('target',)
+    ALLOWED_CONFIGURATION_FIELDS = ('target', 'targets', 'priority')
+    MAX_TARGETS = 10000
     
     def _validate_target(self, url):
         """Only accept URLs that are basic. No query, fragment or embedded auth allowed"""
@@ -62,13 +139,32 @@ class CreateScanHandler(cyclone.web.RequestHandler):
         
     def _validate_configuration(self, body):
         try:
-            cfg = json.loads(body)
+            return self._check_configuration(json.loads(body))
+        except Exception as e:
+            return False, None
+
+    def _check_configuration(self, cfg):
+        try:
             if not isinstance(cfg, dict):
                 return False,None
             for key in cfg.keys():
                 if key not in self.ALLOWED_CONFIGURATION_FIELDS:
                     return False,None
-            if 'target' not in cfg or not self._validate_target(cfg['target']):
+            if ('target' in cfg) == ('targets' in cfg):
+                return False,None
+            if 'target' in cfg and not self._validate_target(cfg['target']):
+                return False,None
+            if 'targets' in cfg:
+                targets = cfg['targets']
+                if not isinstance(targets, list) or not 0 < len(targets) <= self.MAX_TARGETS:
+                    return False,None
+                for target in targets:
+                    if not self._validate_target(target):
+                        return False,None
+                # Drop duplicates, keeping the order
+                seen = set()
+                cfg['targets'] = [t for t in targets if not (t in seen or seen.add(t))]
+            if 'priority' in cfg and not priority.valid_priority(cfg['priority']):
                 return False,None
             return True, cfg
         except Exception as e:
@@ -89,10 +185,144 @@ class CreateScanHandler(cyclone.web.RequestHandler):
             self.finish({'success': False, 'error': 'invalid-configuration'})
             return
 
-        session = yield task_engine.create_session(plan, configuration)
+        try:
+            session = yield task_engine.create_session(plan, configuration)
+        except Exception as e:
+            logging.exception("Failed to create scan: %s" % str(e))
+            self.finish({'success': False, 'error': 'plugin-service-unavailable'})
+            return
         self.finish({ 'success': True, 'scan': session.summary() })
 
 
+class CreateScansHandler(CreateScanHandler):
+
+    # Bulk submission of scans: { "scans": [{ "plan": "tickle", "configuration":
+    # { "target": "http://some.site.com" } }, ...], "start": true }. Everything
+    # is validated first, if anything is wrong then no scan is created. The
+    # scans are returned right away in the QUEUED state. Their plugin sessions
+    # are created in the background, after which they are CREATED or, with
+    # start, STARTED.
+
+    MAX_SCANS = 10000
+
+    @inlineCallbacks
+    def put(self):
+
+        task_engine = self.application.task_engine
+
+        try:
+            body = json.loads(self.request.body)
+            submissions = body['scans']
+            start = body.get('start', False)
+            if not isinstance(submissions, list) or not isinstance(start, bool):
+                raise ValueError()
+        except Exception as e:
+            self.finish({'success': False, 'error': 'invalid-request'})
+            return
+
+        if len(submissions) > self.MAX_SCANS:
+            self.finish({'success': False, 'error': 'too-many-scans'})
+            return
+
+        # Plans are looked up once, not once per scan
+        plans = {}
+        for index, submission in enumerate(submissions):
+            if not isinstance(submission, dict) or not isinstance(submission.get('plan'), basestring):
+                self.finish({'success': False, 'error': 'invalid-request', 'index': index})
+                return
+            plan_name = submission['plan']
+            if plan_name not in plans:
+                try:
+                    plans[plan_name] = yield task_engine.get_plan(plan_name)
+                except Exception as e:
+                    logging.exception("Failed to get plan %s: %s" % (plan_name, str(e)))
+                    self.finish({'success': False, 'error': 'plugin-service-unavailable'})
+                    return
+            if plans[plan_name] is None:
+                self.finish({'success': False, 'error': 'no-such-plan', 'index': index})
+                return
+            valid, configuration = self._check_configuration(submission.get('configuration'))
+            if not valid:
+                self.finish({'success': False, 'error': 'invalid-configuration', 'index': index})
+                return
+            submission['configuration'] = configuration
+
+        scans = task_engine.submit_sessions([(plans[s['plan']], s['configuration']) for s in submissions], start)
+        self.finish({ 'success': True, 'scans': [{ 'id': scan.id, 'state': scan.state } for scan in scans] })
+
+
+class CreateScheduleHandler(CreateScanHandler):
+
+    # Recurring scans: { "configuration": { "target": "http://some.site.com" },
+    # "interval": 86400 } runs a scan of the plan every day. The interval is
+    # in seconds and at least a minute.
+
+    @inlineCallbacks
+    def put(self, plan_name):
+
+        scheduler = self.application.scheduler
+        if scheduler is None:
+            self.finish({'success': False, 'error': 'scheduler-disabled'})
+            return
+
+        try:
+            body = json.loads(self.request.body)
+            configuration, interval = body['configuration'], body['interval']
+        except Exception as e:
+            self.finish({'success': False, 'error': 'invalid-request'})
+            return
+
+        if not isinstance(interval, int) or interval < MIN_INTERVAL:
+            self.finish({'success': False, 'error': 'invalid-interval'})
+            return
+
+        valid, configuration = self._check_configuration(configuration)
+        if not valid:
+            self.finish({'success': False, 'error': 'invalid-configuration'})
+            return
+
+        plan = yield self.application.task_engine.get_plan(plan_name)
+        if plan is None:
+            self.finish({'success': False, 'error': 'no-such-plan'})
+            return
+
+        schedule = yield scheduler.create(plan_name, configuration, interval)
+        self.finish({ 'success': True, 'schedule': schedule })
+
+
+class SchedulesHandler(cyclone.web.RequestHandler):
+
+    def get(self):
+        scheduler = self.application.scheduler
+        if scheduler is None:
+            self.finish({'success': False, 'error': 'scheduler-disabled'})
+            return
+        schedules = sorted(scheduler.schedules.values(), key=lambda schedule: schedule['next_run'])
+        return _finish_json(self, { 'success': True, 'schedules': schedules })
+
+
+class ScheduleHandler(cyclone.web.RequestHandler):
+
+    def get(self, schedule_id):
+        scheduler = self.application.scheduler
+        schedule = scheduler.schedules.get(schedule_id) if scheduler is not None else None
+        if schedule is None:
+            self.finish({'success': False, 'error': 'no-such-schedule'})
+            return
+        self.finish({ 'success': True, 'schedule': schedule })
+
+    @inlineCallbacks
+    def delete(self, schedule_id):
+        scheduler = self.application.scheduler
+        schedule = None
+        if scheduler is not None:
+            schedule = yield scheduler.delete(schedule_id)
+        if schedule is None:
+            self.finish({'success': False, 'error': 'no-such-schedule'})
+            return
+        self.finish({ 'success': True, 'schedule': schedule })
+
+
 class ChangeScanStateHandler(cyclone.web.RequestHandler):
     
     @inlineCallbacks
@@ -116,26 +346,111 @@ class ChangeScanStateHandler(cyclone.web.RequestHandler):
                 self.finish({'success': False, 'error': 'invalid-state-transition'})
                 return
         elif state == 'STOP':
-            success = yield session.stop()
+            success = yield task_engine.stop_session(session)
             if not success:
                 self.finish({'success': False, 'error': 'invalid-state-transition'})
                 return
 
         self.finish({'success': True})
         
+#
+# Field projection for scans. Clients can ask for only the parts of a scan
+# they need with ?fields=state,sessions.state,sessions.progress or drop
+# parts with ?exclude=plan,sessions.issues. Paths go into lists, so
+# sessions.state is the state of every session. The projection builds new
+# dicts only along the requested paths, everything else (like the issue
+# lists) is shared with the scan and not copied.
+#
+# Sessions have a severity_counts field that is computed from their
+# issues. Excluding the issues of a session puts the counts in their place.
+#
+
+FIELDS_PATTERN = re.compile(r"^[A-Za-z0-9_.,]*$")
+
+def _severity_counts(issues):
+    counts = {}
+    for issue in issues:
+        severity = issue.get('Severity')
+        counts[severity] = counts.get(severity, 0) + 1
+    return counts
+
+def _parse_fields(value):
+    tree = {}
+    for path in value.split(","):
+        if path:
+            node = tree
+            for name in path.split("."):
+                node = node.setdefault(name, {})
+    return tree
+
+def _project(data, tree):
+    if isinstance(data, list):
+        return [_project(item, tree) for item in data]
+    if not tree or not isinstance(data, dict):
+        return data
+    result = {}
+    for name, subtree in tree.items():
+        if name in data:
+            result[name] = _project(data[name], subtree)
+        elif name == 'severity_counts' and 'issues' in data:
+            result[name] = _severity_counts(data['issues'])
+    return result
+
+def _exclude(data, tree):
+    if isinstance(data, list):
+        return [_exclude(item, tree) for item in data]
+    if not isinstance(data, dict):
+        return data
+    result = dict(data)
+    for name, subtree in tree.items():
+        if name not in result:
+            continue
+        if subtree:
+            result[name] = _exclude(result[name], subtree)
+        else:
+            if name == 'issues' and isinstance(result[name], list):
+                result['severity_counts'] = _severity_counts(result[name])
+            del result[name]
+    return result
+
+def _filter_targets(scan, targets):
+    # Only the sessions that scanned one of the targets, with just the issues about them
+    scan = dict(scan)
+    scan['sessions'] = [dict(session, issues=[issue for issue in session['issues'] if issue.get('Target') in targets])
+                        for session in scan['sessions']
+                        if targets.intersection(configuration_targets(session['configuration']))]
+    return scan
+
 class ScanHandler(cyclone.web.RequestHandler):
 
+    def _finish_scan(self, scan):
+        targets = self.get_arguments('target')
+        if targets:
+            scan = _filter_targets(scan, set(targets))
+        fields = self.get_argument('fields', None)
+        if fields is not None:
+            scan = _project(scan, _parse_fields(fields))
+        exclude = self.get_argument('exclude', None)
+        if exclude is not None:
+            scan = _exclude(scan, _parse_fields(exclude))
+        return _finish_json(self, { 'success': True, 'scan': scan })
+
     @inlineCallbacks
     def get(self, scan_id):
 
         task_engine = self.application.task_engine
 
+        for name in ('fields', 'exclude'):
+            if not FIELDS_PATTERN.match(self.get_argument(name, "")):
+                self.finish({'success': False, 'error': 'invalid-' + name})
+                return
+
         # Try to load this from the database. If it is not there then the scan
         # might be still in progress in which case the task engine has it.
 
         scan = yield self.application.scan_database.load(scan_id)
         if scan is not None:
-            self.finish({ 'success': True, 'scan': scan })
+            yield self._finish_scan(scan)
             return
 
         session = yield task_engine.get_session(scan_id)
@@ -143,7 +458,10 @@ class ScanHandler(cyclone.web.RequestHandler):
             self.finish({'success': False, 'error': 'no-such-scan'})
             return
 
-        self.finish({ 'success': True, 'scan': session.summary() })
+        if _not_modified(self, session):
+            return
+
+        yield self._finish_scan(session.summary())
 
     @inlineCallbacks
     def delete(self, scan_id):
@@ -155,7 +473,7 @@ class ScanHandler(cyclone.web.RequestHandler):
 
         session = yield task_engine.get_session(scan_id)
         if session is not None:
-            success = yield session.stop(delete=True)
+            success = yield task_engine.stop_session(session, delete=True)
             self.finish({'success': True})
             return        
 
@@ -165,11 +483,60 @@ class ScanHandler(cyclone.web.RequestHandler):
         scan = yield self.application.scan_database.load(scan_id)
         if scan is not None:
             yield self.application.scan_database.delete(scan_id)
+            if self.application.artifact_store is not None:
+                for session in scan['sessions']:
+                    self.application.artifact_store.delete(session['id'])
             self.finish({ 'success': True, 'scan': scan })
             return
 
         self.finish({'success': False, 'error': 'no-such-scan'})
 
+class ScanDiffHandler(cyclone.web.RequestHandler):
+
+    # The new and resolved issues of a finished scan compared to the
+    # previous scan of the same plan and target.
+
+    @inlineCallbacks
+    def get(self, scan_id):
+        diff = yield self.application.scan_database.load_diff(scan_id)
+        if diff is None:
+            self.finish({'success': False, 'error': 'no-such-diff'})
+            return
+        yield _finish_json(self, {'success': True, 'diff': diff})
+
+class ScanTraceHandler(cyclone.web.RequestHandler):
+
+    # Export the timeline of a scan in the Chrome trace event format. This
+    # can be loaded in chrome://tracing or ui.perfetto.dev. The scan gets
+    # a track and every plugin session gets a track per component.
+
+    def _tracks(self, scan):
+        timeline = scan.get('timeline') or {}
+        tracks = [("task-engine", "scan", timeline.get('events', []))]
+        for session in scan['sessions']:
+            name = "%s %s" % (session['plugin']['class'], session['id'][:8])
+            tracks.append(("task-engine", name, timeline.get('sessions', {}).get(session['id'], [])))
+            events = (session.get('timeline') or {}).get('events', [])
+            runner_events = [e for e in events if e.get('attributes', {}).get('source') == 'runner']
+            tracks.append(("plugin-service", name, [e for e in events if e not in runner_events]))
+            tracks.append(("plugin-runner", name, runner_events))
+        return tracing.chrome_trace(tracks, timeline.get('trace_id'))
+
+    @inlineCallbacks
+    def get(self, scan_id):
+
+        scan = yield self.application.scan_database.load(scan_id)
+        if scan is None:
+            session = yield self.application.task_engine.get_session(scan_id)
+            if session is not None:
+                scan = session.summary()
+
+        if scan is None:
+            self.finish({'success': False, 'error': 'no-such-scan'})
+            return
+
+        yield _finish_json(self, self._tracks(scan))
+
 class ScanResultsHandler(cyclone.web.RequestHandler):
 
     def _validate_token(self, token):
@@ -186,7 +553,7 @@ class ScanResultsHandler(cyclone.web.RequestHandler):
     
     def _all_sessions_done(self, sessions):
         for session in sessions:
-            if session['state'] in ('CREATED', 'STARTED'):
+            if session['state'] in ('CREATED', 'QUEUED', 'STARTED', 'STOPPING'):
                 return False
         return True
 
@@ -219,16 +586,22 @@ class ScanResultsHandler(cyclone.web.RequestHandler):
                 self.finish({ 'success': False, 'error': 'malformed-token' })
                 return
             since = self._parse_token(token)
+
+        if _not_modified(self, session):
+            return
             
-        scan_results = session.results(since=since)
+        targets = self.get_arguments('target')
+        scan_results = session.results(since=since, targets=set(targets) if targets else None)
         token = self._generate_token(since, scan_results['sessions'])
-        self.finish({ 'success': True, 'scan': scan_results, 'token': token })
+        yield _finish_json(self, { 'success': True, 'scan': scan_results, 'token': token })
 
 class ScanArtifactsHandler(cyclone.web.RequestHandler):
 
     @inlineCallbacks
     def get(self, scan_id, session_id):
 
+        task_engine = self.application.task_engine
+
         # Try to load this from the database. If it is not there then the scan
         # might be still in progress in which case the task engine has it.
 
@@ -241,40 +614,49 @@ class ScanArtifactsHandler(cyclone.web.RequestHandler):
         if scan is None:
             raise cyclone.web.HTTPError(404)
         
+        # Artifacts in the artifact store are served as a zip that is put
+        # together from the blobs as it is sent
+
+        artifact_store = self.application.artifact_store
+        manifest = artifact_store.load_manifest(session_id) if artifact_store is not None else None
+        if manifest is not None:
+            segments, size = artifact_store.zip_segments(manifest)
+            yield streaming.serve_segments(self, segments, size, manifest['etag'], manifest['mtime'],
+                                           "application/zip", session_id + ".zip")
+            return
+
         artifacts_path = os.path.expanduser(self.settings['task_engine']['artifacts_path']) + "/" + session_id + ".zip"
-        print "LOOKING AT", artifacts_path
         if not os.path.exists(artifacts_path):
             raise cyclone.web.HTTPError(404)            
 
-        with open(artifacts_path) as f:
-            data = f.read()
-            self.set_header("Content-Type", "application/zip")
-            self.set_header("Content-Length", str(len(data)))
-            self.finish(data)        
-        
+        # Stream the zip, downloads can be resumed with a Range request
+        yield streaming.serve_file(self, artifacts_path, "application/zip", session_id + ".zip")
+
 
 class TaskEngineApplication(cyclone.web.Application):
 
-    def __init__(self):
+    def __init__(self, task_engine_settings=None):
 
         # Configure our settings. We have basic default settings that just work for development
         # and then override those with what is defined in either ~/.minion/ or /etc/minion/
-
-        task_engine_settings = dict(plugin_service_api="http://127.0.0.1:8181",
-                                    scan_database_type="memory",
-                                    scan_database_location=None,
-                                    artifacts_path="/tmp")
-
-        for settings_path in (TASK_ENGINE_USER_SETTINGS_PATH, TASK_ENGINE_SYSTEM_SETTINGS_PATH):
-            settings_path = os.path.expanduser(settings_path)
-            if os.path.exists(settings_path):
-                with open(settings_path) as file:
-                    try:
-                        task_engine_settings = json.load(file)
-                        break
-                    except Exception as e:
-                        logging.error("Failed to parse configuration file %s: %s" % (settings_path, str(e)))
-                        sys.exit(1)
+        # Settings can also be passed in directly, which is what the benchmarks do.
+
+        if task_engine_settings is None:
+            task_engine_settings = dict(plugin_service_api="http://127.0.0.1:8181",
+                                        scan_database_type="memory",
+                                        scan_database_location=None,
+                                        artifacts_path="/tmp")
+
+            for settings_path in (TASK_ENGINE_USER_SETTINGS_PATH, TASK_ENGINE_SYSTEM_SETTINGS_PATH):
+                settings_path = os.path.expanduser(settings_path)
+                if os.path.exists(settings_path):
+                    with open(settings_path) as file:
+                        try:
+                            task_engine_settings = json.load(file)
+                            break
+                        except Exception as e:
+                            logging.error("Failed to parse configuration file %s: %s" % (settings_path, str(e)))
+                            sys.exit(1)
 
         # Setup the database
 
@@ -292,17 +674,85 @@ class TaskEngineApplication(cyclone.web.Application):
         
         # Create the Task Engine
 
+        # The plugin service api can be a single url or a list of urls if
+        # plugins should be spread out over multiple plugin services.
+
+        # Results of plugin runs can be reused by later scans of the same
+        # target. This is opt-in, the result_cache setting can configure
+        # the default ttl, a ttl per plugin class and max_entries.
+
+        result_cache = None
+        result_cache_settings = task_engine_settings.get('result_cache')
+        if result_cache_settings is not None:
+            result_cache = ResultCache(**result_cache_settings)
+
+        # Artifacts of plugin services on the same host are taken with a hard
+        # link when possible. Set artifact_handoff to false to always download.
+
+        # Artifact files are deduplicated in a content addressed store under
+        # artifacts_path. The artifact_store setting can configure the path,
+        # gc_interval and gc_grace. Set it to null to keep plain zips.
+
+        self.artifact_store = None
+        artifact_store_settings = task_engine_settings.get('artifact_store', {})
+        if artifact_store_settings is not None:
+            artifact_store_settings = dict(artifact_store_settings)
+            path = artifact_store_settings.pop('path', os.path.join(task_engine_settings['artifacts_path'], "store"))
+            self.artifact_store = ArtifactStore(path, **artifact_store_settings)
+
+        # Scans submitted in bulk are created in the background, with at most
+        # create_concurrency scans talking to the plugin services at a time,
+        # in weighted fair order of their priority. The priority_weights
+        # setting can change the weights of the high, normal and low priorities.
+
         self.task_engine = TaskEngine(self.scan_database, task_engine_settings['plugin_service_api'],
-                                      task_engine_settings['artifacts_path'])
+                                      task_engine_settings['artifacts_path'], result_cache,
+                                      task_engine_settings.get('artifact_handoff', True), self.artifact_store,
+                                      task_engine_settings.get('create_concurrency', 10),
+                                      task_engine_settings.get('priority_weights'))
+
+        # Recurring scans. The scheduler setting can configure the rate, the
+        # most scheduled scans that are started per second, 0 for no limit.
+        # Set it to null to disable the scheduler.
+
+        self.scheduler = None
+        scheduler_settings = task_engine_settings.get('scheduler', {})
+        if scheduler_settings is not None:
+            self.scheduler = Scheduler(self.task_engine, self.scan_database, **scheduler_settings)
+            reactor.callWhenRunning(self.scheduler.start)
+
+        # On-demand profiling. SIGUSR2 always profiles for the default
+        # time. The /debug/profile api has to be enabled explicitly.
+
+        profiling_settings = task_engine_settings.get('profiling', {})
+        profiler = ReactorProfiler("task-engine", profiling_settings.get('directory', '/tmp'))
+        profiler.install_signal_handler()
+        self.profiler = profiler if profiling_settings.get('enabled') else None
+
+        # Compress large scan and results responses. The compression
+        # settings can configure minimum_size, thread_size (above which we
+        # compress in a thread) and level. Set it to null to disable.
+
+        compression_settings = task_engine_settings.get('compression', {})
+        self.compression = Compression(**compression_settings) if compression_settings is not None else None
 
         # Setup our routes and initialize the Cyclone application
 
         handlers = [
+            (r"/metrics", MetricsHandler),
+            (r"/debug/profile", ProfileHandler),
+            (r"/plugin-services", PluginServicesHandler),
             (r"/plans", PlansHandler),
             (r"/plan/([a-z0-9_-]+)", PlanHandler),
             (r"/scan/create/([a-z0-9_-]+)", CreateScanHandler),
+            (r"/scans/create", CreateScansHandler),
+            (r"/schedule/create/([a-z0-9_-]+)", CreateScheduleHandler),
+            (r"/schedules", SchedulesHandler),
+            (r"/schedule/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})", ScheduleHandler),
             (r"/scan/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/state", ChangeScanStateHandler),
             (r"/scan/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/results", ScanResultsHandler),
+            (r"/scan/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/diff", ScanDiffHandler),
+            (r"/scan/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/trace", ScanTraceHandler),
             (r"/scan/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/artifacts/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})", ScanArtifactsHandler),
             (r"/scan/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})", ScanHandler),
         ]
@@ -314,5 +764,11 @@ class TaskEngineApplication(cyclone.web.Application):
 
         cyclone.web.Application.__init__(self, handlers, **settings)
 
+    def log_request(self, handler):
+        cyclone.web.Application.log_request(self, handler)
+        name = handler.__class__.__name__
+        REQUESTS.inc(labels=(name, handler.request.method, handler.get_status()))
+        REQUEST_DURATION.observe(handler.request.request_time(), (name,))
+
 
 Application = lambda: TaskEngineApplication()
@@ -6,7 +6,8 @@ from setuptools import setup
 
 install_requires = [
     'requests==1.1',
-    'cyclone==1.0'
+    'cyclone==1.0',
+    'minion.common==0.1'
 ]
 
 setup(name="minion.task_engine",